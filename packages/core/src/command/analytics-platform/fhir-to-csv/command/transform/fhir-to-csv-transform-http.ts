@@ -1,5 +1,5 @@
-import axios from "axios";
-import { executeWithNetworkRetries, MetriportError } from "@metriport/shared";
+import axios, { AxiosResponse, isAxiosError } from "axios";
+import { executeWithNetworkRetries, MetriportError, sleep } from "@metriport/shared";
 import { Config } from "../../../../../util/config";
 import { out } from "../../../../../util/log";
 import {
@@ -8,6 +8,14 @@ import {
   StartFhirToCsvTransformRequest,
 } from "./fhir-to-csv-transform";
 
+const JOB_POLLING_INTERVAL_IN_MILLIS = 1_000;
+
+type FhirToCsvTransformJob = {
+  jobId: string;
+  status: "queued" | "running" | "completed" | "failed";
+  error?: string | null;
+};
+
 export class FhirToCsvTransformHttp implements FhirToCsvTransformHandler {
   constructor(
     private readonly httpEndpoint: string = Config.getFhirToCsvTransformHttpEndpoint(),
@@ -35,18 +43,63 @@ export class FhirToCsvTransformHttp implements FhirToCsvTransformHandler {
       OUTPUT_S3_BUCKET: this.outputBucket,
     };
 
-    await executeWithNetworkRetries(async () => {
-      const response = await axios.post(`${this.httpEndpoint}/transform`, payload, {
-        headers: { "Content-Type": "application/json" },
-        ...(timeoutInMillis !== undefined ? { timeout: timeoutInMillis } : {}),
-      });
-      if (response.status !== 200) {
+    const startedAt = Date.now();
+    const jobId = await executeWithNetworkRetries(async () => {
+      let response: AxiosResponse;
+      try {
+        response = await axios.post(`${this.httpEndpoint}/transform`, payload, {
+          headers: { "Content-Type": "application/json" },
+          ...(timeoutInMillis !== undefined ? { timeout: timeoutInMillis } : {}),
+        });
+      } catch (error) {
+        // The patient already has a job in progress, e.g. this is a retry of a request the server
+        // enqueued: wait for that job instead
+        const activeJobId = getActiveJobId(error);
+        if (activeJobId) {
+          log(`Transform job ${activeJobId} already in progress for this patient`);
+          return activeJobId;
+        }
+        throw error;
+      }
+      if (response.status !== 202) {
         throw new MetriportError(`HTTP request failed with status ${response.status}`, undefined, {
           status: response.status,
           statusText: response.statusText,
         });
       }
-      log(`Transform completed successfully`);
+      return response.data.jobId as string;
+    });
+    log(`Transform job ${jobId} enqueued, waiting for it to finish`);
+
+    // The server runs transforms asynchronously, poll the job until it's done
+    while (timeoutInMillis === undefined || Date.now() - startedAt < timeoutInMillis) {
+      const job = await executeWithNetworkRetries(async () => {
+        const response = await axios.get<FhirToCsvTransformJob>(
+          `${this.httpEndpoint}/jobs/${jobId}`
+        );
+        return response.data;
+      });
+      if (job.status === "completed") {
+        log(`Transform completed successfully`);
+        return;
+      }
+      if (job.status === "failed") {
+        throw new MetriportError(`Transform job failed`, undefined, {
+          jobId,
+          error: job.error ?? undefined,
+        });
+      }
+      await sleep(JOB_POLLING_INTERVAL_IN_MILLIS);
+    }
+    throw new MetriportError(`Timed out waiting for transform job`, undefined, {
+      jobId,
+      timeoutInMillis,
     });
   }
 }
+
+function getActiveJobId(error: unknown): string | undefined {
+  if (!isAxiosError(error) || error.response?.status !== 409) return undefined;
+  const jobId = error.response.data?.jobId;
+  return typeof jobId === "string" ? jobId : undefined;
+}
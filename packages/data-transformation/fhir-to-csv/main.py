@@ -1,11 +1,14 @@
 import boto3
 import os
 import shutil
-import json
-import ndjson
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from src.parseNdjsonBundle import parseNdjsonBundle
+from src.loadToDwh import loadToDwh
+from src.utils.dwh import DWH
 from src.utils.environment import Environment
+from src.utils import metrics
+from src.utils import jsonlib
+from src.utils.checkpoint import Checkpoint, create_checkpoint_key
 from src.utils.file import create_consolidated_key, create_patient_output_prefix
 
 transform_name = 'fhir-to-csv'
@@ -14,31 +17,109 @@ env = Environment(os.getenv("ENV") or Environment.DEV)
 
 s3_client = boto3.client("s3")
 
+download_chunk_size = 8 * 1024 * 1024
+
 def upload_file_to_s3(file: str, output_bucket: str, output_file_key: str) -> tuple[str, str, str]:
     """Upload a single file to S3 and return the result tuple."""
     table_name = file.split("/")[-1].replace(".csv", "")
     with open(file, "rb") as f:
         print(f"Uploading file {file} to {output_bucket}/{output_file_key}")
-        s3_client.upload_fileobj(f, output_bucket, output_file_key)
+        with metrics.s3_transfer_seconds.labels(operation="upload").time():
+            s3_client.upload_fileobj(f, output_bucket, output_file_key)
     return (output_bucket, output_file_key, table_name)
 
+def upload_dead_letters(local_patient_path: str, output_bucket: str, pt_output_file_prefix: str) -> None:
+    """Resources that failed to parse, kept next to the outputs but not loaded into the DWH."""
+    local_dead_letter_file = f"{local_patient_path}/{parseNdjsonBundle.dead_letter_file_name}"
+    if os.path.exists(local_dead_letter_file):
+        upload_file_to_s3(
+            local_dead_letter_file,
+            output_bucket,
+            f"{pt_output_file_prefix}/{parseNdjsonBundle.dead_letter_file_name}",
+        )
+
+def load_checkpoint(input_bucket: str, output_bucket: str, cx_id: str, patient_id: str, output_file_prefix: str) -> Checkpoint:
+    """The checkpoint of a previous attempt to transform this patient's current bundle, if any."""
+    bundle_key = create_consolidated_key(cx_id, patient_id)
+    try:
+        bundle_etag = s3_client.head_object(Bucket=input_bucket, Key=bundle_key)["ETag"].strip('"')
+    except s3_client.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == '404':
+            print(f"Bundle {bundle_key} not found in input bucket {input_bucket}")
+            raise ValueError("Bundle not found") from e
+        else:
+            raise e
+    pt_output_file_prefix = create_patient_output_prefix(output_file_prefix, patient_id)
+    checkpoint_key = create_checkpoint_key(pt_output_file_prefix)
+    return Checkpoint(s3_client, output_bucket, checkpoint_key, bundle_etag).load()
+
 def transform_and_upload_data(
     input_bucket: str,
     output_bucket: str,
     cx_id: str,
     patient_id: str,
     output_file_prefix: str,
+    checkpoint: Checkpoint,
 ) -> list[tuple[str, str, str]]:
+    if checkpoint.uploaded:
+        print(f"All tables were already uploaded for patient_id {patient_id}")
+        return list(checkpoint.uploaded_tables.values())
+
     bundle_key = create_consolidated_key(cx_id, patient_id)
     local_cx_path = f"/tmp/{transform_name}/output/{cx_id}"
     os.makedirs(local_cx_path, exist_ok=True)
     local_patient_path = f"{local_cx_path}/{patient_id}"
     os.makedirs(local_patient_path, exist_ok=True)
+    try:
+        return transform_and_upload_patient_data(
+            input_bucket, output_bucket, bundle_key, patient_id, output_file_prefix, local_patient_path, checkpoint,
+        )
+    finally:
+        # Progress is kept in the checkpoint, not locally: the folder is always cleaned up. Only the
+        # patient's folder, other patients of the same customer might be processed concurrently
+        print(f"Cleaning up local files in {local_patient_path}")
+        shutil.rmtree(local_patient_path, ignore_errors=True)
+
+def wait_for_uploads(
+    future_to_file: dict,
+    checkpoint: Checkpoint,
+    output_bucket_and_file_keys_and_table_names: list[tuple[str, str, str]],
+) -> None:
+    """Marks each uploaded table in the checkpoint, raises the first upload error once all are done."""
+    error = None
+    for future in as_completed(future_to_file):
+        file = future_to_file[future]
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Error uploading file {file}: {e}")
+            error = error or e
+            continue
+        output_bucket_and_file_keys_and_table_names.append(result)
+        checkpoint.mark_uploaded(*result)
+    if error:
+        raise error
+
+def transform_and_upload_patient_data(
+    input_bucket: str,
+    output_bucket: str,
+    bundle_key: str,
+    patient_id: str,
+    output_file_prefix: str,
+    local_patient_path: str,
+    checkpoint: Checkpoint,
+) -> list[tuple[str, str, str]]:
     local_bundle_key = f"{local_patient_path}/bundle_{bundle_key.replace('/', '_')}.json"
     with open(local_bundle_key, "wb") as f:
         try:
             print(f"Downloading bundle {bundle_key} from {input_bucket} to {local_bundle_key}")
-            s3_client.download_file(input_bucket, bundle_key, local_bundle_key)
+            with metrics.stage_duration_seconds.labels(stage="download").time(), \
+                    metrics.s3_transfer_seconds.labels(operation="download").time():
+                # The version the checkpoint refers to, tables of different versions can't be mixed.
+                # download_file doesn't accept IfMatch, so the body is streamed from get_object
+                response = s3_client.get_object(Bucket=input_bucket, Key=bundle_key, IfMatch=f'"{checkpoint.bundle_etag}"')
+                for chunk in response["Body"].iter_chunks(download_chunk_size):
+                    f.write(chunk)
             print(f"Downloaded bundle {bundle_key} from {input_bucket} to {local_bundle_key}")
         except s3_client.exceptions.ClientError as e:
             if e.response['Error']['Code'] == '404':
@@ -46,40 +127,57 @@ def transform_and_upload_data(
                 raise ValueError("Bundle not found") from e
             else:
                 raise e
-    with open(local_bundle_key, "rb") as f:
-        bundle = json.load(f)
+    metrics.bundle_bytes.observe(os.path.getsize(local_bundle_key))
+    with open(local_bundle_key, "rb") as f, metrics.stage_duration_seconds.labels(stage="to_ndjson").time():
+        bundle = jsonlib.load(f)
         entries = bundle["entry"]
         if entries is None or len(entries) < 1:
             print(f"Bundle {bundle_key} has no entries")
             return []
+        for entry in entries:
+            resource_type = (entry.get("resource") or {}).get("resourceType") or "unknown"
+            metrics.resources_total.labels(resource_type=resource_type).inc()
         local_ndjson_bundle_key = local_bundle_key.replace(".json", ".ndjson")
-        with open(local_ndjson_bundle_key, "w") as f:
-            ndjson.dump(entries, f)
+        with open(local_ndjson_bundle_key, "wb") as f:
+            for entry in entries:
+                f.write(jsonlib.dumps_bytes(entry) + b"\n")
         print(f"Parsing bundle {local_ndjson_bundle_key} to {local_patient_path}")
-    local_output_files = parseNdjsonBundle.parse(local_ndjson_bundle_key, local_patient_path)
-
-    output_bucket_and_file_keys_and_table_names = []
     pt_output_file_prefix = create_patient_output_prefix(output_file_prefix, patient_id)
-    
-    with ThreadPoolExecutor(max_workers=3) as executor:
-        future_to_file = {}
-        for file in local_output_files:
-            file_name = file.replace("/", "_")
-            output_file_key = f"{pt_output_file_prefix}/{file_name}"
-            future = executor.submit(upload_file_to_s3, file, output_bucket, output_file_key)
-            future_to_file[future] = file
-        
-        for future in as_completed(future_to_file):
-            file = future_to_file[future]
+    output_bucket_and_file_keys_and_table_names = list(checkpoint.uploaded_tables.values())
+    # Saved however the transform ends, so a retry skips the tables uploaded so far. Not on every
+    # table, see default_save_interval_seconds
+    try:
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            future_to_file = {}
+
+            def upload_table(file: str) -> None:
+                # Each table is uploaded as soon as it's parsed, before the local folder is cleaned up
+                file_name = file.replace("/", "_")
+                output_file_key = f"{pt_output_file_prefix}/{file_name}"
+                future = executor.submit(upload_file_to_s3, file, output_bucket, output_file_key)
+                future_to_file[future] = file
+
             try:
-                result = future.result()
-                output_bucket_and_file_keys_and_table_names.append(result)
-            except Exception as e:
-                print(f"Error uploading file {file}: {e}")
-                raise e
+                with metrics.stage_duration_seconds.labels(stage="parse").time():
+                    parseNdjsonBundle.parse(
+                        local_ndjson_bundle_key,
+                        local_patient_path,
+                        skip_tables=set(checkpoint.uploaded_tables.keys()),
+                        on_table_parsed=upload_table,
+                    )
+            except Exception:
+                # E.g. the error budget was exceeded, the dead letters show why
+                upload_dead_letters(local_patient_path, output_bucket, pt_output_file_prefix)
+                raise
+            finally:
+                # The tables parsed before a failure are still uploaded and checkpointed
+                with metrics.stage_duration_seconds.labels(stage="upload").time():
+                    wait_for_uploads(future_to_file, checkpoint, output_bucket_and_file_keys_and_table_names)
+    finally:
+        checkpoint.save()
 
-    print(f"Cleaning up local files in {local_cx_path}")
-    shutil.rmtree(local_cx_path)
+    upload_dead_letters(local_patient_path, output_bucket, pt_output_file_prefix)
+    checkpoint.mark_all_uploaded()
 
     print(f"Done transform_and_upload_data for patient_id {patient_id}")
     return output_bucket_and_file_keys_and_table_names
@@ -91,6 +189,8 @@ def handler(event: dict, context: dict):
     output_bucket = event.get("OUTPUT_S3_BUCKET") or os.getenv("OUTPUT_S3_BUCKET")
     # Will append '/<table_name>.csv' to output_file_prefix
     output_file_prefix = event.get("OUTPUT_PREFIX") or os.getenv("OUTPUT_PREFIX")
+    # Optional, loads the output files into the DWH right after they're uploaded
+    dwh = event.get("DWH") or os.getenv("DWH")
     if not cx_id:
         raise ValueError("CX_ID is not set") 
     if not patient_id:
@@ -101,21 +201,53 @@ def handler(event: dict, context: dict):
         raise ValueError("OUTPUT_S3_BUCKET is not set")
     if not output_file_prefix:
         raise ValueError("OUTPUT_PREFIX is not set")
+    if dwh and dwh not in [d.value for d in DWH]:
+        raise ValueError(f"DWH must be one of {[d.value for d in DWH]}")
 
     print(f">>> Parsing data and uploading it to S3 for Snowflake - {cx_id}, patient_id {patient_id}")
+    checkpoint = load_checkpoint(input_bucket, output_bucket, cx_id, patient_id, output_file_prefix)
     output_bucket_and_file_keys_and_table_names = transform_and_upload_data(
         input_bucket,
         output_bucket,
         cx_id,
         patient_id,
         output_file_prefix,
+        checkpoint,
     )
 
     if len(output_bucket_and_file_keys_and_table_names) < 1:
+        checkpoint.delete()
         print("No files were uploaded")
         return {"message": "No files were uploaded"}
 
+    if dwh:
+        print(f">>> Loading {len(output_bucket_and_file_keys_and_table_names)} files into {dwh}")
+        with metrics.stage_duration_seconds.labels(stage="load").time():
+            loadToDwh.load_files(DWH(dwh), output_bucket_and_file_keys_and_table_names, s3_client)
+
+    # Kept until the load is done, so a retry after a failed load doesn't transform the bundle again
+    checkpoint.delete()
+
     print(f">>> Done processing {cx_id}, patient_id {patient_id}")
+    return {
+        "message": "Transform completed successfully",
+        "files": len(output_bucket_and_file_keys_and_table_names),
+    }
+
+def load_handler(event: dict, context: dict):
+    """Loads all output files under a prefix (e.g. a bulk job across many patients) into the DWH."""
+    dwh = event.get("DWH") or os.getenv("DWH")
+    output_bucket = event.get("OUTPUT_S3_BUCKET") or os.getenv("OUTPUT_S3_BUCKET")
+    output_file_prefix = event.get("OUTPUT_PREFIX") or os.getenv("OUTPUT_PREFIX")
+    if not dwh or dwh not in [d.value for d in DWH]:
+        raise ValueError(f"DWH must be one of {[d.value for d in DWH]}")
+    if not output_bucket:
+        raise ValueError("OUTPUT_S3_BUCKET is not set")
+    if not output_file_prefix:
+        raise ValueError("OUTPUT_PREFIX is not set")
+
+    loaded_count = loadToDwh.load_prefix(DWH(dwh), output_bucket, output_file_prefix, s3_client)
+    return {"message": f"Loaded {loaded_count} files into {dwh}"}
 
 def main():
     """Main entry point for CLI usage."""
@@ -133,6 +265,8 @@ if __name__ == "__main__":
         debug = os.environ.get('DEBUG', 'false').lower() == 'true'
         print(f"Starting FHIR to CSV HTTP server on {host}:{port}")
         app.run(host=host, port=port, debug=debug)
+    elif len(sys.argv) > 1 and sys.argv[1] == "load":
+        load_handler({}, {})
     else:
         # Run in CLI mode (default behavior)
         main()
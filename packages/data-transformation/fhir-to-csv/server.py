@@ -2,14 +2,22 @@
 """
 HTTP server for FHIR to CSV transformation.
 This allows the transformation to be called via HTTP requests for local development.
+
+Transforms run as jobs on a worker pool: `POST /transform` enqueues a job and returns its ID right
+away, `GET /jobs/<id>` returns its status and metrics.
 """
 
 import os
-import json
+import time
+import uuid
 import logging
+import threading
 import traceback
-from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from main import handler
+from src.utils import metrics
 
 # Configure logging
 logging.basicConfig(
@@ -18,58 +26,143 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+MAX_CONCURRENT_JOBS = int(os.environ.get('MAX_CONCURRENT_JOBS', 2))
+# Finished jobs are kept in memory so their status can be queried, up to this many
+MAX_FINISHED_JOBS = int(os.environ.get('MAX_FINISHED_JOBS', 1000))
+
+JOB_STATUS_QUEUED = "queued"
+JOB_STATUS_RUNNING = "running"
+JOB_STATUS_COMPLETED = "completed"
+JOB_STATUS_FAILED = "failed"
+ACTIVE_JOB_STATUSES = [JOB_STATUS_QUEUED, JOB_STATUS_RUNNING]
+
 app = Flask(__name__)
 
+executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix="transform")
+jobs: dict[str, dict] = {}
+jobs_lock = threading.Lock()
+
+
+def get_active_job_id(cx_id: str, patient_id: str) -> str | None:
+    for job_id, job in jobs.items():
+        if job["cxId"] == cx_id and job["patientId"] == patient_id and job["status"] in ACTIVE_JOB_STATUSES:
+            return job_id
+    return None
+
+
+def evict_finished_jobs() -> None:
+    finished_job_ids = [job_id for job_id, job in jobs.items() if job["status"] not in ACTIVE_JOB_STATUSES]
+    for job_id in finished_job_ids[:max(0, len(finished_job_ids) - MAX_FINISHED_JOBS)]:
+        del jobs[job_id]
+
+
+def run_job(job_id: str, data: dict) -> None:
+    started_at = time.time()
+    with jobs_lock:
+        job = jobs[job_id]
+        job.update(status=JOB_STATUS_RUNNING, startedAt=started_at)
+        job["metrics"]["queueSeconds"] = round(started_at - job["queuedAt"], 3)
+    logger.info(f"Starting job {job_id} with request data: {data}")
+    metrics.jobs_in_flight.inc()
+    try:
+        # The handler validates all required parameters and throws ValueError if any are missing
+        result = handler(data, {}) or {}
+        finished_at = time.time()
+        with jobs_lock:
+            job = jobs[job_id]
+            job.update(status=JOB_STATUS_COMPLETED, finishedAt=finished_at, result=result)
+            job["metrics"]["durationSeconds"] = round(finished_at - started_at, 3)
+        logger.info(f"Job {job_id} completed successfully.")
+    except Exception as e:
+        finished_at = time.time()
+        metrics.errors_total.labels(exception=type(e).__name__).inc()
+        logger.error(f"Job {job_id} failed: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        with jobs_lock:
+            job = jobs[job_id]
+            job.update(status=JOB_STATUS_FAILED, finishedAt=finished_at, error=f"{type(e).__name__}: {str(e)}")
+            job["metrics"]["durationSeconds"] = round(finished_at - started_at, 3)
+    finally:
+        metrics.jobs_in_flight.dec()
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
     return jsonify({"status": "healthy", "service": "fhir-to-csv-transform"})
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Metrics of the transforms, in the Prometheus text format."""
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
 @app.route('/transform', methods=['POST'])
 def transform_fhir_to_csv():
     """
-    Transform FHIR data to CSV format.
-    
+    Enqueue a job to transform FHIR data to CSV format.
+
     Expected JSON payload:
     {
         "CX_ID": "customer_id",
-        "PATIENT_ID": "patient_id", 
+        "PATIENT_ID": "patient_id",
         "INPUT_S3_BUCKET": "input_bucket",
-        "OUTPUT_S3_BUCKET": "output_bucket", 
+        "OUTPUT_S3_BUCKET": "output_bucket",
         "OUTPUT_PREFIX": "output_prefix"
     }
+
+    Returns 202 with the job ID, to be used with `GET /jobs/<id>`.
     """
-    try:
-        # Parse request data
-        data = request.get_json()
-        if not data:
-            # Check if there's any body content at all
-            raw_data = request.get_data(as_text=True)
-            if not raw_data.strip():
-                return jsonify({"error": "No request body provided"}), 400
-            else:
-                return jsonify({"error": "Invalid JSON data provided"}), 400
-        
-        logger.info(f"Starting FHIR to CSV transform with request data: {data}")
-        
-        # Perform the transformation using the main handler
-        # The handler will validate all required parameters and throw ValueError if any are missing
-        handler(data, {})
-        
-        logger.info("Transform completed successfully.")
-        
-        return jsonify({
-            "status": "success",
-            "message": "Transform completed successfully"
-        })
-        
-    except ValueError as e:
-        logger.error(f"Validation error: {str(e)}")
-        return jsonify({"error": str(e)}), 400
-    except Exception as e:
-        logger.error(f"Transform failed: {str(e)}")
-        logger.error(f"Traceback: {traceback.format_exc()}")
-        return jsonify({"error": f"Transform failed: {str(e)}"}), 500
+    # Parse request data
+    data = request.get_json(silent=True)
+    if not data:
+        # Check if there's any body content at all
+        raw_data = request.get_data(as_text=True)
+        if not raw_data.strip():
+            return jsonify({"error": "No request body provided"}), 400
+        else:
+            return jsonify({"error": "Invalid JSON data provided"}), 400
+
+    cx_id = data.get("CX_ID")
+    patient_id = data.get("PATIENT_ID")
+    if not cx_id or not patient_id:
+        return jsonify({"error": "CX_ID and PATIENT_ID are required"}), 400
+
+    with jobs_lock:
+        # Jobs of the same patient share the local working folder, so only one can run at a time
+        active_job_id = get_active_job_id(cx_id, patient_id)
+        if active_job_id:
+            return jsonify({
+                "error": "There's already a transform in progress for this patient",
+                "jobId": active_job_id,
+            }), 409
+        evict_finished_jobs()
+        job_id = str(uuid.uuid4())
+        jobs[job_id] = {
+            "jobId": job_id,
+            "cxId": cx_id,
+            "patientId": patient_id,
+            "status": JOB_STATUS_QUEUED,
+            "queuedAt": time.time(),
+            "startedAt": None,
+            "finishedAt": None,
+            "result": None,
+            "error": None,
+            "metrics": {},
+        }
+
+    executor.submit(run_job, job_id, data)
+    logger.info(f"Enqueued job {job_id} for cx {cx_id}, patient {patient_id}")
+
+    return jsonify({"status": JOB_STATUS_QUEUED, "jobId": job_id}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id: str):
+    """Status and metrics of a transform job."""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify({**job, "metrics": dict(job["metrics"])})
 
 @app.errorhandler(404)
 def not_found(error):
@@ -83,6 +176,6 @@ if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8000))
     host = os.environ.get('HOST', '0.0.0.0')
     debug = os.environ.get('DEBUG', 'false').lower() == 'true'
-    
-    logger.info(f"Starting FHIR to CSV HTTP server on {host}:{port}")
-    app.run(host=host, port=port, debug=debug)
+
+    logger.info(f"Starting FHIR to CSV HTTP server on {host}:{port}, max concurrent jobs {MAX_CONCURRENT_JOBS}")
+    app.run(host=host, port=port, debug=debug, threaded=True)
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Bulk transform of many patients' NDJSON bundles (e.g. backfills), one output file per table.
+
+Resources are read in batches per resource type across bundles and evaluated column by column
+instead of resource by resource: plain paths (dotted elements and indexes, no operators) are
+compiled into a tree of accessors shared by every column with the same prefix, and each accessor
+is applied to the whole batch at once. Columns with operators (ArrCond:, IfEq:, ...) and anchored
+configurations fall back to parseFhir's per-resource evaluator. The output is the same as
+parseNdjsonBundle's, in a single file per table.
+
+Usage:
+    python -m src.bulkTransform.bulkTransform <bundle.ndjson or folder> ... --output <folder> [--format csv|parquet]
+"""
+
+import os
+import csv
+import sys
+import logging
+import argparse
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from src.parseFhir import columnTypes
+from src.parseFhir.parseFhir import (
+    combineValues, get_constant_columns, get_processed_date, is_integer, parse_one_resource, read_config,
+)
+from src.parseFhir.resourceErrors import ResourceErrors, get_max_errors
+from src.parseNdjsonBundle.ndjsonIndex import NdjsonIndex
+from src.parseNdjsonBundle.parseNdjsonBundle import (
+    config_folder, get_resource_type_from_config, get_table_name_from_config, write_resource_errors,
+)
+from src.utils import jsonlib
+
+default_batch_size = 10_000
+output_formats = ['csv', 'parquet']
+
+
+class Missing:
+    """Marks a path that doesn't resolve: MISSING (None) or EMPTY (an index out of range, '')."""
+
+MISSING = Missing()
+EMPTY = Missing()
+# The per-resource evaluator would raise for this resource (e.g. an element looked up in a number)
+ERROR = Missing()
+
+
+def step_index(values, index):
+    return [
+        value[index] if isinstance(value, list) and index < len(value)
+        else value if isinstance(value, Missing)
+        else EMPTY
+        for value in values
+    ]
+
+
+def step_element(values, element):
+    return [
+        value.get(element, MISSING) if isinstance(value, dict)
+        else value if isinstance(value, Missing)
+        else MISSING if isinstance(value, str) or (isinstance(value, list) and element not in value)
+        else ERROR
+        for value in values
+    ]
+
+
+def to_column_value(value):
+    # Same as combineValues for a single path: None and '' are dropped, everything else is str()'d
+    if isinstance(value, Missing) or value is None or value == '':
+        return None
+    return str(value).strip() or None
+
+
+def is_plain_path(path: str) -> bool:
+    return len(path.splitlines()) == 1 and ':' not in path and path != ''
+
+
+class PathTree:
+    """Plain paths compiled into a tree of elements, so shared prefixes are only resolved once."""
+
+    def __init__(self):
+        self.children: dict[str, "PathTree"] = {}
+        self.columns: list[int] = []
+
+    def add(self, elements: list[str], column: int) -> None:
+        node = self
+        for element in elements:
+            node = node.children.setdefault(element, PathTree())
+        node.columns.append(column)
+
+    def evaluate(self, values: list, columns: list[list]) -> None:
+        for element, child in self.children.items():
+            child_values = step_index(values, int(element)) if is_integer(element) else step_element(values, element)
+            for column in child.columns:
+                columns[column] = [value if value is ERROR else to_column_value(value) for value in child_values]
+            child.evaluate(child_values, columns)
+
+
+class CompiledConfig:
+    def __init__(self, config_file: str, processed_date: str, configs_folder: str = config_folder):
+        self.config_path = os.path.join(configs_folder, config_file)
+        config = read_config(self.config_path)
+        self.table_name = get_table_name_from_config(config_file)
+        self.resource_type = get_resource_type_from_config(config_file)
+        self.anchor = config['GenConfig'].get('anchor', False)
+        self.header = list(config['Struct'].keys())
+        self.paths = [config['Struct'][column] for column in self.header]
+        self.column_types = columnTypes.get_column_types(config, self.header, self.paths)
+        self.processed_date = processed_date
+        self.tree = PathTree()
+        # Columns evaluated per resource, and those that are the same for the whole batch
+        self.row_columns = []
+        self.filename_columns = []
+        self.date_columns = []
+        for i, path in enumerate(self.paths):
+            if path == 'GetDate:':
+                self.date_columns.append(i)
+            elif path == 'Filename:':
+                self.filename_columns.append(i)
+            elif is_plain_path(path):
+                self.tree.add(path.split('.'), i)
+            else:
+                self.row_columns.append(i)
+
+    def get_row_template(self, filename: str) -> list:
+        constants = get_constant_columns(self.paths, filename, self.processed_date)
+        return [constants.get(i) for i in range(len(self.header))]
+
+    def evaluate_row(self, resource: dict, filename: str, resource_errors: ResourceErrors) -> list | None:
+        try:
+            memo = {}
+            row = self.get_row_template(filename)
+            for i, path in enumerate(self.paths):
+                if i not in self.date_columns and i not in self.filename_columns:
+                    row[i] = combineValues(resource, path, filename, memo)
+            return row
+        except Exception as e:
+            resource_errors.record(self.config_path, jsonlib.dumps_bytes(resource), e)
+            return None
+
+    def evaluate_anchored(self, resources: list[dict], filenames: list[str], resource_errors: ResourceErrors) -> list[list]:
+        rows = []
+        leng = len(self.header)
+        columns = [i for i in range(leng) if i not in self.date_columns and i not in self.filename_columns]
+        row_templates = {}
+        for resource, filename in zip(resources, filenames):
+            if filename not in row_templates:
+                row_templates[filename] = self.get_row_template(filename)
+            try:
+                parse_one_resource(
+                    self.anchor, self.paths, resource, leng, None, rows, filename, 'return', row_templates[filename], columns,
+                )
+            except Exception as e:
+                resource_errors.record(self.config_path, jsonlib.dumps_bytes(resource), e)
+        return [list(column) for column in zip(*rows)] if rows else [[] for _ in self.header]
+
+    def evaluate(self, resources: list[dict], filenames: list[str], resource_errors: ResourceErrors) -> list[list]:
+        """The values of each column for a batch of resources (one row per resource, or per anchor item)."""
+        if self.anchor:
+            return self.evaluate_anchored(resources, filenames, resource_errors)
+        columns: list[list] = [None] * len(self.header)
+        self.tree.evaluate(resources, columns)
+        for i in self.date_columns:
+            columns[i] = [self.processed_date] * len(resources)
+        for i in self.filename_columns:
+            columns[i] = [str(filename).strip() or None for filename in filenames]
+        for i in self.row_columns:
+            path = self.paths[i]
+            columns[i] = []
+            for resource, filename in zip(resources, filenames):
+                try:
+                    columns[i].append(combineValues(resource, path, filename, {}))
+                except Exception:
+                    columns[i].append(ERROR)
+        # Resources the per-resource evaluator would fail on are re-evaluated by it, so they end up
+        # in the dead letters the same way
+        failed_rows = {row for column in columns for row, value in enumerate(column) if value is ERROR}
+        if not failed_rows:
+            return columns
+        rows = []
+        for row in range(len(resources)):
+            if row in failed_rows:
+                values = self.evaluate_row(resources[row], filenames[row], resource_errors)
+                if values is not None:
+                    rows.append(values)
+            else:
+                rows.append([column[row] for column in columns])
+        return [list(column) for column in zip(*rows)] if rows else [[] for _ in self.header]
+
+
+class TableWriter:
+    def __init__(self, compiled: CompiledConfig, outputs_folder: str, output_format: str):
+        self.compiled = compiled
+        self.output_format = output_format
+        self.path = os.path.join(outputs_folder, f'{compiled.table_name}.{output_format}')
+        self.row_count = 0
+        self.file = None
+        self.csvwriter = None
+        self.parquet_writer = None
+        if output_format == 'csv':
+            # Same format as parseFhir's 'csv' output
+            self.file = open(self.path, 'w', newline='')
+            self.csvwriter = csv.writer(self.file, delimiter=',', escapechar='\\', quoting=csv.QUOTE_ALL)
+
+    def write(self, columns: list[list]) -> None:
+        count = len(columns[0]) if columns else 0
+        if count < 1:
+            return
+        self.row_count += count
+        if self.csvwriter:
+            self.csvwriter.writerows(zip(*columns))
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        arrays = [
+            pa.array(columnTypes.convert_values(values, column_type), type=columnTypes.to_arrow_type(column_type))
+            for values, column_type in zip(columns, self.compiled.column_types)
+        ]
+        table = pa.Table.from_arrays(arrays, names=self.compiled.header)
+        if self.parquet_writer is None:
+            self.parquet_writer = pq.ParquetWriter(self.path, table.schema)
+        self.parquet_writer.write_table(table)
+
+    def close(self) -> None:
+        if self.file:
+            self.file.close()
+        if self.parquet_writer:
+            self.parquet_writer.close()
+        elif self.output_format == 'parquet':
+            # No rows, still an empty table with the right schema
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = pa.schema([
+                (column, columnTypes.to_arrow_type(column_type))
+                for column, column_type in zip(self.compiled.header, self.compiled.column_types)
+            ])
+            pq.write_table(schema.empty_table(), self.path)
+
+
+def iter_input_files(input_paths):
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            for root, _, files in os.walk(input_path):
+                for file in sorted(files):
+                    if file.endswith('.ndjson'):
+                        yield os.path.join(root, file)
+        else:
+            yield input_path
+
+
+def iter_batches(input_paths, resource_types: set[str], batch_size: int, resource_errors: ResourceErrors):
+    """(resource type, resources, their file names), up to batch_size resources of a type per batch, across files."""
+    pending = {resource_type: ([], []) for resource_type in resource_types}
+    for input_file in iter_input_files(input_paths):
+        with NdjsonIndex(input_file) as index:
+            for line in index.lines(spans=index.invalid_spans):
+                resource_errors.record(input_file, line, ValueError('Line is not a Bundle entry with a resource'))
+            for resource_type in resource_types:
+                resources, filenames = pending[resource_type]
+                for line in index.lines(resource_type):
+                    # The index reads the resourceType from the start of the line, the rest might still be invalid
+                    try:
+                        resources.append(jsonlib.loads(line)['resource'])
+                    except Exception as e:
+                        resource_errors.record(input_file, line, e)
+                        continue
+                    filenames.append(input_file)
+                    if len(resources) >= batch_size:
+                        yield resource_type, resources, filenames
+                        resources, filenames = [], []
+                        pending[resource_type] = (resources, filenames)
+    for resource_type, (resources, filenames) in pending.items():
+        if resources:
+            yield resource_type, resources, filenames
+
+
+def transform(input_paths, outputs_folder: str, output_format: str = 'csv', batch_size: int = default_batch_size, processed_date: str = None) -> list[str]:
+    """Transforms NDJSON bundles (files or folders) into one output file per table, returns the files."""
+    if output_format not in output_formats:
+        raise ValueError(f"Output format must be one of {output_formats}")
+    processed_date = processed_date or get_processed_date()
+    os.makedirs(outputs_folder, exist_ok=True)
+    compiled_configs = [
+        CompiledConfig(config_file, processed_date)
+        for config_file in sorted(os.listdir(config_folder)) if config_file.endswith('.ini')
+    ]
+    configs_by_type = {}
+    for compiled in compiled_configs:
+        configs_by_type.setdefault(compiled.resource_type, []).append(compiled)
+    writers = {compiled.table_name: TableWriter(compiled, outputs_folder, output_format) for compiled in compiled_configs}
+    resource_errors = ResourceErrors(max_errors=get_max_errors())
+    try:
+        for resource_type, resources, filenames in iter_batches(input_paths, set(configs_by_type), batch_size, resource_errors):
+            for compiled in configs_by_type[resource_type]:
+                writers[compiled.table_name].write(compiled.evaluate(resources, filenames, resource_errors))
+    finally:
+        for writer in writers.values():
+            writer.close()
+        # Also when the error budget is exceeded, the dead letters are what shows why
+        write_resource_errors(resource_errors, outputs_folder)
+    for writer in writers.values():
+        logging.info('%s: %s rows', writer.path, writer.row_count)
+    return [writer.path for writer in writers.values()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transform many NDJSON bundles into one output file per table.")
+    parser.add_argument("inputs", nargs="+", help="NDJSON bundles or folders of them")
+    parser.add_argument("--output", required=True, help="folder to write the output files to")
+    parser.add_argument("--format", default="csv", choices=output_formats)
+    parser.add_argument("--batch-size", type=int, default=default_batch_size, help="resources of a type evaluated at once")
+    args = parser.parse_args()
+    files = transform(args.inputs, args.output, args.format, args.batch_size)
+    print(f"{len(files)} files written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import os
+import io
+import csv
+import configparser
+from collections import defaultdict
+from src.parseNdjsonBundle.parseNdjsonBundle import config_folder
+from src.utils.dwh import DWH
+
+# Loads the CSVs produced by fhir-to-csv straight into the data warehouse, batching files of the
+# same table (across patients) into a single COPY. Every loaded file is recorded in a load state
+# table in the same transaction as its COPY, so files are loaded exactly once even when the load
+# is retried.
+
+load_state_table = 'fhir_to_csv_load_state'
+# Snowflake accepts at most 1000 files in the FILES clause of a single COPY INTO
+copy_batch_size = 1000
+
+create_load_state_table_sql = f"""
+CREATE TABLE IF NOT EXISTS {load_state_table} (
+    bucket VARCHAR(256) NOT NULL,
+    file_key VARCHAR(1024) NOT NULL,
+    etag VARCHAR(256) NOT NULL,
+    table_name VARCHAR(256) NOT NULL,
+    loaded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (bucket, file_key, etag)
+)
+"""
+insert_load_state_sql = f"INSERT INTO {load_state_table} (bucket, file_key, etag, table_name) VALUES (%s, %s, %s, %s)"
+
+csv_copy_options = {
+    DWH.SNOWFLAKE: "FILE_FORMAT = (TYPE = CSV FIELD_OPTIONALLY_ENCLOSED_BY = '\"' ESCAPE = '\\\\') ON_ERROR = ABORT_STATEMENT",
+    # Empty values are loaded as NULL: fhir-to-csv quotes every value, None included
+    DWH.POSTGRES: "WITH (FORMAT csv, FORCE_NULL ({columns}))",
+}
+
+
+def get_required_env_var(name: str) -> str:
+    value = os.getenv(name)
+    if not value:
+        raise ValueError(f"Missing required environment variables: {name}")
+    return value
+
+
+def get_table_columns(table_name: str) -> list[str]:
+    """Column names of a table, in the order fhir-to-csv writes them."""
+    config_path = os.path.join(config_folder, f"config_{table_name}.ini")
+    if not os.path.exists(config_path):
+        matches = [f for f in os.listdir(config_folder) if f.lower() == f"config_{table_name}.ini"]
+        if not matches:
+            raise ValueError(f"No configuration found for table {table_name}")
+        config_path = os.path.join(config_folder, matches[0])
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    return list(config['Struct'].keys())
+
+
+def connect(dwh: DWH):
+    if dwh == DWH.SNOWFLAKE:
+        try:
+            import snowflake.connector
+        except ImportError:
+            raise ImportError("Please install snowflake-connector-python to load into Snowflake.")
+        return snowflake.connector.connect(
+            account=get_required_env_var("SNOWFLAKE_ACCOUNT"),
+            user=get_required_env_var("SNOWFLAKE_USER"),
+            password=get_required_env_var("SNOWFLAKE_PASSWORD"),
+            role=get_required_env_var("SNOWFLAKE_ROLE"),
+            warehouse=get_required_env_var("SNOWFLAKE_WAREHOUSE"),
+            database=get_required_env_var("SNOWFLAKE_DATABASE"),
+            schema=get_required_env_var("SNOWFLAKE_SCHEMA"),
+            autocommit=False,
+        )
+    if dwh == DWH.POSTGRES:
+        try:
+            import psycopg2
+        except ImportError:
+            raise ImportError("Please install psycopg2-binary to load into Postgres.")
+        connection = psycopg2.connect(
+            host=get_required_env_var("PG_HOST"),
+            port=int(os.getenv("PG_PORT") or 5432),
+            user=get_required_env_var("PG_USER"),
+            password=get_required_env_var("PG_PASSWORD"),
+            dbname=get_required_env_var("PG_DATABASE"),
+        )
+        schema = os.getenv("PG_SCHEMA")
+        if schema:
+            with connection.cursor() as cursor:
+                cursor.execute("SET search_path TO %s", (schema,))
+            connection.commit()
+        return connection
+    raise ValueError(f"Unsupported DWH {dwh}")
+
+
+def get_loaded_files(connection, bucket: str, file_keys: list[str]) -> set[tuple[str, str]]:
+    """(file key, etag) of the files of a bucket already loaded."""
+    loaded = set()
+    cursor = connection.cursor()
+    try:
+        for i in range(0, len(file_keys), copy_batch_size):
+            batch = file_keys[i:i + copy_batch_size]
+            placeholders = ", ".join(["%s"] * len(batch))
+            cursor.execute(
+                f"SELECT file_key, etag FROM {load_state_table} WHERE bucket = %s AND file_key IN ({placeholders})",
+                [bucket, *batch],
+            )
+            loaded.update((row[0], row[1]) for row in cursor.fetchall())
+    finally:
+        cursor.close()
+    return loaded
+
+
+def quote_snowflake_string(value: str) -> str:
+    """A Snowflake string literal, for where bind variables aren't accepted (e.g. the FILES of a COPY)."""
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def copy_into_snowflake(connection, table_name: str, file_keys: list[str]) -> None:
+    stage = get_required_env_var("SNOWFLAKE_STAGE")
+    files = ", ".join(quote_snowflake_string(key) for key in file_keys)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            f"COPY INTO {table_name} FROM @{stage} FILES = ({files}) {csv_copy_options[DWH.SNOWFLAKE]}"
+        )
+    finally:
+        cursor.close()
+
+
+class PostgresCsvFile:
+    """
+    A fhir-to-csv CSV re-encoded for Postgres' COPY, as a file to read from. The files double
+    quotes and escape backslashes with a backslash (csv.writer with escapechar='\\'), which
+    Postgres' CSV format can't both undo, so the values are unescaped and written again with
+    doubled quotes only.
+    """
+
+    def __init__(self, body):
+        self.rows = csv.reader(io.TextIOWrapper(body, encoding='utf-8', newline=''), delimiter=',', escapechar='\\')
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, delimiter=',', quoting=csv.QUOTE_ALL, lineterminator='\n')
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or self.buffer.tell() < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow(row)
+        data = self.buffer.getvalue()
+        data, rest = (data, '') if size < 0 else (data[:size], data[size:])
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.buffer.write(rest)
+        return data
+
+
+def get_postgres_copy_sql(table_name: str) -> str:
+    columns = ", ".join(get_table_columns(table_name))
+    return f"COPY {table_name} ({columns}) FROM STDIN {csv_copy_options[DWH.POSTGRES].format(columns=columns)}"
+
+
+def copy_into_postgres(connection, table_name: str, bucket: str, file_keys: list[str], s3_client) -> None:
+    copy_sql = get_postgres_copy_sql(table_name)
+    with connection.cursor() as cursor:
+        for key in file_keys:
+            body = s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+            try:
+                cursor.copy_expert(copy_sql, PostgresCsvFile(body))
+            finally:
+                body.close()
+
+
+def load_table(dwh: DWH, connection, table_name: str, bucket: str, files: list[tuple[str, str]], s3_client) -> None:
+    """Loads a batch of files into one table and records them as loaded, in a single transaction."""
+    file_keys = [key for key, _ in files]
+    try:
+        if dwh == DWH.SNOWFLAKE:
+            copy_into_snowflake(connection, table_name, file_keys)
+        else:
+            copy_into_postgres(connection, table_name, bucket, file_keys, s3_client)
+        cursor = connection.cursor()
+        try:
+            cursor.executemany(insert_load_state_sql, [(bucket, key, etag, table_name) for key, etag in files])
+        finally:
+            cursor.close()
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+
+
+def load_files(dwh: DWH, bucket_and_file_keys_and_table_names: list[tuple[str, str, str]], s3_client=None) -> int:
+    """
+    Loads fhir-to-csv output files into the data warehouse, one COPY per table and batch of files.
+    Files already recorded in the load state table are skipped.
+
+    Returns the number of files loaded.
+    """
+    if len(bucket_and_file_keys_and_table_names) < 1:
+        return 0
+    if s3_client is None:
+        import boto3
+        s3_client = boto3.client("s3")
+
+    files_by_bucket_and_table = defaultdict(list)
+    for bucket, file_key, table_name in bucket_and_file_keys_and_table_names:
+        etag = s3_client.head_object(Bucket=bucket, Key=file_key)["ETag"].strip('"')
+        files_by_bucket_and_table[(bucket, table_name)].append((file_key, etag))
+
+    connection = connect(dwh)
+    loaded_count = 0
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(create_load_state_table_sql)
+        finally:
+            cursor.close()
+        connection.commit()
+
+        keys_by_bucket = defaultdict(list)
+        for bucket, file_key, _ in bucket_and_file_keys_and_table_names:
+            keys_by_bucket[bucket].append(file_key)
+        already_loaded = {bucket: get_loaded_files(connection, bucket, keys) for bucket, keys in keys_by_bucket.items()}
+
+        for (bucket, table_name), files in files_by_bucket_and_table.items():
+            pending = [file for file in files if file not in already_loaded[bucket]]
+            if len(pending) < 1:
+                print(f"All {len(files)} files for table {table_name} were already loaded")
+                continue
+            for i in range(0, len(pending), copy_batch_size):
+                batch = pending[i:i + copy_batch_size]
+                print(f"Loading {len(batch)} files into {dwh} table {table_name}")
+                load_table(dwh, connection, table_name, bucket, batch, s3_client)
+                loaded_count += len(batch)
+    finally:
+        connection.close()
+
+    print(f"Loaded {loaded_count} files into {dwh}")
+    return loaded_count
+
+
+def parse_table_name_from_file_key(file_key: str, patient_id: str) -> str:
+    # e.g.: <prefix>/pt=patient-id/_tmp_fhir-to-csv_output_cx-id_patient-id_condition.csv
+    file_name = file_key.split("/")[-1]
+    return file_name.split(f"_{patient_id}_")[-1].replace(".csv", "")
+
+
+def load_prefix(dwh: DWH, bucket: str, prefix: str, s3_client=None) -> int:
+    """Loads every fhir-to-csv output file under an S3 prefix, e.g. all patients of a bulk job."""
+    if s3_client is None:
+        import boto3
+        s3_client = boto3.client("s3")
+
+    bucket_and_file_keys_and_table_names = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            file_key = item["Key"]
+            if not file_key.endswith(".csv"):
+                continue
+            patient_folder = next((part for part in file_key.split("/") if part.startswith("pt=")), None)
+            if patient_folder is None:
+                continue
+            table_name = parse_table_name_from_file_key(file_key, patient_folder[len("pt="):])
+            bucket_and_file_keys_and_table_names.append((bucket, file_key, table_name))
+
+    print(f"Found {len(bucket_and_file_keys_and_table_names)} files under {bucket}/{prefix}")
+    return load_files(dwh, bucket_and_file_keys_and_table_names, s3_client)
@@ -0,0 +1,165 @@
+from datetime import date, datetime, timezone
+
+# METRIPORT CHANGE FOR TYPED COLUMNS - column types for the 'return' and 'parquet' output formats.
+#
+# Types can be declared in a [Types] section of the configuration (`column = type`), otherwise
+# they're inferred from the FHIR primitive type of plain paths (no operators, single line). The
+# 'csv' output format keeps emitting strings, that's what raw-to-core expects.
+
+STRING = 'string'
+DATE = 'date'
+DATETIME = 'datetime'
+INTEGER = 'integer'
+DECIMAL = 'decimal'
+BOOLEAN = 'boolean'
+column_types = [STRING, DATE, DATETIME, INTEGER, DECIMAL, BOOLEAN]
+
+date_elements = {'birthDate', 'expirationDate'}
+datetime_elements = {
+    'abatementDateTime', 'authoredOn', 'created', 'creation', 'date', 'dateAsserted',
+    'deceasedDateTime', 'effectiveDateTime', 'effectiveInstant', 'end', 'issued', 'lastUpdated',
+    'occurrenceDateTime', 'onset', 'onsetDateTime', 'performedDateTime', 'presentationDate',
+    'publicationDate', 'recorded', 'recordedDate', 'start', 'time', 'valueDateTime', 'whenHandedOver',
+    'whenPrepared',
+}
+boolean_elements = {
+    'allDay', 'allowedBoolean', 'asNeededBoolean', 'deceasedBoolean', 'doNotPerform', 'isSubpotent',
+    'primarySource', 'reported', 'reportedBoolean', 'valueBoolean', 'wasSubstituted',
+}
+integer_elements = {
+    'count', 'countMax', 'dimensions', 'doseNumberPositiveInt', 'frequency', 'frequencyMax',
+    'numberOfRepeatsAllowed', 'offset', 'rank', 'seriesDosesPositiveInt', 'size', 'valueInteger',
+}
+decimal_elements = {'altitude', 'factor', 'latitude', 'longitude', 'lowerLimit', 'upperLimit'}
+# Elements that are decimals only under a specific parent, e.g. Quantity.value vs Identifier.value
+decimal_elements_by_parent = {
+    'value': {
+        'abatementAge', 'daysSupply', 'dailyAmount', 'denominator', 'dose', 'doseQuantity', 'high',
+        'length', 'low', 'numerator', 'onsetAge', 'origin', 'performedAge', 'quantity', 'rateQuantity',
+        'valueQuantity',
+    },
+    'duration': {'repeat'},
+    'durationMax': {'repeat'},
+    'period': {'repeat', 'valueSampledData'},
+    'periodMax': {'repeat'},
+}
+
+
+def infer_column_type(path):
+    """FHIR primitive type of a plain path, 'string' if it can't be inferred."""
+    if len(path.splitlines()) != 1:
+        return STRING
+    if path.startswith('Anchor:'):
+        path = path[len('Anchor:'):]
+    if ':' in path:
+        return STRING
+    elements = [element for element in path.split('.') if not element.isdigit()]
+    if len(elements) < 1:
+        return STRING
+    element = elements[-1]
+    parent = elements[-2] if len(elements) > 1 else None
+    if element in date_elements:
+        return DATE
+    if element in datetime_elements:
+        return DATETIME
+    if element in boolean_elements:
+        return BOOLEAN
+    if element in integer_elements:
+        return INTEGER
+    if element in decimal_elements or parent in decimal_elements_by_parent.get(element, set()):
+        return DECIMAL
+    return STRING
+
+
+def get_column_types(config, header, paths):
+    declared_types = config['Types'] if config.has_section('Types') else {}
+    types = []
+    for column, path in zip(header, paths):
+        column_type = declared_types.get(column) or infer_column_type(path)
+        if column_type not in column_types:
+            raise ValueError(f"Invalid type '{column_type}' for column {column}, must be one of {column_types}")
+        types.append(column_type)
+    return types
+
+
+def to_datetime(value):
+    # Dates without time are midnight UTC, partial dates (year, year-month) are dropped
+    if len(value) < 10:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def to_date(value):
+    try:
+        return date.fromisoformat(value[:10])
+    except ValueError:
+        return None
+
+
+def to_boolean(value):
+    lower = value.lower()
+    if lower == 'true':
+        return True
+    if lower == 'false':
+        return False
+    return None
+
+
+def to_integer(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def to_decimal(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+converters = {
+    DATE: to_date,
+    DATETIME: to_datetime,
+    BOOLEAN: to_boolean,
+    INTEGER: to_integer,
+    DECIMAL: to_decimal,
+}
+
+
+def convert_values(values, column_type):
+    """Converts string values to the column type, values that don't parse become None."""
+    converter = converters.get(column_type)
+    if converter is None:
+        return values
+    return [converter(value) if value is not None else None for value in values]
+
+
+def to_arrow_type(column_type):
+    import pyarrow as pa
+    return {
+        STRING: pa.string(),
+        DATE: pa.date32(),
+        DATETIME: pa.timestamp('us', tz='UTC'),
+        BOOLEAN: pa.bool_(),
+        INTEGER: pa.int64(),
+        DECIMAL: pa.float64(),
+    }[column_type]
+
+
+def to_pandas_dtype(column_type):
+    return {
+        STRING: object,
+        DATE: object,
+        DATETIME: 'datetime64[us, UTC]',
+        BOOLEAN: 'boolean',
+        INTEGER: 'Int64',
+        DECIMAL: 'Float64',
+    }[column_type]
@@ -0,0 +1,124 @@
+from array import array
+from src.parseFhir import columnTypes
+
+# METRIPORT CHANGE - columnar accumulator for the 'return' and 'parquet' output formats, so rows
+# aren't kept as one Python list of strings each.
+#
+# Values are stored per column. Columns start dictionary-encoded (each distinct value is stored
+# once, rows keep a 4-byte code), which is what low-cardinality columns like resourcetype, status
+# or system end up with. Columns whose dictionary grows past max_dictionary_size switch to a plain
+# list of values.
+
+# Code reserved for None/missing values
+null_code = 0
+default_max_dictionary_size = 1024
+# Rough per-value overhead of a Python str, used to estimate the memory held by the accumulator
+str_overhead_bytes = 50
+
+
+class ColumnarRows:
+    def __init__(self, header, column_types=None, on_flush=None, max_chunk_bytes=None, max_dictionary_size=default_max_dictionary_size):
+        """
+        :param header: the column names.
+        :param column_types: the type of each column (see columnTypes), all strings if not set.
+        :param on_flush: called with this accumulator when it holds max_chunk_bytes, before
+            it's cleared; if not set, rows are kept until the caller reads them.
+        :param max_chunk_bytes: estimated memory at which rows are flushed.
+        """
+        self.header = header
+        self.column_types = column_types or [columnTypes.STRING] * len(header)
+        self.on_flush = on_flush
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_dictionary_size = max_dictionary_size
+        self.reset()
+
+    def reset(self):
+        self.row_count = 0
+        self.estimated_bytes = 0
+        # Per column: either a list of values (plain) or array of codes + dictionary (encoded)
+        self.codes = [array('I') for _ in self.header]
+        self.dictionaries = [{} for _ in self.header]
+        self.dictionary_values = [[None] for _ in self.header]
+        self.plain_values = [None for _ in self.header]
+
+    def __len__(self):
+        return self.row_count
+
+    def append(self, row):
+        for i, value in enumerate(row):
+            plain = self.plain_values[i]
+            if plain is not None:
+                plain.append(value)
+                self.estimated_bytes += 8 + (len(value) + str_overhead_bytes if value is not None else 0)
+                continue
+            if value is None:
+                self.codes[i].append(null_code)
+                self.estimated_bytes += 4
+                continue
+            dictionary = self.dictionaries[i]
+            code = dictionary.get(value)
+            if code is None:
+                if len(dictionary) >= self.max_dictionary_size:
+                    self.to_plain(i)
+                    self.plain_values[i].append(value)
+                    self.estimated_bytes += 8 + len(value) + str_overhead_bytes
+                    continue
+                code = len(self.dictionary_values[i])
+                dictionary[value] = code
+                self.dictionary_values[i].append(value)
+                self.estimated_bytes += len(value) + str_overhead_bytes
+            self.codes[i].append(code)
+            self.estimated_bytes += 4
+        self.row_count += 1
+        if self.on_flush and self.max_chunk_bytes and self.estimated_bytes >= self.max_chunk_bytes:
+            self.flush()
+
+    def to_plain(self, i):
+        values = self.dictionary_values[i]
+        self.plain_values[i] = [values[code] for code in self.codes[i]]
+        self.estimated_bytes += 4 * len(self.codes[i])
+        self.codes[i] = array('I')
+        self.dictionaries[i] = {}
+        self.dictionary_values[i] = [None]
+
+    def flush(self):
+        if self.row_count > 0 and self.on_flush:
+            self.on_flush(self)
+        self.reset()
+
+    def column_values(self, i):
+        """The values of a column, as a list."""
+        if self.plain_values[i] is not None:
+            return self.plain_values[i]
+        values = self.dictionary_values[i]
+        return [values[code] for code in self.codes[i]]
+
+    def to_dataframe(self):
+        import pandas as pd
+        columns = {}
+        for i, name in enumerate(self.header):
+            column_type = self.column_types[i]
+            if self.plain_values[i] is not None:
+                values = columnTypes.convert_values(self.plain_values[i], column_type)
+            else:
+                # Only distinct values need converting
+                typed_dictionary = columnTypes.convert_values(self.dictionary_values[i], column_type)
+                values = [typed_dictionary[code] for code in self.codes[i]]
+            columns[name] = pd.Series(values, dtype=columnTypes.to_pandas_dtype(column_type))
+        return pd.DataFrame(columns, columns=self.header)
+
+    def to_arrow_table(self):
+        import pyarrow as pa
+        arrays = []
+        for i in range(len(self.header)):
+            column_type = self.column_types[i]
+            arrow_type = columnTypes.to_arrow_type(column_type)
+            if self.plain_values[i] is not None:
+                arrays.append(pa.array(columnTypes.convert_values(self.plain_values[i], column_type), type=arrow_type))
+                continue
+            # The dictionary's first value is None (null_code), so nulls decode as they are
+            indices = pa.array(self.codes[i], type=pa.int32())
+            dictionary = pa.array(columnTypes.convert_values(self.dictionary_values[i], column_type), type=arrow_type)
+            # Decoded so every chunk has the same schema, Parquet dictionary-encodes on write anyway
+            arrays.append(pa.DictionaryArray.from_arrays(indices, dictionary).dictionary_decode())
+        return pa.Table.from_arrays(arrays, names=self.header)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Lints the .ini configurations and, given sample bundles, estimates what each of them costs.
+
+Static checks (no sample needed):
+- duplicate columns in [Struct], and columns that read the exact same path
+- unreachable paths: unknown operators, `Anchor:` paths in configurations without an anchor
+- expensive operators: ArrCond/ArrNotHave/ArrJoin (scan arrays) and multi-line paths
+
+With sample bundles (NDJSON as produced by main.py, or Bundle JSON), every configuration is run
+over the resources of its type and each column is timed, reporting the columns that never get a
+value: they're evaluated for every resource and are candidates for pruning. Sample lines that aren't
+valid JSON and resources a configuration fails on are skipped and counted, as parseFhir.parse does.
+
+Usage:
+    python -m src.parseFhir.configAnalysis [--sample <bundle or folder> ...] [--json <report.json>]
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import configparser
+from collections import Counter, defaultdict
+from pathlib import Path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from src.parseFhir.parseFhir import combineValues, getJsonValue
+from src.utils import jsonlib
+
+config_dir = Path(__file__).parent / "configurations"
+
+# Operators getJsonValue understands, see parseFhir.getJsonValue
+operators = [
+    "ArrJoin", "Filename", "GetDate", "ArrNotHave", "ArrCond", "Hard", "IfEx", "IfEq", "Left", "LTrim", "TimeForm",
+]
+expensive_operators = ["ArrCond", "ArrNotHave", "ArrJoin"]
+constant_operators = ["Filename", "GetDate", "Hard"]
+key_line = re.compile(r"^\s*([^#;=\s][^=]*?)\s*=\s*(.*)$")
+
+
+def read_raw_struct(config_path) -> list[tuple[str, str, int]]:
+    """(column, path, line number) of each [Struct] row, duplicates included - ConfigParser rejects them."""
+    rows = []
+    section = None
+    with open(config_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            stripped = line.strip()
+            if stripped.startswith("[") and stripped.endswith("]"):
+                section = stripped[1:-1]
+                continue
+            if section != "Struct":
+                continue
+            match = key_line.match(line)
+            if match:
+                rows.append((match.group(1).lower(), match.group(2), line_number))
+            elif rows and line[:1].isspace() and stripped:
+                # Continuation of a multi-line path
+                column, path, number = rows[-1]
+                rows[-1] = (column, f"{path}\n{stripped}", number)
+    return rows
+
+
+def get_operators(path: str) -> list[str]:
+    found = []
+    for line in path.splitlines():
+        for element in line.split("."):
+            if ":" in element:
+                found.append(element.split(":", 1)[0])
+    return found
+
+
+def get_resource_type(config_file: str) -> str:
+    # Same convention as parseNdjsonBundle.get_resource_type_from_config
+    return config_file.replace("config_", "").replace(".ini", "").split("_")[0]
+
+
+class ConfigAnalysis:
+    def __init__(self, config_path):
+        self.config_path = Path(config_path)
+        self.config_file = self.config_path.name
+        self.resource_type = get_resource_type(self.config_file)
+        self.rows = read_raw_struct(config_path)
+        config = configparser.ConfigParser(strict=False)
+        config.read(config_path)
+        self.anchor = config["GenConfig"].get("anchor", False) if config.has_section("GenConfig") else False
+        self.columns = list(dict.fromkeys(column for column, _, _ in self.rows))
+        self.paths = {column: path for column, path, _ in self.rows}
+        self.issues: list[str] = []
+        # Filled by evaluate()
+        self.resources = 0
+        self.row_count = 0
+        self.populated = defaultdict(int)
+        self.seconds = defaultdict(float)
+        # Exception class -> resources the configuration failed on
+        self.errors = Counter()
+
+    def lint(self) -> list[str]:
+        issues = []
+        seen_columns = {}
+        columns_by_path = defaultdict(list)
+        for column, path, line_number in self.rows:
+            if column in seen_columns:
+                issues.append(f"duplicate column '{column}' (lines {seen_columns[column]} and {line_number})")
+            seen_columns.setdefault(column, line_number)
+            columns_by_path[path].append(column)
+            for operator in get_operators(path):
+                if operator not in operators and operator != "Anchor":
+                    issues.append(f"unreachable column '{column}', unknown operator '{operator}:'")
+            if path.startswith("Anchor:") and not self.anchor:
+                issues.append(f"unreachable column '{column}', 'Anchor:' path without an anchor in [GenConfig]")
+            if "" in path.replace("Anchor:", "", 1).split("."):
+                issues.append(f"unreachable column '{column}', empty element in path '{path}'")
+            expensive = [operator for operator in get_operators(path) if operator in expensive_operators]
+            if expensive:
+                issues.append(f"expensive column '{column}', uses {', '.join(sorted(set(expensive)))}")
+            if len(path.splitlines()) > 3:
+                issues.append(f"expensive column '{column}', combines {len(path.splitlines())} paths")
+        for path, columns in columns_by_path.items():
+            if len(columns) > 1 and not any(operator in constant_operators for operator in get_operators(path)):
+                issues.append(f"columns {columns} read the same path '{path}'")
+        self.issues = issues
+        return issues
+
+    def evaluate(self, resources: list[dict]) -> None:
+        """Runs the configuration over sample resources of its type, timing each column."""
+        filename = ""
+        timer = time.perf_counter
+        for resource in resources:
+            self.resources += 1
+            try:
+                self.evaluate_resource(resource, filename, timer)
+            except Exception as e:
+                # Skipped like parseFhir.parse skips it, the columns it reached are still timed
+                self.errors[type(e).__name__] += 1
+
+    def evaluate_resource(self, resource: dict, filename: str, timer) -> None:
+        if self.anchor:
+            anchor_value = getJsonValue(resource, self.anchor, filename)
+            if anchor_value is None:
+                return
+            anchor_items = anchor_value if isinstance(anchor_value, list) else [anchor_value]
+        else:
+            anchor_items = [None]
+        for item in anchor_items:
+            self.row_count += 1
+            memo = {}
+            for column in self.columns:
+                path = self.paths[column]
+                start = timer()
+                try:
+                    if path.startswith("Anchor:"):
+                        value = combineValues(item, path[len("Anchor:"):], filename, memo) if item is not None else None
+                    else:
+                        value = combineValues(resource, path, filename, memo)
+                finally:
+                    self.seconds[column] += timer() - start
+                if value is not None:
+                    self.populated[column] += 1
+
+    def never_populated(self) -> list[str]:
+        return [
+            column for column in self.columns
+            if self.populated[column] == 0
+            and not any(operator in constant_operators for operator in get_operators(self.paths[column]))
+        ]
+
+    def report(self) -> dict:
+        total_seconds = sum(self.seconds.values())
+        dead_columns = self.never_populated() if self.resources > 0 else []
+        return {
+            "config": self.config_file,
+            "columns": len(self.columns),
+            "issues": self.issues,
+            "resources": self.resources,
+            "failedResources": sum(self.errors.values()),
+            "errors": dict(self.errors),
+            "rows": self.row_count,
+            "seconds": round(total_seconds, 4),
+            "microsecondsPerResource": round(1e6 * total_seconds / self.resources, 1) if self.resources else None,
+            "neverPopulated": dead_columns,
+            "neverPopulatedSeconds": round(sum(self.seconds[column] for column in dead_columns), 4),
+            "slowestColumns": [
+                {"column": column, "seconds": round(seconds, 4)}
+                for column, seconds in sorted(self.seconds.items(), key=lambda item: -item[1])[:5]
+            ],
+        }
+
+
+def iter_sample_files(sample_paths):
+    for sample_path in sample_paths:
+        if os.path.isdir(sample_path):
+            for root, _, files in os.walk(sample_path):
+                for file in sorted(files):
+                    if file.endswith((".json", ".ndjson")):
+                        yield os.path.join(root, file)
+        else:
+            yield sample_path
+
+
+def iter_ndjson_documents(f, skipped: Counter):
+    for line in f:
+        if not line.strip():
+            continue
+        try:
+            yield jsonlib.loads(line)
+        except ValueError:
+            # E.g. a truncated line, skipped like parseFhir.parse skips it
+            skipped["invalidLines"] += 1
+
+
+def iter_sample_resources(sample_paths, skipped: Counter = None):
+    """
+    Resources of sample bundles: NDJSON (one Bundle entry or resource per line) or Bundle JSON.
+    NDJSON lines and JSON files that aren't valid JSON are skipped, and counted in `skipped`.
+    """
+    skipped = skipped if skipped is not None else Counter()
+    for sample_file in iter_sample_files(sample_paths):
+        with open(sample_file, "rb") as f:
+            if sample_file.endswith(".ndjson"):
+                documents = iter_ndjson_documents(f, skipped)
+            else:
+                try:
+                    bundle = jsonlib.load(f)
+                except ValueError:
+                    skipped["invalidFiles"] += 1
+                    continue
+                if not isinstance(bundle, dict):
+                    skipped["invalidFiles"] += 1
+                    continue
+                documents = (bundle.get("entry") or []) if bundle.get("resourceType") == "Bundle" else [bundle]
+            for document in documents:
+                resource = document.get("resource", document) if isinstance(document, dict) else None
+                if isinstance(resource, dict) and resource.get("resourceType"):
+                    yield resource
+
+
+def load_sample(sample_paths, skipped: Counter = None) -> dict[str, list[dict]]:
+    resources_by_type = defaultdict(list)
+    for resource in iter_sample_resources(sample_paths, skipped):
+        resources_by_type[resource["resourceType"]].append(resource)
+    return resources_by_type
+
+
+def analyze(config_paths, sample_paths=None, skipped: Counter = None) -> list[dict]:
+    """:param skipped: filled with the count of sample lines (and files) that aren't valid JSON."""
+    resources_by_type = load_sample(sample_paths, skipped) if sample_paths else {}
+    reports = []
+    for config_path in config_paths:
+        analysis = ConfigAnalysis(config_path)
+        analysis.lint()
+        if sample_paths:
+            analysis.evaluate(resources_by_type.get(analysis.resource_type, []))
+        reports.append(analysis.report())
+    return reports
+
+
+def print_reports(reports, with_sample: bool) -> None:
+    for report in reports:
+        print(f"{report['config']}: {report['columns']} columns")
+        for issue in report["issues"]:
+            print(f"  - {issue}")
+        if with_sample:
+            if report["resources"] < 1:
+                print("  no sample resources of this type")
+                continue
+            print(
+                f"  {report['resources']} resources, {report['rows']} rows, {report['seconds']}s "
+                f"({report['microsecondsPerResource']}us per resource)"
+            )
+            print(
+                f"  {len(report['neverPopulated'])} columns never populated, "
+                f"{report['neverPopulatedSeconds']}s spent on them"
+            )
+            if report["failedResources"]:
+                print(f"  {report['failedResources']} resources failed: {report['errors']}")
+    if with_sample:
+        total = sum(report["seconds"] for report in reports)
+        dead = sum(report["neverPopulatedSeconds"] for report in reports)
+        print(f"Total: {round(total, 3)}s, {round(dead, 3)}s on never populated columns")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lint the configurations and estimate their cost over sample bundles.")
+    parser.add_argument("configs", nargs="*", help="configuration files, defaults to all of them")
+    parser.add_argument("--sample", action="append", help="sample bundle (NDJSON or JSON) or folder of bundles")
+    parser.add_argument("--json", help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    config_paths = args.configs or sorted(str(path) for path in config_dir.glob("*.ini"))
+    skipped = Counter()
+    reports = analyze(config_paths, args.sample, skipped)
+    print_reports(reports, bool(args.sample))
+    if skipped:
+        print(
+            f"Skipped {skipped['invalidLines']} sample lines and {skipped['invalidFiles']} sample files "
+            "that aren't valid JSON"
+        )
+    if args.json:
+        with open(args.json, "wb") as f:
+            f.write(jsonlib.dumps_bytes(reports))
+        print(f"Report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
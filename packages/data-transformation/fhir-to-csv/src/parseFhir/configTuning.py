@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Tunes the indexed columns of the configurations (e.g. identifier_0..4_*, type_coding_0..1_*) to
+the array sizes observed in a corpus of bundles.
+
+The corpus is profiled first: the size of every array, per path (indexes removed) and resource
+type. Then, for each array, the number of indexed columns is set to a percentile of its sizes
+(99.9 by default, between --min-cap and --max-cap): columns of positions above it are dropped, and positions
+that are missing are added, cloned from the last configured one. Arrays that aren't in the corpus
+keep the columns they have. Arrays that are larger than their cap in the corpus get an anchored
+child configuration (like config_Condition_code_coding.ini), one row per element, so the overflow
+isn't lost.
+
+The configurations are edited line by line, so their comments (e.g. the sorting markers) are kept,
+and the added columns follow the column they're cloned from. Tuned configurations are written to
+--output (the configurations in use aren't modified), run sort-ini-files.py on them before moving
+them into configurations/.
+
+Usage:
+    python -m src.parseFhir.configTuning --sample <bundle or folder> [--percentile 99.9] [--output <folder>]
+"""
+
+import os
+import re
+import sys
+import math
+import argparse
+import configparser
+from collections import Counter, defaultdict
+from pathlib import Path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from src.parseFhir.configAnalysis import config_dir, get_resource_type, iter_sample_resources, key_line
+from src.utils import jsonlib
+
+default_percentile = 99.9
+default_min_cap = 1
+# Arrays can have hundreds of elements (e.g. Observation.component), those go to the overflow table
+default_max_cap = 10
+# Sections whose entries are (name, path) pairs that follow the indexed columns
+path_sections = ["Struct", "root_paths", "anchor_paths"]
+numeric_token = re.compile(r"(?<![^_.])\d+(?![^_.])")
+
+
+def profile_resource(value, path: str, sizes: dict[str, Counter]) -> None:
+    if isinstance(value, dict):
+        for key, child in value.items():
+            profile_resource(child, f"{path}.{key}" if path else key, sizes)
+    elif isinstance(value, list):
+        sizes[path][len(value)] += 1
+        for child in value:
+            profile_resource(child, path, sizes)
+
+
+def profile(sample_paths) -> dict[str, dict[str, Counter]]:
+    """Resource type -> array path (without indexes) -> Counter of the array sizes."""
+    sizes_by_type = defaultdict(lambda: defaultdict(Counter))
+    for resource in iter_sample_resources(sample_paths):
+        profile_resource(resource, "", sizes_by_type[resource["resourceType"]])
+    return sizes_by_type
+
+
+def get_percentile(sizes: Counter, percentile: float) -> int:
+    total = sum(sizes.values())
+    if total < 1:
+        return 0
+    rank = math.ceil(percentile / 100 * total)
+    seen = 0
+    for size in sorted(sizes):
+        seen += sizes[size]
+        if seen >= rank:
+            return size
+    return max(sizes)
+
+
+def get_indexes(path: str, base: str = "") -> list[tuple[str, int, int]]:
+    """(array path without indexes, index, element position) of each index in a single-line path."""
+    indexes = []
+    elements = path.split(".")
+    array_path = [base] if base else []
+    for position, element in enumerate(elements):
+        if element.isdigit():
+            indexes.append((".".join(array_path), int(element), position))
+        else:
+            array_path.append(element)
+    return indexes
+
+
+def replace_index(name: str, path: str, index_number: int, position: int, new_index: int) -> tuple[str, str] | None:
+    """Name and path of a column for another position of one of its arrays, None if the name doesn't follow the path."""
+    elements = path.split(".")
+    elements[position] = str(new_index)
+    tokens = list(numeric_token.finditer(name))
+    path_indexes = [element for element in path.split(".") if element.isdigit()]
+    if len(tokens) != len(path_indexes):
+        return None
+    token = tokens[index_number]
+    new_token = str(new_index).zfill(len(token.group(0)))
+    return name[:token.start()] + new_token + name[token.end():], ".".join(elements)
+
+
+def split_anchor(path: str) -> tuple[str, str]:
+    return ("Anchor:", path[len("Anchor:"):]) if path.startswith("Anchor:") else ("", path)
+
+
+class ConfigLine:
+    """A line of a configuration, with its continuation lines if it's an entry with a multi-line path."""
+
+    def __init__(self, text: str, section: str = None, name: str = None, path: str = None):
+        self.text = text
+        self.section = section
+        self.name = name
+        self.path = path
+
+
+def read_config_lines(config_path) -> list[ConfigLine]:
+    lines = []
+    section = None
+    with open(config_path, "r", encoding="utf-8") as f:
+        for line in f:
+            stripped = line.strip()
+            if stripped.startswith("[") and stripped.endswith("]"):
+                section = stripped[1:-1]
+                lines.append(ConfigLine(line))
+                continue
+            match = key_line.match(line)
+            if match:
+                lines.append(ConfigLine(line, section, match.group(1), match.group(2)))
+            elif lines and lines[-1].name is not None and line[:1].isspace() and stripped:
+                # Continuation of a multi-line path, joined like ConfigParser joins it
+                entry = lines[-1]
+                entry.text += line
+                entry.path = f"{entry.path}\n{stripped}" if entry.path else stripped
+            else:
+                lines.append(ConfigLine(line))
+    return lines
+
+
+class ConfigTuning:
+    def __init__(self, config_path, sizes: dict[str, Counter], percentile: float = default_percentile, min_cap: int = default_min_cap, max_cap: int = default_max_cap):
+        self.config_path = Path(config_path)
+        self.config = configparser.ConfigParser(strict=False)
+        self.config.read(config_path)
+        self.lines = read_config_lines(config_path)
+        self.anchor = self.config["GenConfig"].get("anchor", "")
+        self.sizes = sizes
+        self.caps = {
+            array_path: min(max_cap, max(min_cap, get_percentile(counts, percentile)))
+            for array_path, counts in sizes.items()
+        }
+        self.removed_columns = 0
+        self.added_columns = 0
+        # Added column -> the configured column it's cloned from
+        self.clone_sources: dict[str, str] = {}
+
+    def get_cap(self, array_path: str) -> int | None:
+        """Number of positions to keep, None for arrays not in the corpus: their columns are kept as they are."""
+        return self.caps.get(array_path)
+
+    def get_base(self, section: str, prefix: str) -> str:
+        # anchor_paths and Anchor: paths are relative to the anchor's elements
+        return self.anchor if section == "anchor_paths" or prefix else ""
+
+    def is_above_cap(self, array_path: str, index: int) -> bool:
+        cap = self.get_cap(array_path)
+        return cap is not None and index >= cap
+
+    def tune_section(self, section: str, entries: list[tuple[str, str]]) -> list[tuple[str, str]]:
+        """
+        The entries of a section without the positions above their cap, followed by the missing
+        ones (see clone_sources for the entry each one is cloned from).
+        """
+        # Drop the positions above the cap
+        kept = []
+        for name, path in entries:
+            prefix, relative_path = split_anchor(path)
+            base = self.get_base(section, prefix)
+            single_line = len(path.splitlines()) == 1
+            if single_line and any(self.is_above_cap(array_path, index) for array_path, index, _ in get_indexes(relative_path, base)):
+                self.removed_columns += 1
+                continue
+            kept.append((name, path))
+
+        # Add the missing positions, outer arrays first so their clones get the inner positions too
+        array_paths = sorted(
+            {array_path for _, path in kept if len(path.splitlines()) == 1
+             for array_path, _, _ in get_indexes(split_anchor(path)[1], self.get_base(section, split_anchor(path)[0]))},
+            key=lambda array_path: array_path.count("."),
+        )
+        for array_path in array_paths:
+            kept = self.extend_array(section, kept, array_path)
+        return kept
+
+    def extend_array(self, section: str, entries: list[tuple[str, str]], array_path: str) -> list[tuple[str, str]]:
+        cap = self.get_cap(array_path)
+        if cap is None:
+            return entries
+        configured = [
+            (name, path, index_number, index, position)
+            for name, path in entries if len(path.splitlines()) == 1
+            for index_number, (entry_array_path, index, position) in enumerate(
+                get_indexes(split_anchor(path)[1], self.get_base(section, split_anchor(path)[0]))
+            )
+            if entry_array_path == array_path
+        ]
+        if not configured:
+            return entries
+        last_index = max(index for _, _, _, index, _ in configured)
+        if last_index + 1 >= cap:
+            return entries
+        existing_names = {name for name, _ in entries}
+        clones = []
+        for name, path, index_number, index, position in configured:
+            if index != last_index:
+                continue
+            prefix, relative_path = split_anchor(path)
+            for new_index in range(last_index + 1, cap):
+                replaced = replace_index(name, relative_path, index_number, position, new_index)
+                if replaced is None or replaced[0] in existing_names:
+                    continue
+                clones.append((replaced[0], prefix + replaced[1]))
+                existing_names.add(replaced[0])
+                # Placed after the original column, the clone of a clone too
+                self.clone_sources[replaced[0]] = self.clone_sources.get(name, name)
+        self.added_columns += len(clones)
+        return entries + clones
+
+    def get_overflowing_arrays(self) -> list[str]:
+        """Outermost indexed arrays larger than their cap in the corpus."""
+        if self.anchor:
+            return []
+        arrays = set()
+        for path in self.config["Struct"].values():
+            indexes = get_indexes(path) if len(path.splitlines()) == 1 else []
+            if indexes:
+                array_path = indexes[0][0]
+                if array_path in self.sizes and max(self.sizes[array_path]) > self.get_cap(array_path):
+                    arrays.add(array_path)
+        return sorted(arrays)
+
+    def tune(self) -> list[str]:
+        """Lines of the tuned configuration, the other lines (comments included) as they are."""
+        tuned_entries = set()
+        clones_by_source = defaultdict(list)
+        for section in path_sections:
+            entries = [(line.name, line.path) for line in self.lines if line.section == section and line.name is not None]
+            for name, path in self.tune_section(section, entries):
+                if name in self.clone_sources:
+                    clones_by_source[(section, self.clone_sources[name])].append(f"{name} = {path}\n")
+                else:
+                    tuned_entries.add((section, name))
+        tuned = []
+        for line in self.lines:
+            if line.section in path_sections and line.name is not None:
+                if (line.section, line.name) not in tuned_entries:
+                    continue
+                tuned.append(line.text)
+                tuned.extend(clones_by_source[(line.section, line.name)])
+            else:
+                tuned.append(line.text)
+        return tuned
+
+    def create_overflow_config(self, array_path: str, resource_type: str) -> configparser.ConfigParser:
+        """Anchored configuration with one row per element of the array, from the columns of its first element."""
+        overflow = configparser.ConfigParser()
+        overflow["GenConfig"] = {
+            "outputpath": f"{resource_type}.csv",
+            "inputformat": "json",
+            "writemode": "append",
+            "anchor": array_path,
+        }
+        struct = {}
+        anchor_paths = {}
+        element_prefix = f"{array_path}.0."
+        for path in self.config["Struct"].values():
+            if len(path.splitlines()) == 1 and path.startswith(element_prefix):
+                element_path = path[len(element_prefix):]
+                struct[element_path.replace(".", "_").lower()] = f"Anchor:{element_path}"
+                anchor_paths[element_path.lower()] = element_path
+        struct[f"{resource_type.lower()}_id"] = "id"
+        struct["filename"] = "Filename:"
+        struct["processed_date"] = "GetDate:"
+        overflow["Struct"] = struct
+        overflow["anchor_paths"] = anchor_paths
+        overflow["root_paths"] = {}
+        overflow["ignore_paths"] = dict(self.config["ignore_paths"]) if self.config.has_section("ignore_paths") else {}
+        return overflow
+
+
+def write_config(config: configparser.ConfigParser, path: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        config.write(f)
+
+
+def write_lines(lines: list[str], path: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+
+
+def count_struct_columns(lines: list[str]) -> int:
+    section = None
+    count = 0
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith("[") and stripped.endswith("]"):
+            section = stripped[1:-1]
+        elif section == "Struct" and key_line.match(line):
+            count += 1
+    return count
+
+
+def tune(config_paths, sample_paths, output_folder: str, percentile: float = default_percentile, min_cap: int = default_min_cap, max_cap: int = default_max_cap) -> list[dict]:
+    sizes_by_type = profile(sample_paths)
+    os.makedirs(output_folder, exist_ok=True)
+    existing_configs = {Path(config_path).name.lower() for config_path in config_paths}
+    results = []
+    for config_path in config_paths:
+        config_file = Path(config_path).name
+        resource_type = get_resource_type(config_file)
+        if resource_type not in sizes_by_type:
+            print(f"{config_file}: no sample resources of this type, not tuned")
+            continue
+        tuning = ConfigTuning(config_path, sizes_by_type[resource_type], percentile, min_cap, max_cap)
+        columns_before = len(tuning.config["Struct"])
+        tuned = tuning.tune()
+        write_lines(tuned, os.path.join(output_folder, config_file))
+        overflow_configs = []
+        for array_path in tuning.get_overflowing_arrays():
+            overflow_file = f"config_{resource_type}_{array_path.replace('.', '_')}.ini"
+            if overflow_file.lower() in existing_configs:
+                continue
+            write_config(tuning.create_overflow_config(array_path, resource_type), os.path.join(output_folder, overflow_file))
+            overflow_configs.append(overflow_file)
+        results.append({
+            "config": config_file,
+            "columnsBefore": columns_before,
+            "columnsAfter": count_struct_columns(tuned),
+            "overflowConfigs": overflow_configs,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the indexed columns of the configurations to a corpus of bundles.")
+    parser.add_argument("configs", nargs="*", help="configuration files, defaults to all of them")
+    parser.add_argument("--sample", action="append", required=True, help="bundle (NDJSON or JSON) or folder of bundles")
+    parser.add_argument("--percentile", type=float, default=default_percentile, help="percentile of the array sizes to keep columns for")
+    parser.add_argument("--min-cap", type=int, default=default_min_cap, help="minimum number of positions kept per array")
+    parser.add_argument("--max-cap", type=int, default=default_max_cap, help="maximum number of positions kept per array")
+    parser.add_argument("--output", default="tuned-configurations", help="folder to write the tuned configurations to")
+    parser.add_argument("--profile", help="also write the array sizes per resource type to this JSON file")
+    args = parser.parse_args()
+
+    config_paths = args.configs or sorted(str(path) for path in config_dir.glob("*.ini"))
+    if args.profile:
+        sizes_by_type = profile(args.sample)
+        with open(args.profile, "wb") as f:
+            f.write(jsonlib.dumps_bytes({
+                resource_type: {array_path: {str(size): count for size, count in sorted(sizes.items())} for array_path, sizes in arrays.items()}
+                for resource_type, arrays in sizes_by_type.items()
+            }))
+    results = tune(config_paths, args.sample, args.output, args.percentile, args.min_cap, args.max_cap)
+    for result in results:
+        overflow = f", overflow in {', '.join(result['overflowConfigs'])}" if result["overflowConfigs"] else ""
+        print(f"{result['config']}: {result['columnsBefore']} -> {result['columnsAfter']} columns{overflow}")
+    print(f"Tuned configurations written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
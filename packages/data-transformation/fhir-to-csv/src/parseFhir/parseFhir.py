@@ -1,16 +1,25 @@
-import json
 import sys
 import csv
 import configparser
 import logging
 import os
 from datetime import datetime
+from functools import lru_cache
+from contextlib import nullcontext
+from src.parseFhir.columnarRows import ColumnarRows # METRIPORT CHANGE FOR COMPACT ROWS
+from src.parseFhir.columnTypes import get_column_types # METRIPORT CHANGE FOR TYPED COLUMNS
+from src.parseFhir.resourceErrors import ResourceErrors # METRIPORT CHANGE FOR DEAD LETTERS
+from src.utils import jsonlib # METRIPORT CHANGE FOR FASTER JSON DECODING
 
 logging.basicConfig(
     level=logging.INFO,
     format='%(levelname)s - %(message)s'
 )
 
+# METRIPORT CHANGE FOR COMPACT ROWS - estimated memory of accumulated rows at which the 'parquet'
+# output format flushes them to the output file
+default_max_chunk_bytes = 64 * 1024 * 1024
+
 
 def extract_paths(json_obj, current_path='', all_paths=None, ignore_paths=None):
     if all_paths is None:
@@ -65,9 +74,9 @@ def compare_and_write_new_paths(json_obj, filename, anchor, config_paths, output
 
             for path in new_paths:
                 if anchor:
-                    file.write(f'"{filename.name}","Anchor:{path}","{anchor}"\n')
+                    file.write(f'"{filename}","Anchor:{path}","{anchor}"\n')
                 else:
-                    file.write(f'"{filename.name}","{path}",""\n')
+                    file.write(f'"{filename}","{path}",""\n')
 
 
 def get_sub_object(obj, path):
@@ -91,7 +100,31 @@ def is_integer(n):
         return float(n).is_integer()
 
 
-def getJsonValue(lnjsn, ln,filename = ""):
+# METRIPORT CHANGE FOR ARRAY LOOKUP INDEXES - the first element of an array matching an ArrCond: or
+# ArrNotHave: condition, memoized per resource so columns probing the same array (e.g. the codings of
+# each system) scan it once. Keyed by the array's id, only valid while the resource is alive.
+def get_arr_cond_index(lnjsn, condPath, filename, memo):
+    key = (id(lnjsn), 'ArrCond', condPath)
+    index = memo.get(key)
+    if index is None:
+        index = {}
+        for item in lnjsn:
+            value = getJsonValue(item, condPath, filename, memo)
+            if isinstance(value, str):
+                index.setdefault(value, item)
+        memo[key] = index
+    return index
+
+def get_arr_not_have_item(lnjsn, condPath, filename, memo):
+    key = (id(lnjsn), 'ArrNotHave', condPath)
+    if key not in memo:
+        memo[key] = next((item for item in lnjsn if getJsonValue(item, condPath, filename, memo) is None), None)
+    return memo[key]
+
+def get_processed_date():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def getJsonValue(lnjsn, ln,filename = "",memo = None):
     retVal = ""
     for x in ln.split("."):
         if is_integer(x):
@@ -110,7 +143,16 @@ def getJsonValue(lnjsn, ln,filename = ""):
         elif x.startswith("Filename:"):
             lnjsn = filename
         elif x.startswith("GetDate:"):
-            lnjsn = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            lnjsn = get_processed_date()
+        elif x.startswith("ArrNotHave:") and memo is not None and isinstance(lnjsn, list):
+            lnjsn = get_arr_not_have_item(lnjsn, x[11:].replace(",","."), filename, memo)
+            if lnjsn is None:
+                return None
+        elif x.startswith("ArrCond:") and memo is not None and isinstance(lnjsn, list):
+            spl = x[8:].split("|")
+            lnjsn = get_arr_cond_index(lnjsn, spl[0].replace(",","."), filename, memo).get(spl[1].replace(",","."))
+            if lnjsn is None:
+                return None
         elif x.startswith("ArrNotHave:"):
             x = x[11:]
             found = False
@@ -174,10 +216,10 @@ def getJsonValue(lnjsn, ln,filename = ""):
     return lnjsn
 
 
-def combineValues(jsn, path, filename):
+def combineValues(jsn, path, filename, memo=None):
     values = []
     for ln in path.splitlines():
-        value = getJsonValue(jsn, ln, filename)
+        value = getJsonValue(jsn, ln, filename, memo)
         if value is not None and value != '':  # This will skip over both None and empty strings, preserves 0 and False
             values.append(str(value))
 
@@ -198,48 +240,76 @@ def writerow_flex(data,csvwriter,row,outputFormat):
     elif outputFormat == 'parquet' or outputFormat == 'return':
         data.append(row)
 
-def parse_one_resource(anchor,paths,jsndict,leng,csvwriter,data,filename,outputFormat):
-    thisRow = [None]*leng
+# METRIPORT CHANGE FOR RUN-SCOPED CONSTANTS - columns whose value is the same for every row of a run
+# (GetDate:, Filename:), resolved once per run instead of once per row
+def get_constant_columns(paths, filename, processedDate):
+    constants = {}
+    for i, path in enumerate(paths):
+        if path == 'GetDate:':
+            constants[i] = processedDate
+        elif path == 'Filename:':
+            value = str(filename).strip() if filename is not None else ''
+            constants[i] = value or None
+    return constants
+
+def parse_one_resource(anchor,paths,jsndict,leng,csvwriter,data,filename,outputFormat,rowTemplate=None,columns=None):
+    # METRIPORT CHANGE FOR RUN-SCOPED CONSTANTS - rows start from rowTemplate (the constant columns),
+    # only the other columns are evaluated
+    rowTemplate = rowTemplate or [None]*leng
+    columns = columns if columns is not None else range(leng)
+    thisRow = list(rowTemplate)
     result_count = 0
+    memo = {} # METRIPORT CHANGE FOR ARRAY LOOKUP INDEXES, SHARED BY ALL COLUMNS OF THE RESOURCE
     if anchor == False:
-        for i in range(leng):
-            thisRow[i] = combineValues(jsndict, paths[i],filename)
+        for i in columns:
+            thisRow[i] = combineValues(jsndict, paths[i],filename,memo)
         writerow_flex(data,csvwriter,thisRow,outputFormat)
         return 1
     else:
-        anchorArray = getJsonValue(jsndict, anchor, filename)
+        anchorArray = getJsonValue(jsndict, anchor, filename, memo)
         if anchorArray is not None and isinstance(anchorArray, list):
             for z in anchorArray:
-                thisRow = [None] * leng
-                for i in range(leng):
+                thisRow = list(rowTemplate)
+                for i in columns:
                     if paths[i][:7] == 'Anchor:':
-                        thisRow[i] = combineValues(z, paths[i][7:],filename)
+                        thisRow[i] = combineValues(z, paths[i][7:],filename,memo)
                     else:
-                        thisRow[i] = combineValues(jsndict, paths[i],filename)
+                        thisRow[i] = combineValues(jsndict, paths[i],filename,memo)
                 result_count += 1
                 writerow_flex(data, csvwriter, thisRow, outputFormat)
             return result_count
         elif anchorArray is not None:
-            for i in range(leng):
+            for i in columns:
                 if paths[i][:7] == 'Anchor:':
                     thisRow[i] = combineValues(anchorArray,
                                                paths[i][7:]
-                                               , filename)
+                                               , filename, memo)
                 else:
-                    thisRow[i] = combineValues(jsndict, paths[i], filename)
+                    thisRow[i] = combineValues(jsndict, paths[i], filename, memo)
 
             writerow_flex(data, csvwriter, thisRow, outputFormat)
             return 1
 
 
-def parse(configPath,inputPath=None,outputPath=None,missingPath=None,outputFormat=None,inputFormat=None,writeMode=None):
-    f = open(configPath, "r")
+# Configurations don't change during the life of the process, so they're parsed once and shared
+# across runs (and threads, they're only read from)
+@lru_cache(maxsize=None)
+def read_config(configPath):
+    config = configparser.ConfigParser()
+    config.read(configPath)
+    return config
+
+
+# METRIPORT CHANGE - inputLines: ndjson lines (bytes-like) to parse instead of reading inputPath;
+# resourceKey: key of the resource in each input line/document (e.g. 'resource' for Bundle entries);
+# resourceErrors: collects the resources that fail to parse (see resourceErrors.py);
+# processedDate: value of the GetDate: columns, so all the files of a run share it
+def parse(configPath,inputPath=None,outputPath=None,missingPath=None,outputFormat=None,inputFormat=None,writeMode=None,maxChunkBytes=None,inputLines=None,resourceKey=None,resourceErrors=None,processedDate=None):
     logging.info('Started parsing "%s"', configPath)
 
-    config = configparser.ConfigParser()
     try:
-        config.read(configPath)
-    except:
+        config = read_config(configPath)
+    except Exception as e:
         logging.exception(f"Failed to read or parse the configuration file: {configPath}. Error: {e}")
         return
 
@@ -251,26 +321,30 @@ def parse(configPath,inputPath=None,outputPath=None,missingPath=None,outputForma
     missingPath = missingPath or config['GenConfig'].get('missingPath',None)
     outputFormat = outputFormat or config['GenConfig'].get('outputFormat', 'return')
     inputFormat = inputFormat or config['GenConfig'].get('inputFormat', 'json')
+    maxChunkBytes = int(maxChunkBytes or config['GenConfig'].get('maxChunkBytes', default_max_chunk_bytes))
 
     if (writeMode or config['GenConfig'].get('writeMode', 'a')).lower() in ['w','write']:
         writeMode = "w"
     else:
         writeMode = "a"
 
-    if inputFormat == 'ndjson' and outputFormat != 'csv':
-        raise ValueError("Input format 'ndjson' is only supported with 'csv' output format.")
-    
-    data = []
     header = []
     paths = []
     leng = 0
     row_count = 0
+    resourceErrors = resourceErrors if resourceErrors is not None else ResourceErrors()
 
     for key in config['Struct']:
         header.append(key)
         paths.append(config['Struct'][key])
         leng = leng + 1
 
+    # METRIPORT CHANGE FOR RUN-SCOPED CONSTANTS
+    processedDate = processedDate or get_processed_date()
+    constants = get_constant_columns(paths, inputPath, processedDate)
+    rowTemplate = [constants.get(i) for i in range(leng)]
+    columns = [i for i in range(leng) if i not in constants]
+
     if outputFormat == 'csv':
         csvfile = open(outputPath, writeMode, newline='')
         csvwriter = csv.writer(csvfile,
@@ -280,39 +354,62 @@ def parse(configPath,inputPath=None,outputPath=None,missingPath=None,outputForma
                                )
         if writeMode == "w":
             csvwriter.writerow(header)
+        data = None
+    elif outputFormat == 'parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Please install pyarrow and pandas to use the 'parquet' output format.")
+        csvfile = None
+        csvwriter = None
+        # METRIPORT CHANGE FOR COMPACT ROWS - rows are written in chunks to cap memory usage
+        parquet_writer = None
+        def write_parquet_chunk(rows):
+            nonlocal parquet_writer
+            table = rows.to_arrow_table()
+            if parquet_writer is None:
+                parquet_writer = pq.ParquetWriter(outputPath, table.schema)
+            parquet_writer.write_table(table)
+        data = ColumnarRows(header, get_column_types(config, header, paths), on_flush=write_parquet_chunk, max_chunk_bytes=maxChunkBytes)
     else:
         csvfile = None
         csvwriter = None
+        data = ColumnarRows(header, get_column_types(config, header, paths)) # METRIPORT CHANGE FOR COMPACT AND TYPED ROWS
 
 
 
     if inputFormat == 'ndjson':
-        with open(inputPath, encoding='utf-8-sig') as inputFile:
-            for jsntxt in inputFile:
-                result_count = 0
-                try:
-                    jsndict = json.loads(jsntxt)
-                    result_count = parse_one_resource(anchor, paths, jsndict, leng, csvwriter,data,inputPath,outputFormat)
-                    if missingPath:
-                        compare_and_write_new_paths(jsndict,inputFile,anchor,config,missingPath)
-                except:
-
-                    logging.exception('Issue with input file "%s", see badfile.csv',
-                                      configPath
-                                      )
-                row_count = row_count + (result_count or 0)
+        with (open(inputPath, 'rb') if inputLines is None else nullcontext(inputLines)) as inputFile: # METRIPORT CHANGE FOR FASTER JSON DECODING, BOM HANDLED BY jsonlib
+            try:
+                for jsntxt in inputFile:
+                    result_count = 0
+                    try:
+                        jsndict = jsonlib.loads(jsntxt)
+                        if resourceKey:
+                            jsndict = jsndict[resourceKey]
+                        result_count = parse_one_resource(anchor, paths, jsndict, leng, csvwriter,data,inputPath,outputFormat,rowTemplate,columns)
+                        if missingPath:
+                            compare_and_write_new_paths(jsndict,inputPath,anchor,config,missingPath) # METRIPORT CHANGE TO PASS THE PATH, THE INPUT MIGHT NOT BE A FILE
+                    except Exception as e:
+                        resourceErrors.record(configPath, jsntxt, e) # METRIPORT CHANGE FOR DEAD LETTERS, INSTEAD OF A TRACEBACK PER RESOURCE
+                    row_count = row_count + (result_count or 0)
+            finally:
+                # METRIPORT CHANGE - closed even if record() raises ErrorBudgetExceeded
+                if csvfile:
+                    csvfile.close()
     elif inputFormat == 'json':
-        with open(inputPath, encoding='utf-8-sig') as inputFile:
+        with open(inputPath, 'rb') as inputFile: # METRIPORT CHANGE FOR FASTER JSON DECODING, BOM HANDLED BY jsonlib
             result_count = 0
+            jsntxt = inputFile.read()
             try:
-                jsndict = json.loads(inputFile.read())
-                result_count = parse_one_resource(anchor, paths, jsndict, leng, csvwriter,data,inputPath,outputFormat)
+                jsndict = jsonlib.loads(jsntxt)
+                if resourceKey:
+                    jsndict = jsndict[resourceKey]
+                result_count = parse_one_resource(anchor, paths, jsndict, leng, csvwriter,data,inputPath,outputFormat,rowTemplate,columns)
                 if missingPath:
-                    compare_and_write_new_paths(jsndict,inputFile,anchor,config,missingPath)
-            except:
-                logging.exception('Issue with input file "%s" ',
-                                  configPath
-                                  )
+                    compare_and_write_new_paths(jsndict,inputPath,anchor,config,missingPath) # METRIPORT CHANGE TO PASS THE PATH, THE INPUT MIGHT NOT BE A FILE
+            except Exception as e:
+                resourceErrors.record(configPath, jsntxt, e) # METRIPORT CHANGE FOR DEAD LETTERS
 
 
             row_count = row_count + (result_count or 0)
@@ -320,22 +417,20 @@ def parse(configPath,inputPath=None,outputPath=None,missingPath=None,outputForma
         csvfile.close()
 
     elif outputFormat == 'parquet':
-        try:
-            import pyarrow as pa
-            import pyarrow.parquet as pq
-            import pandas as pd
-        except ImportError:
-            raise ImportError("Please install pyarrow and pandas to use the 'parquet' output format.")
-        table = pa.Table.from_pandas(pd.DataFrame(data, columns=header))
-        pq.write_table(table, outputPath)
+        data.flush()
+        if parquet_writer is None:
+            pq.write_table(data.to_arrow_table(), outputPath)
+        else:
+            parquet_writer.close()
     elif outputFormat == 'return':
         try:
             import pandas as pd
         except ImportError:
             raise ImportError("Please install pandas to use the 'return' output format.")
 
-        return pd.DataFrame(data, columns=header)
+        return data.to_dataframe()
     logging.info('Finished parsing "%s", %s rows written',
                  configPath,
                  str(row_count)
                  )
+    return row_count # METRIPORT CHANGE TO RETURN THE ROW COUNT
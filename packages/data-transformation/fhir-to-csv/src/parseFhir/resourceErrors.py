@@ -0,0 +1,126 @@
+import os
+import hashlib
+import logging
+from collections import Counter
+from src.utils import jsonlib
+
+# METRIPORT CHANGE - resources that fail to parse are collected here instead of logging a traceback
+# for each of them.
+#
+# Failures are counted per exception class and kept (up to max_dead_letters) so they can be written
+# once to a dead-letter NDJSON file. Only the first failure of each exception class is logged with
+# its traceback, the following ones are logged every log_sample_rate failures. Once more than
+# max_errors resources failed, ErrorBudgetExceeded is raised so the patient is aborted early.
+#
+# A resource is counted once even if it fails in several configurations (e.g. a truncated line of a
+# resource type with more than one configuration). Collectors of worker processes can share their
+# count (shared_count) so the budget applies to all of them together.
+
+default_log_sample_rate = 1000
+default_max_dead_letters = 10_000
+# Longest error message kept in the dead letters
+max_message_length = 500
+
+
+class ErrorBudgetExceeded(Exception):
+    pass
+
+
+def get_max_errors() -> int | None:
+    max_errors = os.getenv('MAX_RESOURCE_ERRORS')
+    return int(max_errors) if max_errors else None
+
+
+class ResourceErrors:
+    def __init__(self, max_errors: int = None, log_sample_rate: int = default_log_sample_rate, max_dead_letters: int = default_max_dead_letters, shared_count=None):
+        """
+        :param max_errors: number of failed resources above which ErrorBudgetExceeded is raised,
+            no limit if not set.
+        :param shared_count: multiprocessing.Value counting the failed resources of all the
+            collectors sharing it (e.g. one per worker process), used for the budget if set.
+        """
+        self.max_errors = max_errors
+        self.log_sample_rate = log_sample_rate
+        self.max_dead_letters = max_dead_letters
+        self.shared_count = shared_count
+        self.counts = Counter()
+        # Digest of each failed line -> exception class of its first failure
+        self.failed_lines: dict[bytes, str] = {}
+        # (config, exception class, message, line) of each failure
+        self.dead_letters: list[tuple[str, str, str, bytes]] = []
+
+    def __getstate__(self):
+        # Sent back from worker processes: the shared count can't be pickled, only inherited
+        return {**self.__dict__, 'shared_count': None}
+
+    def __len__(self):
+        """Number of resources that failed, each counted once."""
+        return len(self.failed_lines)
+
+    def total(self) -> int:
+        """Number of resources that failed, across all the collectors sharing the count."""
+        return self.shared_count.value if self.shared_count is not None else len(self)
+
+    def over_budget(self) -> bool:
+        return self.max_errors is not None and self.total() > self.max_errors
+
+    def check_budget(self) -> None:
+        if self.over_budget():
+            raise ErrorBudgetExceeded(f"{self.total()} resources failed to parse, the error budget is {self.max_errors}")
+
+    def record(self, config: str, line, exception: Exception) -> None:
+        """Records a resource that failed to parse, to be called from an except block."""
+        error = type(exception).__name__
+        line = bytes(line) if line is not None else b''
+        digest = hashlib.sha1(line).digest()
+        if digest not in self.failed_lines:
+            self.failed_lines[digest] = error
+            self.counts[error] += 1
+            if self.shared_count is not None:
+                with self.shared_count.get_lock():
+                    self.shared_count.value += 1
+            count = self.counts[error]
+            if count == 1:
+                logging.exception('Issue with input file "%s", %s - see the dead letters', config, error)
+            elif count % self.log_sample_rate == 0:
+                logging.warning('Issue with input file "%s", %s resources failed with %s so far', config, count, error)
+        if len(self.dead_letters) < self.max_dead_letters:
+            self.dead_letters.append((config, error, str(exception)[:max_message_length], line))
+        self.check_budget()
+
+    def merge(self, other: "ResourceErrors", check: bool = True) -> None:
+        """
+        Adds the failures of another collector, e.g. one used in a worker process.
+
+        :param check: whether to raise ErrorBudgetExceeded if the budget is exceeded.
+        """
+        for digest, error in other.failed_lines.items():
+            if digest not in self.failed_lines:
+                self.failed_lines[digest] = error
+                self.counts[error] += 1
+        room = max(0, self.max_dead_letters - len(self.dead_letters))
+        self.dead_letters.extend(other.dead_letters[:room])
+        if check:
+            self.check_budget()
+
+    def write_dead_letters(self, path: str) -> int:
+        """
+        Writes the failed resources to an NDJSON file, each one once even if it failed in several
+        configurations. Returns the number of lines written.
+        """
+        lines_by_resource = {}
+        for config, error, message, line in self.dead_letters:
+            entry = lines_by_resource.get(line)
+            if entry is None:
+                lines_by_resource[line] = {
+                    "error": error,
+                    "message": message,
+                    "configs": [os.path.basename(config)],
+                    "line": line.decode('utf-8', errors='replace'),
+                }
+            elif os.path.basename(config) not in entry["configs"]:
+                entry["configs"].append(os.path.basename(config))
+        with open(path, 'wb') as file:
+            for entry in lines_by_resource.values():
+                file.write(jsonlib.dumps_bytes(entry) + b'\n')
+        return len(lines_by_resource)
@@ -0,0 +1,124 @@
+import os
+import mmap
+from src.utils import jsonlib
+
+# METRIPORT CHANGE - memory-mapped reader for the NDJSON bundle.
+#
+# The file is mapped once and scanned for line offsets and the resourceType of each line, without
+# parsing the JSON (the resourceType is read straight from the bytes when it's the first key of the
+# resource, which is how bundles are serialized). Each config then gets only the lines of its own
+# resource type, as zero-copy slices of the mapped file.
+
+resource_key = b'"resource"'
+resource_type_key = b'"resourceType"'
+whitespace = b' \t\r'
+
+
+def skip_whitespace(buffer, position: int, end: int) -> int:
+    while position < end and buffer[position] in whitespace:
+        position += 1
+    return position
+
+
+def scan_resource_type(buffer, start: int, end: int) -> str | None:
+    """Reads the resourceType of a Bundle entry line, None if it's not the resource's first key."""
+    position = buffer.find(resource_key, start, end)
+    if position < 0:
+        return None
+    position = skip_whitespace(buffer, position + len(resource_key), end)
+    if position >= end or buffer[position] != ord(':'):
+        return None
+    position = skip_whitespace(buffer, position + 1, end)
+    if position >= end or buffer[position] != ord('{'):
+        return None
+    position = skip_whitespace(buffer, position + 1, end)
+    if buffer[position:position + len(resource_type_key)] != resource_type_key:
+        return None
+    position = skip_whitespace(buffer, position + len(resource_type_key), end)
+    if position >= end or buffer[position] != ord(':'):
+        return None
+    position = skip_whitespace(buffer, position + 1, end)
+    if position >= end or buffer[position] != ord('"'):
+        return None
+    value_end = buffer.find(b'"', position + 1, end)
+    if value_end < 0:
+        return None
+    return buffer[position + 1:value_end].decode('utf-8')
+
+
+def parse_resource_type(buffer, start: int, end: int) -> str | None:
+    try:
+        entry = jsonlib.loads(buffer[start:end])
+    except jsonlib.JSONDecodeError:
+        return None
+    resource = entry.get('resource') if isinstance(entry, dict) else None
+    return resource.get('resourceType') if isinstance(resource, dict) else None
+
+
+class NdjsonIndex:
+    def __init__(self, path: str, build_index: bool = True):
+        """
+        :param build_index: whether to scan the file; if False, lines can only be read from spans
+            of an index built elsewhere (e.g. by the parent of a worker process).
+        """
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mm = None
+        self.view = None
+        # resourceType -> list of (start, end) offsets of its lines
+        self.spans: dict[str, list[tuple[int, int]]] = {}
+        # Offsets of the lines that aren't valid JSON or have no resource type
+        self.invalid_spans: list[tuple[int, int]] = []
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mm)
+            if build_index:
+                self.build()
+
+    def build(self) -> None:
+        mm = self.mm
+        size = len(mm)
+        start = 0
+        while start < size:
+            end = mm.find(b'\n', start)
+            if end < 0:
+                end = size
+            if end > start:
+                resource_type = scan_resource_type(mm, start, end) or parse_resource_type(mm, start, end)
+                if resource_type:
+                    self.spans.setdefault(resource_type, []).append((start, end))
+                elif mm[start:end].strip():
+                    self.invalid_spans.append((start, end))
+            start = end + 1
+
+    def resource_types(self) -> list[str]:
+        return list(self.spans.keys())
+
+    def count(self, resource_type: str) -> int:
+        return len(self.spans.get(resource_type, []))
+
+    def lines(self, resource_type: str = None, spans: list[tuple[int, int]] = None):
+        """Yields the lines of a resource type (or the given spans) as zero-copy memoryviews."""
+        if self.view is None:
+            return
+        for start, end in (spans if spans is not None else self.spans.get(resource_type, [])):
+            line = self.view[start:end]
+            try:
+                yield line
+            finally:
+                # So the file can be unmapped even if the caller still references the last line
+                line.release()
+
+    def close(self) -> None:
+        if self.view is not None:
+            self.view.release()
+            self.mm.close()
+            self.view = None
+            self.mm = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,14 +1,24 @@
 import sys
 import os
+import logging
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from src.parseFhir import parseFhir # METRIPORT CHANGE FOR CORRECT IMPORT
-import json
+from src.utils import metrics # METRIPORT CHANGE TO EXPOSE METRICS
+from src.utils import jsonlib
+from src.parseNdjsonBundle.ndjsonIndex import NdjsonIndex # METRIPORT CHANGE TO READ FROM A MEMORY-MAPPED FILE
+from src.parseFhir.resourceErrors import ErrorBudgetExceeded, ResourceErrors, get_max_errors # METRIPORT CHANGE FOR DEAD LETTERS
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing
+from typing import Callable
 
 # This script allows you to convert your entire NDJSON FHIR Bundle into CSV output files based on the selected configurations.
 
 # Define base paths
 config_folder = 'src/parseFhir/configurations/'
 output_format = 'csv'
+partial_file_suffix = '.partial'
+dead_letter_file_name = 'dead_letter.ndjson'
 
 def get_resource_type_from_config(config_file):
     """Extract the main resource type from config filename."""
@@ -20,11 +30,95 @@ def get_resource_type_from_config(config_file):
         return name.split('_')[0]
     return name
 
+def get_table_name_from_config(config_file):
+    return config_file.replace('config_', '').replace('.ini', '').lower()
+
+def parse_invalid_line(line):
+    """Raises the reason an NDJSON line has no resource type."""
+    entry = jsonlib.loads(line)
+    if not isinstance(entry, dict) or not isinstance(entry.get('resource'), dict):
+        raise ValueError('Entry has no resource')
+    raise ValueError('Resource has no resourceType')
+
 def ensure_folder_exists(folder_path):
     os.makedirs(folder_path, exist_ok=True)
 
+def parse_config(index: NdjsonIndex, spans: list[tuple[int, int]], config_file: str, outputs_folder: str, resource_errors: ResourceErrors, processed_date: str) -> tuple[str, str, int]:
+    output_name = get_table_name_from_config(config_file)
+    output_file_path = f'{outputs_folder}/{output_name}.{output_format}' # METRIPORT CHANGE TO RETURN LIST OF OUTPUT FILES
+    # METRIPORT CHANGE - written to a partial file that's renamed once complete, so a failed or
+    # retried run never leaves (or appends to) a half-written table
+    partial_file_path = f'{output_file_path}{partial_file_suffix}'
+    if os.path.exists(partial_file_path):
+        os.remove(partial_file_path)
+    # METRIPORT CHANGE - closed so the last line is released even if parsing raises (e.g. the error
+    # budget is exceeded), otherwise the file can't be unmapped
+    with closing(index.lines(spans=spans)) as lines:
+        row_count = parseFhir.parse( # METRIPORT CHANGE TO EXPOSE METRICS
+            configPath=os.path.join(config_folder, config_file),
+            inputPath=index.path,
+            inputFormat='ndjson',
+            inputLines=lines, # METRIPORT CHANGE TO READ FROM THE MEMORY-MAPPED FILE
+            resourceKey='resource',
+            outputPath=partial_file_path,
+            outputFormat=output_format,
+            writeMode='a', # METRIPORT CHANGE FROM WRITE TO APPEND
+            resourceErrors=resource_errors, # METRIPORT CHANGE FOR DEAD LETTERS
+            processedDate=processed_date, # METRIPORT CHANGE FOR RUN-SCOPED CONSTANTS
+        )
+    os.replace(partial_file_path, output_file_path)
+    return output_file_path, output_name, row_count or 0
+
+# Count of failed resources shared by the worker processes, see init_worker
+worker_error_count = None
+
+def init_worker(error_count) -> None:
+    global worker_error_count
+    worker_error_count = error_count
+
+def parse_configs_in_worker(input_path: str, spans: list[tuple[int, int]], config_files: list[str], outputs_folder: str, processed_date: str) -> tuple[list[tuple[str, str, int]], ResourceErrors]:
+    """
+    Parses the configs of one resource type, so a resource failing in several of them is counted
+    once. Returns the results of the configs parsed before the error budget was exceeded, if it was.
+    """
+    resource_errors = ResourceErrors(max_errors=get_max_errors(), shared_count=worker_error_count)
+    results = []
+    # The file is mapped again in the worker, the OS shares the pages so it's not copied
+    with NdjsonIndex(input_path, build_index=False) as index:
+        try:
+            for config_file in config_files:
+                # Stops early if other workers exceeded the budget
+                resource_errors.check_budget()
+                results.append(parse_config(index, spans, config_file, outputs_folder, resource_errors, processed_date))
+        except ErrorBudgetExceeded:
+            # The dead letters still reach the parent, merging them raises ErrorBudgetExceeded there
+            pass
+    return results, resource_errors
+
+def write_resource_errors(resource_errors: ResourceErrors, outputs_folder: str) -> None:
+    for error, count in resource_errors.counts.items():
+        metrics.resource_errors_total.labels(exception=error).inc(count) # METRIPORT CHANGE TO EXPOSE METRICS
+    if len(resource_errors) > 0:
+        dead_letter_count = resource_errors.write_dead_letters(os.path.join(outputs_folder, dead_letter_file_name))
+        logging.warning('%s resources failed to parse (%s), %s written to %s', len(resource_errors),
+                        dict(resource_errors.counts), dead_letter_count, dead_letter_file_name)
+
 # METRIPORT CHANGE FROM INLINE TO FUNCTION
-def parse(input_path: str, outputs_folder: str) -> list[str]:
+def parse(input_path: str, outputs_folder: str, max_workers: int = None, skip_tables: set[str] = None, processed_date: str = None, on_table_parsed: Callable[[str], None] = None) -> list[str]:
+    """
+    :param skip_tables: names of the output tables not to parse, e.g. already uploaded by a
+        previous attempt.
+    :param processed_date: value of the processed_date column of all output files, defaults to now.
+    :param on_table_parsed: called with the path of each output file as soon as it's complete, e.g.
+        to upload it while the other tables are parsed.
+
+    Resources that fail to parse are written to dead_letter.ndjson in outputs_folder (not part of
+    the returned files). If more than MAX_RESOURCE_ERRORS fail, ErrorBudgetExceeded is raised.
+    :param max_workers: number of processes to parse resource types (their configs) in parallel, defaults to the
+        PARSE_WORKERS env var or 1 (in-process). Lambda doesn't support process pools.
+    """
+    max_workers = max_workers or int(os.getenv('PARSE_WORKERS') or 1)
+
     # First, group config files by their base resource type
     config_groups = {}
     for config_file in os.listdir(config_folder):
@@ -34,37 +128,77 @@ def parse(input_path: str, outputs_folder: str) -> list[str]:
                 config_groups[resource_type] = []
             config_groups[resource_type].append(config_file)
 
+    ensure_folder_exists(outputs_folder)
     output_files = [] # METRIPORT CHANGE TO RETURN LIST OF OUTPUT FILES
-    # Process each resource type separately
-    for resource_type, config_files in config_groups.items():
-        # First, filter the input file for just this resource type
-        filtered_input = f'{outputs_folder}/temp_{resource_type.lower()}.ndjson'
-        
-        ensure_folder_exists(outputs_folder)
-        with open(input_path, 'r') as infile, open(filtered_input, 'w') as outfile:
-            for line in infile:
+    resource_errors = ResourceErrors(max_errors=get_max_errors()) # METRIPORT CHANGE FOR DEAD LETTERS
+    processed_date = processed_date or parseFhir.get_processed_date() # METRIPORT CHANGE - THE SAME FOR ALL FILES OF THE RUN
+    # METRIPORT CHANGE - the dead letters are written even if the error budget is exceeded, they're
+    # the only evidence of why the patient was aborted
+    try:
+        # METRIPORT CHANGE - index the lines of each resource type once instead of filtering the whole
+        # input into a temp file per resource type
+        with NdjsonIndex(input_path) as index:
+            # METRIPORT CHANGE FOR DEAD LETTERS - lines that aren't valid JSON used to be skipped silently
+            for invalid_line in index.lines(spans=index.invalid_spans):
                 try:
-                    resource = json.loads(line)
-                    if resource['resource'].get('resourceType') == resource_type:
-                        outfile.write(json.dumps(resource['resource']) + '\n')
-                except json.JSONDecodeError:
-                    continue
-
-        # Now process each config file for this resource type using the filtered input
-        for config_file in config_files:
-            output_name = config_file.replace('config_', '').replace('.ini', '').lower()
-            output_file_path = f'{outputs_folder}/{output_name}.{output_format}' # METRIPORT CHANGE TO RETURN LIST OF OUTPUT FILES
-            output_files.append(output_file_path) # METRIPORT CHANGE TO RETURN LIST OF OUTPUT FILES
-            parseFhir.parse(
-                configPath=os.path.join(config_folder, config_file),
-                inputPath=filtered_input,
-                inputFormat='ndjson',
-                outputPath=output_file_path, # METRIPORT CHANGE TO RETURN LIST OF OUTPUT FILES
-                outputFormat=output_format,
-                writeMode='a' # METRIPORT CHANGE FROM WRITE TO APPEND
-            )
-    
-        # Clean up temporary file
-        os.remove(filtered_input)
+                    parse_invalid_line(invalid_line)
+                except Exception as e:
+                    resource_errors.record(input_path, invalid_line, e)
+            # METRIPORT CHANGE - one task per resource type, so a resource failing in several of its
+            # configs is counted once against the error budget
+            tasks = []
+            for resource_type, config_files in config_groups.items():
+                config_files = [
+                    config_file for config_file in config_files
+                    if not skip_tables or get_table_name_from_config(config_file) not in skip_tables
+                ]
+                if config_files:
+                    tasks.append((index.spans.get(resource_type, []), config_files))
+            results = []
+            if max_workers > 1:
+                # Shared by the workers so the budget applies to all of them, and they stop early once
+                # it's exceeded
+                error_count = multiprocessing.Value('i', len(resource_errors))
+                resource_errors.shared_count = error_count
+                with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(error_count,)) as executor:
+                    futures = [
+                        executor.submit(parse_configs_in_worker, input_path, spans, config_files, outputs_folder, processed_date)
+                        for spans, config_files in tasks
+                    ]
+                    try:
+                        for future in as_completed(futures):
+                            if future.cancelled():
+                                continue
+                            worker_results, worker_resource_errors = future.result()
+                            # Merged even once the budget is exceeded, so the dead letters of the
+                            # workers still running aren't lost
+                            resource_errors.merge(worker_resource_errors, check=False)
+                            results.extend(worker_results)
+                            if on_table_parsed:
+                                for output_file_path, _, _ in worker_results:
+                                    on_table_parsed(output_file_path)
+                            if resource_errors.over_budget():
+                                for pending in futures:
+                                    pending.cancel()
+                    except BaseException:
+                        for future in futures:
+                            future.cancel()
+                        raise
+                    finally:
+                        resource_errors.shared_count = None
+                resource_errors.check_budget()
+            else:
+                for spans, config_files in tasks:
+                    for config_file in config_files:
+                        result = parse_config(index, spans, config_file, outputs_folder, resource_errors, processed_date)
+                        results.append(result)
+                        if on_table_parsed:
+                            on_table_parsed(result[0])
+    finally:
+        write_resource_errors(resource_errors, outputs_folder)
+
+    for output_file_path, output_name, row_count in results:
+        output_files.append(output_file_path) # METRIPORT CHANGE TO RETURN LIST OF OUTPUT FILES
+        metrics.rows_total.labels(table=output_name).inc(row_count) # METRIPORT CHANGE TO EXPOSE METRICS
 
     return output_files
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Runs SQL over fhir-to-csv tables locally, with DuckDB, to validate transforms or run cohort checks
+without loading them into the DWH.
+
+Tables can come from:
+- output folders: every <table>.csv/.parquet under them (recursively, so a folder with many
+  patients' outputs works too) becomes a view named after the table
+- NDJSON bundles: each configuration is run over the bundle (the 'return' output format, so
+  columns are typed) and registered as a table
+
+Usage:
+    python -m src.queryOutputs.queryOutputs "SELECT count(*) FROM condition" --outputs <folder>
+    python -m src.queryOutputs.queryOutputs "SELECT * FROM observation LIMIT 5" --ndjson <bundle.ndjson>
+"""
+
+import os
+import sys
+import argparse
+from collections import defaultdict
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from src.loadToDwh.loadToDwh import get_table_columns
+from src.parseFhir import parseFhir
+from src.parseNdjsonBundle.ndjsonIndex import NdjsonIndex
+from src.parseNdjsonBundle.parseNdjsonBundle import config_folder, get_resource_type_from_config, get_table_name_from_config
+
+output_extensions = [".csv", ".parquet"]
+
+
+def connect(database: str = ":memory:"):
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError("Please install duckdb to query the outputs.")
+    return duckdb.connect(database)
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def quote_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def find_output_files(outputs_folder: str) -> dict[tuple[str, str], list[str]]:
+    """(table name, extension) -> output files, across all subfolders."""
+    files = defaultdict(list)
+    for root, _, file_names in os.walk(outputs_folder):
+        for file_name in sorted(file_names):
+            table_name, extension = os.path.splitext(file_name)
+            if extension in output_extensions:
+                files[(table_name.lower(), extension)].append(os.path.join(root, file_name))
+    return files
+
+
+def register_outputs(connection, outputs_folder: str) -> list[str]:
+    """Creates a view per output table in the folder, returns their names."""
+    tables = []
+    for (table_name, extension), paths in find_output_files(outputs_folder).items():
+        file_list = "[" + ", ".join(quote_literal(path) for path in paths) + "]"
+        if extension == ".parquet":
+            select = f"SELECT * FROM read_parquet({file_list}, union_by_name = true)"
+        else:
+            # Written without a header, quoting every value: quotes are doubled and backslashes
+            # escaped with a backslash (csv.writer with escapechar='\\')
+            table_columns = get_table_columns(table_name)
+            columns = ", ".join(f"{quote_literal(column)}: 'VARCHAR'" for column in table_columns)
+            unescaped_columns = ", ".join(
+                f"replace({quote_identifier(column)}, '\\\\', '\\') AS {quote_identifier(column)}"
+                for column in table_columns
+            )
+            select = (
+                f"SELECT {unescaped_columns} FROM read_csv({file_list}, auto_detect = false, header = false, "
+                f"delim = ',', quote = '\"', escape = '\"', columns = {{{columns}}})"
+            )
+        connection.execute(f"CREATE OR REPLACE VIEW {quote_identifier(table_name)} AS {select}")
+        tables.append(table_name)
+    return tables
+
+
+def register_ndjson(connection, ndjson_path: str) -> list[str]:
+    """Runs every configuration over an NDJSON bundle and registers the results as tables."""
+    tables = []
+    with NdjsonIndex(ndjson_path) as index:
+        for config_file in sorted(os.listdir(config_folder)):
+            if not config_file.endswith(".ini"):
+                continue
+            table_name = get_table_name_from_config(config_file)
+            spans = index.spans.get(get_resource_type_from_config(config_file), [])
+            dataframe = parseFhir.parse(
+                configPath=os.path.join(config_folder, config_file),
+                inputPath=ndjson_path,
+                inputFormat="ndjson",
+                inputLines=index.lines(spans=spans),
+                resourceKey="resource",
+                outputFormat="return",
+            )
+            connection.register(f"{table_name}_dataframe", dataframe)
+            connection.execute(
+                f"CREATE OR REPLACE TABLE {quote_identifier(table_name)} AS SELECT * FROM {quote_identifier(table_name + '_dataframe')}"
+            )
+            connection.unregister(f"{table_name}_dataframe")
+            tables.append(table_name)
+    return tables
+
+
+def query(sql: str, outputs_folders: list[str] = None, ndjson_paths: list[str] = None, connection=None):
+    """Runs a query over output folders and/or NDJSON bundles, returns a pandas DataFrame."""
+    connection = connection or connect()
+    for outputs_folder in outputs_folders or []:
+        register_outputs(connection, outputs_folder)
+    for ndjson_path in ndjson_paths or []:
+        register_ndjson(connection, ndjson_path)
+    return connection.execute(sql).df()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run SQL over fhir-to-csv outputs or NDJSON bundles.")
+    parser.add_argument("sql", help="query to run, tables are named after the configurations (e.g. condition)")
+    parser.add_argument("--outputs", action="append", help="folder of output files (.csv/.parquet)")
+    parser.add_argument("--ndjson", action="append", help="NDJSON bundle to transform and query")
+    parser.add_argument("--database", default=":memory:", help="DuckDB database file, to keep the tables")
+    parser.add_argument("--output", help="write the result to this CSV file instead of printing it")
+    args = parser.parse_args()
+    if not args.outputs and not args.ndjson:
+        parser.error("at least one of --outputs or --ndjson is required")
+
+    connection = connect(args.database)
+    try:
+        result = query(args.sql, args.outputs, args.ndjson, connection)
+    finally:
+        connection.close()
+    if args.output:
+        result.to_csv(args.output, index=False)
+        print(f"{len(result)} rows written to {args.output}")
+    else:
+        import pandas as pd
+        with pd.option_context("display.max_rows", 100, "display.max_columns", 20, "display.width", 200):
+            print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import os
+import time
+import threading
+from src.utils import jsonlib
+
+# Checkpoint of a patient's transform, stored in S3 next to its output files so a retry (e.g. after
+# S3 throttling or a Lambda timeout) only parses and uploads the tables that weren't uploaded yet.
+#
+# The checkpoint is tied to the ETag of the input bundle: if the bundle changed since the failed
+# attempt, it's discarded and the transform starts over.
+
+checkpoint_file_name = '_checkpoint.json'
+# Saving after every uploaded table would double the PUTs of a transform, saved at most this often
+default_save_interval_seconds = 10
+
+
+def create_checkpoint_key(pt_output_file_prefix: str) -> str:
+    return f"{pt_output_file_prefix}/{checkpoint_file_name}"
+
+
+class Checkpoint:
+    def __init__(self, s3_client, bucket: str, key: str, bundle_etag: str, save_interval_seconds: float = None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.bundle_etag = bundle_etag
+        self.save_interval_seconds = save_interval_seconds if save_interval_seconds is not None else float(
+            os.getenv("CHECKPOINT_INTERVAL_SECONDS") or default_save_interval_seconds
+        )
+        # table name -> (bucket, file key, table name) of its uploaded output file
+        self.uploaded_tables: dict[str, tuple[str, str, str]] = {}
+        # Whether all tables were uploaded, only the DWH load is left
+        self.uploaded = False
+        self.last_saved_at = 0.0
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self) -> "Checkpoint":
+        """Loads the checkpoint of a previous attempt, if any and for the same bundle."""
+        try:
+            body = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)["Body"]
+        except self.s3_client.exceptions.NoSuchKey:
+            return self
+        try:
+            state = jsonlib.loads(body.read())
+        finally:
+            body.close()
+        if state.get("bundleEtag") != self.bundle_etag:
+            print(f"Ignoring checkpoint {self.key}, the bundle changed since it was saved")
+            return self
+        self.uploaded_tables = {
+            table_name: (bucket, file_key, table_name)
+            for bucket, file_key, table_name in state.get("uploadedTables", [])
+        }
+        self.uploaded = bool(state.get("uploaded"))
+        print(f"Resuming from checkpoint {self.key}, {len(self.uploaded_tables)} tables already uploaded")
+        return self
+
+    def is_uploaded(self, table_name: str) -> bool:
+        return table_name in self.uploaded_tables
+
+    def mark_uploaded(self, bucket: str, file_key: str, table_name: str) -> None:
+        with self.lock:
+            self.uploaded_tables[table_name] = (bucket, file_key, table_name)
+            self.dirty = True
+        if time.time() - self.last_saved_at >= self.save_interval_seconds:
+            self.save()
+
+    def mark_all_uploaded(self) -> None:
+        with self.lock:
+            self.uploaded = True
+            self.dirty = True
+        self.save()
+
+    def save(self) -> None:
+        with self.lock:
+            if not self.dirty:
+                return
+            state = {
+                "bundleEtag": self.bundle_etag,
+                "uploadedTables": list(self.uploaded_tables.values()),
+                "uploaded": self.uploaded,
+            }
+            self.dirty = False
+            self.last_saved_at = time.time()
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=jsonlib.dumps_bytes(state))
+
+    def delete(self) -> None:
+        """Removes the checkpoint once the transform is done, so the next run starts from scratch."""
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self.key)
@@ -2,6 +2,7 @@ from enum import Enum
 
 class DWH(Enum):
     SNOWFLAKE = "snowflake"
+    POSTGRES = "postgres"
 
     def __str__(self) -> str:
         return self.value
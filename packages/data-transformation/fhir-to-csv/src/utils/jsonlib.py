@@ -0,0 +1,73 @@
+import os
+import re
+import json
+import codecs
+
+# JSON decoding/encoding used across fhir-to-csv. Uses orjson when it's installed - it's several
+# times faster than the stdlib on large bundles and decodes bytes directly, without the UTF-8
+# decode step - and falls back to the stdlib otherwise. Set JSON_BACKEND=stdlib to force the
+# stdlib.
+
+STDLIB = "stdlib"
+ORJSON = "orjson"
+
+# orjson.JSONDecodeError is a subclass of this one, so callers can catch a single exception type
+JSONDecodeError = json.JSONDecodeError
+
+_orjson = None
+if (os.getenv("JSON_BACKEND") or ORJSON) == ORJSON:
+    try:
+        import orjson as _orjson
+    except ImportError:
+        _orjson = None
+
+backend = ORJSON if _orjson is not None else STDLIB
+
+# orjson only decodes integers that fit in 64 bits, some versions silently turn larger ones into
+# floats. A run of 20+ digits might be one (2**64 has 20 digits), such documents are decoded by
+# the stdlib, which keeps them exact. Digits inside strings match too, they're just decoded slower
+_long_digits_bytes = re.compile(rb"\d{20}")
+_long_digits_str = re.compile(r"\d{20}")
+
+
+def _may_have_big_int(data: bytes | memoryview | str) -> bool:
+    pattern = _long_digits_str if isinstance(data, str) else _long_digits_bytes
+    return pattern.search(data) is not None
+
+
+def strip_bom(data: bytes | memoryview | str) -> bytes | str:
+    if isinstance(data, (bytearray, memoryview)):
+        data = bytes(data)
+    if isinstance(data, bytes):
+        return data[len(codecs.BOM_UTF8):] if data.startswith(codecs.BOM_UTF8) else data
+    return data[1:] if data.startswith("\ufeff") else data
+
+
+def loads(data: bytes | memoryview | str):
+    """Decodes a JSON document, from bytes-like objects (preferred) or str."""
+    if _orjson is not None and not _may_have_big_int(data):
+        try:
+            return _orjson.loads(data)
+        except _orjson.JSONDecodeError:
+            # orjson is stricter than the stdlib (e.g. NaN, BOM), retry there before giving up
+            pass
+    return json.loads(strip_bom(data))
+
+
+def load(fp):
+    return loads(fp.read())
+
+
+def dumps_bytes(obj) -> bytes:
+    """Encodes to a single line of UTF-8 JSON."""
+    if _orjson is not None:
+        try:
+            return _orjson.dumps(obj)
+        except _orjson.JSONEncodeError:
+            # E.g. an integer larger than 64 bits, see loads
+            pass
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def dumps(obj) -> str:
+    return dumps_bytes(obj).decode("utf-8")
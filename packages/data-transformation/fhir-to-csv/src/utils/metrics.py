@@ -0,0 +1,47 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Metrics of the transform, exposed by the HTTP server on /metrics. Kept in the default registry, so
+# they're a cheap no-op when running as a Lambda or from the CLI.
+
+# Stages: download, to_ndjson, parse, upload, load
+stage_duration_seconds = Histogram(
+    "fhir_to_csv_stage_duration_seconds",
+    "Duration of each stage of the transform",
+    ["stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+rows_total = Counter(
+    "fhir_to_csv_rows_total",
+    "Rows emitted, per output table",
+    ["table"],
+)
+bundle_bytes = Histogram(
+    "fhir_to_csv_bundle_bytes",
+    "Size of the input bundles",
+    buckets=(10_000, 100_000, 1_000_000, 10_000_000, 50_000_000, 100_000_000, 500_000_000, 1_000_000_000),
+)
+resources_total = Counter(
+    "fhir_to_csv_resources_total",
+    "Resources in the input bundles, per resource type",
+    ["resource_type"],
+)
+s3_transfer_seconds = Histogram(
+    "fhir_to_csv_s3_transfer_seconds",
+    "Latency of S3 transfers",
+    ["operation"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+jobs_in_flight = Gauge(
+    "fhir_to_csv_jobs_in_flight",
+    "Transform jobs currently running",
+)
+errors_total = Counter(
+    "fhir_to_csv_errors_total",
+    "Failed transforms, per exception class",
+    ["exception"],
+)
+resource_errors_total = Counter(
+    "fhir_to_csv_resource_errors_total",
+    "Resources that failed to parse, per exception class",
+    ["exception"],
+)
@@ -0,0 +1,106 @@
+import io
+
+import pytest
+
+import main
+from src.utils import jsonlib
+from src.utils.checkpoint import Checkpoint
+
+checkpoint_key = "outputs/pt=patient/_checkpoint.json"
+bundle = {
+    "resourceType": "Bundle",
+    "entry": [
+        {"resource": {"resourceType": "Patient", "id": "patient"}},
+        {"resource": {"resourceType": "Condition", "id": "1", "code": {"text": "Asthma"}}},
+    ],
+}
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class ClientError(Exception):
+    pass
+
+
+class Body(io.BytesIO):
+    def iter_chunks(self, chunk_size):
+        while chunk := self.read(chunk_size):
+            yield chunk
+
+
+class FakeS3:
+    """The S3 calls of a transform, in memory. Uploads of keys containing `fail_upload` fail."""
+
+    class exceptions:
+        NoSuchKey = NoSuchKey
+        ClientError = ClientError
+
+    def __init__(self, fail_upload: str = None):
+        self.objects = {"bundle": jsonlib.dumps_bytes(bundle)}
+        self.fail_upload = fail_upload
+        self.uploaded_keys = []
+
+    def get_object(self, Bucket, Key, IfMatch=None):
+        if Key not in self.objects:
+            raise NoSuchKey(Key)
+        return {"Body": Body(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def upload_fileobj(self, file, bucket, key):
+        if self.fail_upload and self.fail_upload in key:
+            raise RuntimeError("Slow down")
+        self.objects[key] = file.read()
+        self.uploaded_keys.append(key)
+
+
+def transform(s3, monkeypatch) -> list[tuple[str, str, str]]:
+    monkeypatch.setattr(main, "s3_client", s3)
+    monkeypatch.setattr(main, "create_consolidated_key", lambda cx_id, patient_id: "bundle")
+    # Saved only when the transform ends, so a resume relies on the save on failure
+    checkpoint = Checkpoint(s3, "output-bucket", checkpoint_key, "etag", save_interval_seconds=3600).load()
+    return main.transform_and_upload_data("input-bucket", "output-bucket", "cx", "patient", "outputs", checkpoint)
+
+
+def test_checkpoint_is_ignored_when_the_bundle_changed():
+    s3 = FakeS3()
+    checkpoint = Checkpoint(s3, "output-bucket", checkpoint_key, "etag")
+    checkpoint.mark_uploaded("output-bucket", "patient.csv", "patient")
+    checkpoint.save()
+
+    assert Checkpoint(s3, "output-bucket", checkpoint_key, "etag").load().is_uploaded("patient")
+    assert not Checkpoint(s3, "output-bucket", checkpoint_key, "new-etag").load().is_uploaded("patient")
+
+
+def test_failed_transform_resumes_from_the_uploaded_tables(monkeypatch):
+    s3 = FakeS3(fail_upload="_patient_condition.csv")
+
+    with pytest.raises(RuntimeError):
+        transform(s3, monkeypatch)
+
+    saved_tables = {table_name for _, _, table_name in jsonlib.loads(s3.objects[checkpoint_key])["uploadedTables"]}
+    assert "patient" in saved_tables
+    assert "condition" not in saved_tables
+
+    s3.fail_upload = None
+    s3.uploaded_keys = []
+    tables = transform(s3, monkeypatch)
+
+    # Only the table that failed to upload is uploaded again
+    assert [key for key in s3.uploaded_keys if key.endswith(".csv")] == [
+        "outputs/pt=patient/_tmp_fhir-to-csv_output_cx_patient_condition.csv"
+    ]
+    assert len(tables) == len(saved_tables) + 1
+
+
+def test_uploaded_transform_is_not_done_again(monkeypatch):
+    s3 = FakeS3()
+    transform(s3, monkeypatch)
+    s3.uploaded_keys = []
+
+    transform(s3, monkeypatch)
+
+    assert s3.uploaded_keys == []
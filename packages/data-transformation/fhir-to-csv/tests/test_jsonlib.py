@@ -0,0 +1,13 @@
+from src.utils import jsonlib
+
+big_int = 2**64 + 1
+
+
+def test_big_integers_are_decoded_exactly():
+    document = jsonlib.loads(f'{{"resource": {{"value": {big_int}}}}}'.encode('utf-8'))
+
+    assert document == {"resource": {"value": big_int}}
+
+
+def test_big_integers_are_encoded_exactly():
+    assert jsonlib.loads(jsonlib.dumps_bytes({"value": big_int})) == {"value": big_int}
@@ -0,0 +1,54 @@
+import csv
+import io
+
+from src.loadToDwh import loadToDwh
+
+# The values of a row as fhir-to-csv writes them, see parseFhir.parse
+values = ['c\\d', 'say "hi"', None, 'a,b', 'line\nbreak']
+
+
+def write_fhir_to_csv(rows) -> bytes:
+    output = io.StringIO()
+    writer = csv.writer(output, delimiter=',', escapechar='\\', quoting=csv.QUOTE_ALL)
+    for row in rows:
+        writer.writerow(row)
+    return output.getvalue().encode('utf-8')
+
+
+def read_as_postgres(data: str) -> list[list]:
+    """Rows as Postgres' COPY ... WITH (FORMAT csv, FORCE_NULL (...)) reads them, empty values as NULL."""
+    return [[value if value != '' else None for value in row] for row in csv.reader(io.StringIO(data))]
+
+
+def test_postgres_csv_round_trip():
+    body = io.BytesIO(write_fhir_to_csv([values, values]))
+
+    data = loadToDwh.PostgresCsvFile(body).read()
+
+    assert read_as_postgres(data) == [values, values]
+
+
+def test_postgres_csv_read_in_chunks():
+    body = io.BytesIO(write_fhir_to_csv([values] * 100))
+    postgres_csv = loadToDwh.PostgresCsvFile(body)
+
+    chunks = []
+    while chunk := postgres_csv.read(64):
+        assert len(chunk) <= 64
+        chunks.append(chunk)
+
+    assert read_as_postgres(''.join(chunks)) == [values] * 100
+
+
+def test_postgres_copy_loads_empty_values_as_null():
+    columns = ", ".join(loadToDwh.get_table_columns('patient'))
+
+    copy_sql = loadToDwh.get_postgres_copy_sql('patient')
+
+    assert copy_sql == f"COPY patient ({columns}) FROM STDIN WITH (FORMAT csv, FORCE_NULL ({columns}))"
+
+
+def test_snowflake_files_are_quoted():
+    quoted = loadToDwh.quote_snowflake_string("pt=1/o'brien\\condition.csv")
+
+    assert quoted == "'pt=1/o\\'brien\\\\condition.csv'"
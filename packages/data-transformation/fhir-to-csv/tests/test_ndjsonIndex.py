@@ -0,0 +1,38 @@
+from src.parseNdjsonBundle.ndjsonIndex import NdjsonIndex
+
+condition = b'{"resource": {"resourceType": "Condition", "id": "1"}}'
+# Cut off mid-resource, e.g. a partial upload
+truncated_condition = b'{"resource": {"resourceType": "Condition", "id": "2", "code'
+not_json = b'not json'
+no_resource_type = b'{"resource": {"id": "3"}}'
+
+
+def write_ndjson(tmp_path, lines: list[bytes]) -> str:
+    path = tmp_path / "bundle.ndjson"
+    path.write_bytes(b"\n".join(lines) + b"\n")
+    return str(path)
+
+
+def read_lines(index: NdjsonIndex, **kwargs) -> list[bytes]:
+    return [bytes(line) for line in index.lines(**kwargs)]
+
+
+def test_truncated_line_is_indexed_under_its_resource_type(tmp_path):
+    with NdjsonIndex(write_ndjson(tmp_path, [condition, truncated_condition])) as index:
+        assert read_lines(index, resource_type="Condition") == [condition, truncated_condition]
+        assert index.invalid_spans == []
+
+
+def test_lines_without_a_resource_type_are_invalid(tmp_path):
+    with NdjsonIndex(write_ndjson(tmp_path, [not_json, condition, b"", no_resource_type])) as index:
+        assert index.resource_types() == ["Condition"]
+        assert read_lines(index, spans=index.invalid_spans) == [not_json, no_resource_type]
+
+
+def test_empty_file_has_no_lines(tmp_path):
+    path = tmp_path / "empty.ndjson"
+    path.write_bytes(b"")
+
+    with NdjsonIndex(str(path)) as index:
+        assert index.resource_types() == []
+        assert read_lines(index, resource_type="Condition") == []
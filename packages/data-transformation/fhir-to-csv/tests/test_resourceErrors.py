@@ -0,0 +1,97 @@
+import multiprocessing
+
+import pytest
+
+from src.parseFhir.resourceErrors import ErrorBudgetExceeded, ResourceErrors
+from src.parseNdjsonBundle import parseNdjsonBundle
+from src.utils import jsonlib
+
+# Condition has two configurations (Condition and Condition_code_coding), each fails on these
+truncated_conditions = [
+    b'{"resource": {"resourceType": "Condition", "id": "1", "code',
+    b'{"resource": {"resourceType": "Condition", "id": "2", "code',
+]
+patient = b'{"resource": {"resourceType": "Patient", "id": "p"}}'
+
+
+def record(resource_errors: ResourceErrors, config: str, line: bytes) -> None:
+    try:
+        jsonlib.loads(line)
+    except ValueError as e:
+        resource_errors.record(config, line, e)
+
+
+def test_line_failing_in_several_configs_is_counted_once():
+    resource_errors = ResourceErrors(max_errors=1)
+
+    record(resource_errors, "config_Condition.ini", truncated_conditions[0])
+    record(resource_errors, "config_Condition_code_coding.ini", truncated_conditions[0])
+
+    assert len(resource_errors) == 1
+    assert sum(resource_errors.counts.values()) == 1
+
+
+def test_budget_is_exceeded_above_max_errors():
+    resource_errors = ResourceErrors(max_errors=1)
+    record(resource_errors, "config_Condition.ini", truncated_conditions[0])
+
+    with pytest.raises(ErrorBudgetExceeded):
+        record(resource_errors, "config_Condition.ini", truncated_conditions[1])
+
+
+def test_merge_counts_each_line_once():
+    resource_errors = ResourceErrors()
+    record(resource_errors, "config_Condition.ini", truncated_conditions[0])
+    worker_resource_errors = ResourceErrors()
+    for line in truncated_conditions:
+        record(worker_resource_errors, "config_Condition_code_coding.ini", line)
+
+    resource_errors.merge(worker_resource_errors)
+
+    assert len(resource_errors) == 2
+
+
+def test_budget_is_shared_by_collectors_sharing_the_count():
+    shared_count = multiprocessing.Value('i', 0)
+    first = ResourceErrors(max_errors=1, shared_count=shared_count)
+    second = ResourceErrors(max_errors=1, shared_count=shared_count)
+    record(first, "config_Condition.ini", truncated_conditions[0])
+
+    with pytest.raises(ErrorBudgetExceeded):
+        record(second, "config_Condition.ini", truncated_conditions[1])
+    assert shared_count.value == 2
+
+
+def write_bundle(tmp_path) -> str:
+    path = tmp_path / "bundle.ndjson"
+    path.write_bytes(b"\n".join([patient, *truncated_conditions]) + b"\n")
+    return str(path)
+
+
+def read_dead_letters(outputs_folder) -> list[dict]:
+    with open(outputs_folder / parseNdjsonBundle.dead_letter_file_name, "rb") as f:
+        return [jsonlib.loads(line) for line in f]
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_parse_within_budget_writes_the_dead_letters(tmp_path, monkeypatch, max_workers):
+    monkeypatch.setenv("MAX_RESOURCE_ERRORS", "2")
+    outputs_folder = tmp_path / "outputs"
+
+    output_files = parseNdjsonBundle.parse(write_bundle(tmp_path), str(outputs_folder), max_workers=max_workers)
+
+    assert f"{outputs_folder}/patient.csv" in output_files
+    dead_letters = read_dead_letters(outputs_folder)
+    assert len(dead_letters) == 2
+    assert sorted(dead_letters[0]["configs"]) == ["config_Condition.ini", "config_Condition_code_coding.ini"]
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_parse_over_budget_raises_and_writes_the_dead_letters(tmp_path, monkeypatch, max_workers):
+    monkeypatch.setenv("MAX_RESOURCE_ERRORS", "1")
+    outputs_folder = tmp_path / "outputs"
+
+    with pytest.raises(ErrorBudgetExceeded):
+        parseNdjsonBundle.parse(write_bundle(tmp_path), str(outputs_folder), max_workers=max_workers)
+
+    assert len(read_dead_letters(outputs_folder)) == 2
@@ -1,17 +1,55 @@
+import hashlib
 import json
+import time
 
 from canvas_workflow_kit.constants import CHANGE_TYPE
 from canvas_workflow_kit.protocol import (STATUS_NOT_APPLICABLE,
                                           ClinicalQualityMeasure,
                                           ProtocolResult)
 from canvas_workflow_kit.utils import send_notification
-from canvas_workflow_kit.fhir import FumageHelper
+
+# When clinics book many appointments at once, most of them are for patients already sent to
+# Metriport: the patient IDs resolved and the document queries triggered are kept for as long as
+# the protocol's process lives, so those appointments don't create the patient or query documents again.
+PATIENT_ID_TTL_SECONDS = 24 * 60 * 60
+DOCUMENT_QUERY_WINDOW_SECONDS = 60 * 60
+MAX_CACHED_PATIENTS = 10000
+
+# (Metriport facility ID, API key hash, Canvas patient key) -> (Metriport patient ID, when it was resolved).
+# The process can serve protocols set up with other facilities or API keys, their patients are their own
+_patient_ids = {}
+# Metriport patient ID -> (True, when its last document query was triggered)
+_document_queries = {}
+
+
+def _get_recent(cache, key, max_age_seconds):
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    if time.time() - entry[1] > max_age_seconds:
+        del cache[key]
+        return None
+    return entry
+
+
+def _patient_cache_key(api_key, facility_id, external_id):
+    # Hashed, the API key itself isn't kept in the cache
+    api_key_hash = hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()
+    return (facility_id, api_key_hash, external_id)
+
+
+def _remember(cache, key, value):
+    cache.pop(key, None)
+    cache[key] = value
+    # Oldest first, dicts keep the insertion order
+    while len(cache) > MAX_CACHED_PATIENTS:
+        del cache[next(iter(cache))]
 
 
 class AppointmentNotification2(ClinicalQualityMeasure):
     class Meta:
         title = 'Appointment Creation Notification'
-        version = 'v1.2.8'
+        version = 'v1.2.9'
         description = 'Listens for appointment creation and sends a notification.'
         types = ['Notification']
         compute_on_change_types = [CHANGE_TYPE.APPOINTMENT]
@@ -25,12 +63,6 @@ class AppointmentNotification2(ClinicalQualityMeasure):
         changed_model = self.field_changes.get('model_name', '')
 
         if changed_model == 'appointment' and self.field_changes.get('created'):
-            fhir = FumageHelper(self.settings)
-
-            response = fhir.read("Appointment", self.field_changes.get('external_id'))
-            if response.status_code != 200:
-                raise Exception("Failed to search Appointments")
-
             patient_data = self.patient.patient
 
             payload = {
@@ -63,21 +95,36 @@ class AppointmentNotification2(ClinicalQualityMeasure):
             provider_name = self.settings.get("CANVAS_PROVIDER_NAME")
 
 
-            pd_response = send_notification(
-                f'{base_url}/medical/v1/patient?facilityId={metriport_facility_id}',
-                json.dumps(payload),
-                headers={
-                    'Content-Type': 'application/json',
-                    'x-api-key': metriport_api_key
-                })
-        
-            pd_response_data = pd_response.json()
-            patient_id = pd_response_data.get('id')
-            result.add_narrative(json.dumps({
-                'patient': pd_response_data
-            }))
+            external_id = payload["externalId"]
+            patient_cache_key = _patient_cache_key(metriport_api_key, metriport_facility_id, external_id)
+            cached_patient = _get_recent(_patient_ids, patient_cache_key, PATIENT_ID_TTL_SECONDS) if external_id else None
+            if cached_patient:
+                patient_id = cached_patient[0]
+                result.add_narrative(json.dumps({
+                    'patient': {'id': patient_id, 'cached': True}
+                }))
+            else:
+                pd_response = send_notification(
+                    f'{base_url}/medical/v1/patient?facilityId={metriport_facility_id}',
+                    json.dumps(payload),
+                    headers={
+                        'Content-Type': 'application/json',
+                        'x-api-key': metriport_api_key
+                    })
+
+                pd_response_data = pd_response.json()
+                patient_id = pd_response_data.get('id')
+                result.add_narrative(json.dumps({
+                    'patient': pd_response_data
+                }))
+                if patient_id and external_id:
+                    _remember(_patient_ids, patient_cache_key, (patient_id, time.time()))
 
             if patient_id:
+                if _get_recent(_document_queries, patient_id, DOCUMENT_QUERY_WINDOW_SECONDS):
+                    result.add_narrative("Document query already triggered recently for this patient")
+                    return result
+
                 metadata = {
                     'metadata': {
                         'canvas': "true",
@@ -93,7 +140,9 @@ class AppointmentNotification2(ClinicalQualityMeasure):
                         'x-api-key': metriport_api_key
                     }
                 )
+                if dq_response.ok:
+                    _remember(_document_queries, patient_id, (True, time.time()))
             else:
                 result.add_narrative("Unable to retrieve patient ID from the response")
 
-        return result
\ No newline at end of file
+        return result
@@ -0,0 +1,132 @@
+"""
+Async client for many patients at once: the generated AsyncMetriport on a pooled httpx client that
+limits the requests in flight and retries rate limited and failed requests.
+
+    async with pooled_async_metriport(api_key, base_url, max_concurrency=50) as metriport:
+        results = await bulk_start_get_document_url(metriport, patient_ids)
+"""
+
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Optional, Union
+
+import httpx
+
+from generated.client import AsyncMetriport
+from generated.resources.medical import BulkGetDocumentUrlQuery
+
+# Responses worth retrying: rate limited or a transient server error
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Requests that can be sent again without side effects if the first one did go through
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"}
+# Errors before the request was sent, any request can be retried after them
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+
+def get_retry_after(response: httpx.Response) -> Optional[float]:
+    """Seconds to wait from the Retry-After header, either a number of seconds or an HTTP date."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryTransport(httpx.AsyncBaseTransport):
+    """
+    Sends at most `max_concurrency` requests at once and retries 429/5xx responses and connection
+    errors, waiting as long as Retry-After says or with exponential backoff.
+
+    Requests that aren't idempotent (e.g. POST to create a patient) are only retried on 429 and when
+    they couldn't connect: after a 5xx or a timeout the server might have done it already.
+    """
+
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        max_concurrency: int = 20,
+        max_retries: int = 3,
+        backoff_seconds: float = 0.5,
+        max_wait_seconds: float = 60,
+    ):
+        self.transport = transport
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_wait_seconds = max_wait_seconds
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        idempotent = request.method in IDEMPOTENT_METHODS
+        retry_status_codes = RETRY_STATUS_CODES if idempotent else {429}
+        retry_errors = httpx.TransportError if idempotent else NOT_SENT_ERRORS
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                async with self.semaphore:
+                    response = await self.transport.handle_async_request(request)
+                if response.status_code not in retry_status_codes or attempt == self.max_retries:
+                    return response
+                retry_after = get_retry_after(response)
+                await response.aclose()
+            except retry_errors:
+                if attempt == self.max_retries:
+                    raise
+            # Waiting happens outside the semaphore, so other requests can go on
+            delay = retry_after if retry_after is not None else self.backoff_seconds * 2**attempt * (1 + random.random())
+            await asyncio.sleep(min(delay, self.max_wait_seconds))
+        raise AssertionError("unreachable")
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+@asynccontextmanager
+async def pooled_async_metriport(
+    api_key: str,
+    base_url: Optional[str] = None,
+    max_concurrency: int = 20,
+    max_connections: int = 100,
+    max_keepalive_connections: int = 20,
+    max_retries: int = 3,
+    timeout: float = 60,
+) -> AsyncIterator[AsyncMetriport]:
+    """An AsyncMetriport whose requests share one connection pool, closed on exit."""
+    transport = RetryTransport(
+        httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+            ),
+        ),
+        max_concurrency=max_concurrency,
+        max_retries=max_retries,
+    )
+    httpx_client = httpx.AsyncClient(transport=transport, timeout=timeout)
+    try:
+        yield AsyncMetriport(api_key=api_key, base_url=base_url, timeout=timeout, httpx_client=httpx_client)
+    finally:
+        await httpx_client.aclose()
+
+
+async def bulk_start_get_document_url(
+    metriport: AsyncMetriport, patient_ids: list[str], metadata: Optional[dict[str, str]] = None
+) -> dict[str, Union[BulkGetDocumentUrlQuery, Exception]]:
+    """
+    Starts the bulk document URL generation of many patients concurrently (as many at once as the
+    client allows), returns the response or the error of each patient.
+    """
+
+    async def start(patient_id: str):
+        return await metriport.medical.document.start_bulk_get_document_url(patient_id=patient_id, request=metadata)
+
+    results = await asyncio.gather(*(start(patient_id) for patient_id in patient_ids), return_exceptions=True)
+    return dict(zip(patient_ids, results))
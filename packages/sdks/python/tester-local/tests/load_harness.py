@@ -0,0 +1,196 @@
+"""
+Load test of the SDK: N patients go through create, match, document query and consolidated query
+concurrently, and the latency percentiles, throughput and error rate of each operation are reported.
+
+Run it against the local stand-in API (see stand_in_server.py) or against BASE_URL:
+
+    python -m tests.load_harness --patients 500 --concurrency 50 --stand-in --report report.json
+"""
+
+import argparse
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+
+from generated.client import Metriport
+from generated.resources import UsState, Address
+from generated.resources.medical import BasePatient, Demographics
+
+load_dotenv()
+
+OPERATIONS = ["create_patient", "match_patient", "start_document_query", "start_consolidated_query"]
+PERCENTILES = [50, 90, 95, 99]
+
+
+def get_percentile(sorted_values: list[float], percentile: float) -> Optional[float]:
+    # Nearest rank
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(percentile / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class LoadTestResults:
+    """Latencies and errors of each operation, recorded from many threads."""
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, Counter] = defaultdict(Counter)
+        self.skipped: Counter = Counter()
+        self.lock = threading.Lock()
+
+    def skip(self, operations: list[str]) -> None:
+        with self.lock:
+            self.skipped.update(operations)
+
+    def measure(self, operation: str, call: Callable):
+        """Runs an operation, recording its latency, returns its result or None if it failed."""
+        start = time.perf_counter()
+        error = None
+        try:
+            return call()
+        except Exception as exc:
+            error = get_error_type(exc)
+            return None
+        finally:
+            latency = time.perf_counter() - start
+            with self.lock:
+                self.latencies[operation].append(latency)
+                if error:
+                    self.errors[operation][error] += 1
+
+    def report(self, duration_seconds: float, config: dict) -> dict:
+        operations = {}
+        for operation in OPERATIONS:
+            latencies = sorted(self.latencies[operation])
+            count = len(latencies)
+            errors = sum(self.errors[operation].values())
+            operations[operation] = {
+                "count": count,
+                "errors": errors,
+                "errorRate": round(errors / count, 4) if count else None,
+                "errorTypes": dict(self.errors[operation]),
+                "skipped": self.skipped[operation],
+                "throughputPerSecond": round(count / duration_seconds, 2) if duration_seconds > 0 else None,
+                "latencyMs": {
+                    **{f"p{p}": to_ms(get_percentile(latencies, p)) for p in PERCENTILES},
+                    "max": to_ms(latencies[-1] if latencies else None),
+                    "mean": to_ms(sum(latencies) / count if count else None),
+                },
+            }
+        return {"config": config, "durationSeconds": round(duration_seconds, 3), "operations": operations}
+
+
+def to_ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def get_error_type(exc: Exception) -> str:
+    # The generated client raises ApiError with the status code of the response
+    status_code = getattr(exc, "status_code", None)
+    return f"HTTP {status_code}" if status_code is not None else type(exc).__name__
+
+
+def get_demographics(index: int) -> dict:
+    """Distinct demographics for each patient of the load test."""
+    return dict(
+        first_name=f"Load{index}",
+        last_name="Tester",
+        dob=f"{1940 + index % 60}-{1 + index % 12:02d}-{1 + index % 28:02d}",
+        gender_at_birth="F" if index % 2 else "M",
+        address=[Address(
+            address_line_1=f"{index} Main St",
+            city="Los Angeles",
+            state=UsState.CA,
+            zip="90001",
+            country="USA",
+        )],
+    )
+
+
+def run_patient(metriport: Metriport, facility_id: str, index: int, results: LoadTestResults) -> None:
+    """The operations of one patient, in order. Once one fails, the following ones are skipped."""
+    demographics = get_demographics(index)
+    patient = results.measure(
+        "create_patient",
+        lambda: metriport.medical.patient.create(facility_id=facility_id, request=BasePatient(**demographics)),
+    )
+    if patient is None:
+        results.skip(OPERATIONS[1:])
+        return
+    results.measure("match_patient", lambda: metriport.medical.patient.match(request=Demographics(**demographics)))
+    results.measure(
+        "start_document_query",
+        lambda: metriport.medical.document.start_query(patient_id=patient.id, facility_id=facility_id),
+    )
+    results.measure(
+        "start_consolidated_query",
+        lambda: metriport.medical.fhir.start_consolidated_query(id=patient.id, conversion_type="json"),
+    )
+
+
+def run_load_test(metriport: Metriport, facility_id: str, patients: int, concurrency: int, config: Optional[dict] = None) -> dict:
+    """Runs `patients` patients through the operations, `concurrency` at a time, and returns the report."""
+    results = LoadTestResults()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # One client for all threads, so they share its connection pool
+        list(executor.map(lambda index: run_patient(metriport, facility_id, index, results), range(patients)))
+    duration = time.perf_counter() - start
+    return results.report(duration, {"patients": patients, "concurrency": concurrency, **(config or {})})
+
+
+def print_report(report: dict) -> None:
+    print(f"{report['config']['patients']} patients, concurrency {report['config']['concurrency']}, {report['durationSeconds']}s")
+    for operation, stats in report["operations"].items():
+        latency = stats["latencyMs"]
+        print(
+            f"  {operation}: {stats['count']} calls, {stats['throughputPerSecond']}/s, "
+            f"errors {stats['errors']} ({stats['errorRate']}), "
+            f"p50 {latency['p50']}ms p90 {latency['p90']}ms p99 {latency['p99']}ms max {latency['max']}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the SDK and the Metriport API.")
+    parser.add_argument("--patients", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--stand-in", action="store_true", help="run against the local stand-in API instead of BASE_URL")
+    parser.add_argument("--latency-ms", type=float, default=20, help="mean latency of the stand-in API")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of stand-in API requests that fail")
+    parser.add_argument("--report", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    facility_id = os.environ.get("FACILITY_ID") or "load-test-facility"
+    server = None
+    if args.stand_in:
+        from tests.stand_in_server import StandInServer
+        server = StandInServer(latency_ms=args.latency_ms, error_rate=args.error_rate).start()
+        base_url = server.base_url
+    else:
+        base_url = os.environ.get("BASE_URL")
+    try:
+        metriport = Metriport(api_key=os.environ.get("API_KEY") or "load-test", base_url=base_url)
+        report = run_load_test(
+            metriport, facility_id, args.patients, args.concurrency,
+            {"baseUrl": base_url, "standIn": args.stand_in},
+        )
+    finally:
+        if server:
+            server.stop()
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
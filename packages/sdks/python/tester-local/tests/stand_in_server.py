@@ -0,0 +1,112 @@
+"""
+Local stand-in for the Metriport API, to load test the SDK without hitting a real environment.
+
+It implements the endpoints the load test uses (patient create and match, document query and
+consolidated query), keeps patients in memory, and can add latency and errors to the responses.
+"""
+
+import asyncio
+import random
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+def create_app(latency_ms: float = 20, error_rate: float = 0, throttle_rate: float = 0) -> FastAPI:
+    """
+    :param latency_ms: mean latency added to each response (exponentially distributed).
+    :param error_rate: fraction of the requests that fail with a 500.
+    :param throttle_rate: fraction of the requests that are rate limited with a 429 and Retry-After.
+    """
+    app = FastAPI()
+    patients: dict[str, dict] = {}
+    patients_by_demographics: dict[tuple, str] = {}
+
+    @app.middleware("http")
+    async def simulate(request: Request, call_next):
+        if latency_ms > 0:
+            await asyncio.sleep(random.expovariate(1000 / latency_ms))
+        draw = random.random()
+        if draw < throttle_rate:
+            return JSONResponse({"message": "Too many requests"}, status_code=429, headers={"Retry-After": "1"})
+        if draw < throttle_rate + error_rate:
+            return JSONResponse({"message": "Internal server error"}, status_code=500)
+        return await call_next(request)
+
+    def demographics_key(body: dict) -> tuple:
+        return (body.get("firstName"), body.get("lastName"), body.get("dob"), body.get("genderAtBirth"))
+
+    @app.post("/medical/v1/patient")
+    async def create_patient(request: Request, facilityId: str):
+        body = await request.json()
+        patient = {**body, "id": str(uuid.uuid4()), "facilityIds": [facilityId]}
+        patients[patient["id"]] = patient
+        patients_by_demographics[demographics_key(body)] = patient["id"]
+        return patient
+
+    @app.post("/medical/v1/patient/match")
+    async def match_patient(request: Request):
+        patient_id = patients_by_demographics.get(demographics_key(await request.json()))
+        if patient_id is None:
+            return JSONResponse({"message": "Patient not found"}, status_code=404)
+        return patients[patient_id]
+
+    @app.post("/medical/v1/document/query")
+    async def start_document_query(patientId: str, facilityId: str):
+        if patientId not in patients:
+            return JSONResponse({"message": "Patient not found"}, status_code=404)
+        return {"download": {"status": "processing"}, "convert": {"status": "processing"}, "requestId": str(uuid.uuid4())}
+
+    @app.post("/medical/v1/document/download-url/bulk")
+    async def start_bulk_get_document_url(patientId: str):
+        if patientId not in patients:
+            return JSONResponse({"message": "Patient not found"}, status_code=404)
+        return {"status": "processing", "requestId": str(uuid.uuid4())}
+
+    @app.post("/medical/v1/patient/{id}/consolidated/query")
+    async def start_consolidated_query(id: str, conversionType: str = "json"):
+        if id not in patients:
+            return JSONResponse({"message": "Patient not found"}, status_code=404)
+        return {
+            "query": {
+                "requestId": str(uuid.uuid4()),
+                "startedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "conversionType": conversionType,
+                "status": "processing",
+            }
+        }
+
+    return app
+
+
+class StandInServer:
+    """Runs the stand-in API on a background thread, e.g. `with StandInServer() as server: server.base_url`."""
+
+    def __init__(self, port: int = 8181, **app_options):
+        self.port = port
+        self.base_url = f"http://127.0.0.1:{port}"
+        config = uvicorn.Config(create_app(**app_options), host="127.0.0.1", port=port, log_level="warning")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self) -> "StandInServer":
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise RuntimeError(f"Stand-in server failed to start on port {self.port}")
+            time.sleep(0.05)
+        return self
+
+    def stop(self) -> None:
+        self.server.should_exit = True
+        self.thread.join()
+
+    def __enter__(self) -> "StandInServer":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
@@ -0,0 +1,78 @@
+import asyncio
+
+import httpx
+
+from generated.resources.medical import BasePatient
+
+from async_metriport import RetryTransport, bulk_start_get_document_url, pooled_async_metriport
+from tests.load_harness import get_demographics
+from tests.stand_in_server import StandInServer
+
+facility_id = "load-test-facility"
+
+
+def test_bulk_start_get_document_url() -> None:
+    """
+    Starts the bulk document URL generation of many patients with the pooled async client, against
+    the local stand-in API rate limiting some of the requests: they're retried after Retry-After.
+    """
+
+    async def run(base_url: str) -> dict:
+        async with pooled_async_metriport(api_key="load-test", base_url=base_url, max_concurrency=10) as metriport:
+            patients = await asyncio.gather(*(
+                metriport.medical.patient.create(facility_id=facility_id, request=BasePatient(**get_demographics(index)))
+                for index in range(20)
+            ))
+            return await bulk_start_get_document_url(metriport, [patient.id for patient in patients])
+
+    with StandInServer(latency_ms=5, throttle_rate=0.1) as server:
+        results = asyncio.run(run(server.base_url))
+    print(f"Results: {results}")
+    assert len(results) == 20
+    for patient_id, result in results.items():
+        assert not isinstance(result, Exception), f"{patient_id}: {result}"
+        assert result.status == "processing"
+
+
+def send_with_retries(method: str, responses: list) -> tuple[object, int]:
+    """Sends a request through RetryTransport, returns the response (or error) and the number of attempts."""
+    attempts = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        attempts.append(request)
+        response = responses[min(len(attempts), len(responses)) - 1]
+        if isinstance(response, Exception):
+            raise response
+        return httpx.Response(response)
+
+    async def send():
+        transport = RetryTransport(httpx.MockTransport(handle), backoff_seconds=0)
+        async with httpx.AsyncClient(transport=transport) as client:
+            try:
+                return await client.request(method, "http://metriport/medical/v1/patient")
+            except httpx.HTTPError as error:
+                return error
+
+    return asyncio.run(send()), len(attempts)
+
+
+def test_retry_transport_retries_idempotent_requests() -> None:
+    response, attempts = send_with_retries("GET", [500, httpx.ReadTimeout("timed out"), 200])
+    assert response.status_code == 200
+    assert attempts == 3
+
+
+def test_retry_transport_does_not_retry_creates_that_may_have_succeeded() -> None:
+    response, attempts = send_with_retries("POST", [500, 200])
+    assert response.status_code == 500
+    assert attempts == 1
+
+    error, attempts = send_with_retries("POST", [httpx.ReadTimeout("timed out"), 200])
+    assert isinstance(error, httpx.ReadTimeout)
+    assert attempts == 1
+
+
+def test_retry_transport_retries_creates_not_done() -> None:
+    response, attempts = send_with_retries("POST", [429, httpx.ConnectError("refused"), 201])
+    assert response.status_code == 201
+    assert attempts == 3
@@ -0,0 +1,27 @@
+import os
+
+from generated.client import Metriport
+
+from dotenv import load_dotenv
+
+from tests.load_harness import OPERATIONS, run_load_test
+from tests.stand_in_server import StandInServer
+
+load_dotenv()
+
+facility_id = os.environ.get("FACILITY_ID") or "load-test-facility"
+
+
+def test_load_harness() -> None:
+    """
+    Runs a small load test against the local stand-in API, see load_harness.py for the full one.
+    """
+    with StandInServer(latency_ms=5) as server:
+        metriport = Metriport(api_key="load-test", base_url=server.base_url)
+        report = run_load_test(metriport, facility_id, patients=20, concurrency=5)
+    print(f"Report: {report}")
+    for operation in OPERATIONS:
+        stats = report["operations"][operation]
+        assert stats["count"] == 20
+        assert stats["errors"] == 0
+        assert stats["latencyMs"]["p50"] <= stats["latencyMs"]["p99"]
@@ -0,0 +1,238 @@
+"""
+Scans converted FHIR bundles for "dead" resources, in parallel across cores:
+
+- dead responses: resources whose text says there's no data ("No known medications", "No data
+  available for this section", ...), in the code/vaccineCode/reasonCode/dosage texts and in
+  Observation.valueString - decoded first when it's a _b64 value (see Observation.hbs)
+- dead resources: resources with nothing but resourceType, id and meta (or one other element),
+  counted per resource type and per resource type and element
+
+Bundles above --stream-threshold-mb are parsed as a stream (with ijson, if installed).
+
+Usage:
+    python dead_resource_scanner.py <directory> [--json stats.json] [--csv stats.csv] [--workers N]
+"""
+
+import argparse
+import base64
+import binascii
+import csv
+import json
+import os
+import re
+import sys
+from collections import Counter
+from multiprocessing import Pool
+
+try:
+    import ijson
+
+    PARSE_ERRORS = (ValueError, OSError, ijson.JSONError)
+except ImportError:
+    ijson = None
+    PARSE_ERRORS = (ValueError, OSError)
+
+NO_DATA_PHRASES = [
+    "no known",
+    "no observation",
+    "no data",
+    "no information",
+    "no results",
+    "no medical",
+    "no smoking status",
+    "no social history",
+    "no chronic problems",
+]
+TEXT_FIELDS = ["vaccineCode", "code", "reasonCode", "dosage"]
+BASE64_PATTERN = re.compile(r"^[A-Za-z0-9+/]+={0,2}$")
+DEFAULT_STREAM_THRESHOLD_MB = 20
+
+# Set in each worker by init_worker
+matcher = None
+
+
+def compile_matcher(phrases):
+    """One case-insensitive pattern matching any of the phrases, so each text is scanned once."""
+    return re.compile("|".join(re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True)), re.IGNORECASE)
+
+
+def init_worker(phrases):
+    global matcher
+    matcher = compile_matcher(phrases)
+
+
+def decode_b64(value):
+    """The decoded text of a _b64 value, None if the value isn't base64 text."""
+    if len(value) < 4 or len(value) % 4 != 0 or not BASE64_PATTERN.match(value):
+        return None
+    try:
+        return base64.b64decode(value, validate=True).decode("utf-8")
+    except (binascii.Error, UnicodeDecodeError):
+        return None
+
+
+def iter_texts(resource):
+    """(field, text) of the texts of a resource that can hold a dead response."""
+    for field in TEXT_FIELDS:
+        values = resource.get(field)
+        for value in values if isinstance(values, list) else [values]:
+            if isinstance(value, dict) and isinstance(value.get("text"), str):
+                yield field, value["text"]
+    value_string = resource.get("valueString")
+    if resource.get("resourceType") == "Observation" and isinstance(value_string, str):
+        decoded = decode_b64(value_string)
+        if decoded is not None:
+            yield "valueString._b64", decoded
+        else:
+            yield "valueString", value_string
+
+
+def is_dead_resource(resource):
+    # Only resourceType, id and meta (or one other element), e.g. a reference target without data
+    return "id" in resource and len(resource) <= 3 and "code" not in resource and "name" not in resource
+
+
+def iter_resources(file_path, stream_threshold_bytes):
+    with open(file_path, "rb") as f:
+        if ijson is not None and os.path.getsize(file_path) > stream_threshold_bytes:
+            for resource in ijson.items(f, "entry.item.resource", use_float=True):
+                yield resource
+            return
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError("JSON array at the top level")
+    for entry in data.get("entry", []):
+        if isinstance(entry, dict) and entry.get("resource"):
+            yield entry["resource"]
+
+
+def new_stats():
+    return {
+        "files": 0,
+        "skippedFiles": [],
+        "resources": 0,
+        # text -> {"count", "resources", "fields"}
+        "deadResponses": {},
+        # resource type (or resource type_element) -> count
+        "deadResources": Counter(),
+    }
+
+
+def scan_file(args):
+    file_path, stream_threshold_bytes = args
+    stats = new_stats()
+    stats["files"] = 1
+    try:
+        for resource in iter_resources(file_path, stream_threshold_bytes):
+            stats["resources"] += 1
+            resource_type = resource.get("resourceType")
+            for field, text in iter_texts(resource):
+                if matcher.search(text):
+                    response = stats["deadResponses"].setdefault(text, {"count": 0, "resources": set(), "fields": set()})
+                    response["count"] += 1
+                    response["resources"].add(resource_type)
+                    response["fields"].add(field)
+            if is_dead_resource(resource) and resource_type:
+                stats["deadResources"][resource_type] += 1
+            if "resourceType" in resource and "id" in resource and len(resource) <= 3:
+                for key, value in resource.items():
+                    if isinstance(value, dict) and key != "meta":
+                        stats["deadResources"][f"{resource_type}_{key}"] += 1
+    except PARSE_ERRORS as exc:
+        stats["skippedFiles"].append({"file": file_path, "error": str(exc)})
+    return stats
+
+
+def merge_stats(total, stats):
+    total["files"] += stats["files"]
+    total["skippedFiles"].extend(stats["skippedFiles"])
+    total["resources"] += stats["resources"]
+    total["deadResources"].update(stats["deadResources"])
+    for text, response in stats["deadResponses"].items():
+        merged = total["deadResponses"].setdefault(text, {"count": 0, "resources": set(), "fields": set()})
+        merged["count"] += response["count"]
+        merged["resources"] |= response["resources"]
+        merged["fields"] |= response["fields"]
+
+
+def iter_files(directory):
+    for root, _, files in os.walk(directory):
+        for file in sorted(files):
+            if file.endswith(".json"):
+                yield os.path.join(root, file)
+
+
+def scan(directory, workers=None, phrases=NO_DATA_PHRASES, stream_threshold_mb=DEFAULT_STREAM_THRESHOLD_MB):
+    total = new_stats()
+    stream_threshold_bytes = stream_threshold_mb * 1024 * 1024
+    tasks = ((file_path, stream_threshold_bytes) for file_path in iter_files(directory))
+    with Pool(processes=workers, initializer=init_worker, initargs=(phrases,)) as pool:
+        for stats in pool.imap_unordered(scan_file, tasks, chunksize=16):
+            merge_stats(total, stats)
+    return total
+
+
+def to_report(total):
+    dead_responses = sorted(total["deadResponses"].items(), key=lambda item: -item[1]["count"])
+    return {
+        "files": total["files"],
+        "skippedFiles": total["skippedFiles"],
+        "resources": total["resources"],
+        "deadResponsesTotal": sum(response["count"] for _, response in dead_responses),
+        "deadResponses": [
+            {
+                "text": text,
+                "count": response["count"],
+                "resources": sorted(str(resource) for resource in response["resources"]),
+                "fields": sorted(response["fields"]),
+            }
+            for text, response in dead_responses
+        ],
+        "deadResources": dict(total["deadResources"].most_common()),
+    }
+
+
+def write_csv(report, path):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["kind", "key", "count", "resources", "fields"])
+        for response in report["deadResponses"]:
+            writer.writerow(["deadResponse", response["text"], response["count"], ";".join(response["resources"]), ";".join(response["fields"])])
+        for key, count in report["deadResources"].items():
+            writer.writerow(["deadResource", key, count, "", ""])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count dead responses and dead resources in converted FHIR bundles.")
+    parser.add_argument("directory", help="folder with the converted bundles (.json), searched recursively")
+    parser.add_argument("--workers", type=int, help="processes to scan the files with, defaults to the number of cores")
+    parser.add_argument("--phrase", action="append", default=[], help="another phrase that marks a dead response")
+    parser.add_argument("--stream-threshold-mb", type=float, default=DEFAULT_STREAM_THRESHOLD_MB, help="stream-parse bundles larger than this")
+    parser.add_argument("--json", help="write the stats to this JSON file")
+    parser.add_argument("--csv", help="write the stats to this CSV file")
+    args = parser.parse_args()
+    if not os.path.isdir(args.directory):
+        print(f"Not a directory: {args.directory}")
+        sys.exit(1)
+
+    total = scan(args.directory, args.workers, NO_DATA_PHRASES + args.phrase, args.stream_threshold_mb)
+    report = to_report(total)
+    for response in report["deadResponses"]:
+        print(f"{response['text']}: {response['count']} ({', '.join(response['resources'])})")
+    for key, count in report["deadResources"].items():
+        print(f"{key}: {count}")
+    for skipped in report["skippedFiles"]:
+        print(f"Skipped {skipped['file']}: {skipped['error']}")
+    print(f"Scanned {report['files']} files, {report['resources']} resources")
+    print(f"Total count of resources with 'dead responses': {report['deadResponsesTotal']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Stats written to {args.json}")
+    if args.csv:
+        write_csv(report, args.csv)
+        print(f"Stats written to {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,34 +2,41 @@
 
 
 import logging
+import random
+import time
 import httpx
 import pydantic
 import asyncio
-from typing import Optional
+from datetime import datetime, timezone
+from typing import AsyncIterator, Optional
 
 logging.basicConfig(level=logging.INFO)
 
 import gcp
 import env
+import roster_index
 
 _METRIPORT_SANDBOX_URL = "https://api.sandbox.metriport.com/"
 _METRIPORT_PROD_URL = "https://api.metriport.com/"
+# Responses worth retrying: rate limited or a transient server error
+_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 
 
 class MetriportAuth(httpx.Auth):
-    def __init__(self):
-        try:
-            gcp_instance = gcp.GCP()
-            self.api_key = gcp_instance.get_secret("METRIPORT_SECRET_KEY")
-        except Exception as exc:
-            raise
+    def __init__(self, secrets: gcp.SecretCache = gcp.secrets):
+        self.secrets = secrets
 
     def auth_flow(self, request: httpx.Request):
-        if self.api_key:
-            request.headers["x-api-key"] = self.api_key
+        # Read on every request (it's cached) so a rotated key is picked up once the cache expires
+        api_key = self.secrets.get("METRIPORT_SECRET_KEY")
+        if api_key:
+            request.headers["x-api-key"] = api_key
         yield request
 
 
+# Process-wide async client, see get_async_client
+_async_client: Optional[httpx.AsyncClient] = None
+
 
 def default_client() -> httpx.Client:
     return client(timeout=30, transport=httpx.HTTPTransport(retries=3))
@@ -40,9 +47,31 @@ def default_async_client() -> httpx.AsyncClient:
         base_url=_METRIPORT_PROD_URL if env.is_prod() else _METRIPORT_SANDBOX_URL,
         auth=MetriportAuth(),
         timeout=30,
-        transport=httpx.AsyncHTTPTransport(retries=3),
+        transport=httpx.AsyncHTTPTransport(
+            retries=3,
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+        ),
     )
 
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    The async client shared by the whole process, so requests reuse its pooled (HTTP/2, keep-alive)
+    connections instead of opening new ones. Close it with close_async_client on shutdown.
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = default_async_client()
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
 def client(**kwargs) -> httpx.Client:
     return httpx.Client(
         base_url=_METRIPORT_PROD_URL if env.is_prod() else _METRIPORT_SANDBOX_URL,
@@ -78,14 +107,82 @@ class Patient(pydantic.BaseModel):
     contact: Optional[list[Contact]] = None
     externalId: Optional[str] = None
 
+class TokenBucket:
+    """
+    Rate limiter shared by concurrent requests: up to `rate` requests per second, in bursts of up
+    to `capacity` requests.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[int] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def request_with_retry(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    rate_limiter: Optional[TokenBucket] = None,
+    max_retries: int = 5,
+    backoff_seconds: float = 0.5,
+    idempotent: bool = True,
+    **kwargs,
+) -> httpx.Response:
+    """
+    Sends a request, retrying on 429/5xx responses and network errors with exponential backoff
+    (or the Retry-After header, when there's one). Returns the last response once out of retries.
+
+    Requests that aren't `idempotent` (e.g. creating a patient) are only retried on 429: after a
+    5xx or a timeout the server might have done it already. Failures to connect, before anything
+    was sent, are retried by the client's transport.
+    """
+    retry_status_codes = _RETRY_STATUS_CODES if idempotent else {429}
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            await rate_limiter.acquire()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError:
+            if not idempotent or attempt == max_retries:
+                raise
+            response = None
+        if response is not None and (
+            response.status_code not in retry_status_codes or attempt == max_retries
+        ):
+            return response
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else backoff_seconds * 2**attempt
+        logging.info(f"Retrying {method} {url} in {delay}s (attempt {attempt + 1} of {max_retries})")
+        await asyncio.sleep(delay + random.uniform(0, backoff_seconds))
+
+
 async def upload_new_patient(
-    metriport_facility_id: str, patient: Patient, client=None
+    metriport_facility_id: str, patient: Patient, client=None, rate_limiter: Optional[TokenBucket] = None
 ) -> httpx.Response:
     if client is None:
-        client = default_async_client()
+        client = get_async_client()
 
-    result = await client.post(
+    result = await request_with_retry(
+        client,
+        "POST",
         "/medical/v1/patient",
+        rate_limiter=rate_limiter,
+        # A retried create could create the patient twice
+        idempotent=False,
         params={"facilityId": metriport_facility_id},
         content=patient.model_dump_json(exclude_none=True),
         headers={"Content-Type": "application/json"},
@@ -97,7 +194,7 @@ async def get_patient(
         client=None
 ) -> httpx.Response:
     if client is None:
-        client = default_async_client()
+        client = get_async_client()
 
     result = await client.get(
         f"/medical/v1/patient/{patient_id}",
@@ -112,7 +209,7 @@ async def post_document_query(
     client=None
 ) -> httpx.Response:
     if client is None:
-        client = default_async_client()
+        client = get_async_client()
 
     result = await client.post(
         "/medical/v1/document/query",
@@ -136,7 +233,7 @@ async def post_consolidated_query(
     client=None
 ) -> httpx.Response:
     if client is None:
-        client = default_async_client()
+        client = get_async_client()
 
     result = await client.post(
         f"/medical/v1//patient/{patient_id}/consolidated/query",
@@ -153,54 +250,176 @@ async def post_consolidated_query(
     )
     return result
 
-def _already_included(patient: Patient, email_index: dict, phone_index: dict) -> bool:
-    for contact in patient.contact:
-        if contact.phone and contact.phone in phone_index:
-            return True
-        if contact.email and contact.email in email_index:
-            return True
-    return False
+async def list_patients(
+    metriport_facility_id: str,
+    client: httpx.AsyncClient,
+    rate_limiter: Optional[TokenBucket] = None,
+    page_size: int = 500,
+) -> AsyncIterator[Patient]:
+    """All patients of a facility, following the `meta.nextPage` links of the paginated listing."""
+    url = "/medical/v1/patient"
+    params = {"facilityId": metriport_facility_id, "count": page_size}
+    while url:
+        response = await request_with_retry(client, "GET", url, rate_limiter=rate_limiter, params=params)
+        body = response.raise_for_status().json()
+        for row in body["patients"]:
+            yield Patient.model_validate(row)
+        url = (body.get("meta") or {}).get("nextPage")
+        # The next page URL already has the query parameters
+        params = None
+
+
+async def update_patient(
+    patient_id: str,
+    metriport_facility_id: str,
+    patient: Patient,
+    client=None,
+    rate_limiter: Optional[TokenBucket] = None,
+) -> httpx.Response:
+    if client is None:
+        client = get_async_client()
+
+    result = await request_with_retry(
+        client,
+        "PUT",
+        f"/medical/v1/patient/{patient_id}",
+        rate_limiter=rate_limiter,
+        params={"facilityId": metriport_facility_id},
+        content=patient.model_dump_json(exclude_none=True, exclude={"id"}),
+        headers={"Content-Type": "application/json"},
+    )
+    return result
+
+
+class PatientSyncResult(pydantic.BaseModel):
+    # Position of the patient in the roster passed to sync_patients
+    index: int
+    externalId: Optional[str] = None
+    # "created", "updated", "unchanged" or "failed"
+    status: str
+    patientId: Optional[str] = None
+    statusCode: Optional[int] = None
+    error: Optional[str] = None
+
+
+def diff_roster(
+    metriport_facility_id: str, patients: list[Patient], index: roster_index.RosterIndex
+) -> list[tuple[str, Optional[str]]]:
+    """
+    ("create", None), ("update", patient id) or ("unchanged", patient id) for each patient of the
+    roster, compared to the index: by externalId (or demographics), then by email or phone.
+
+    Family members often share an email or phone, so a match by contact only counts when the
+    demographics are the same too: a patient is never updated with the demographics of another one.
+    """
+    diff = []
+    seen_keys = set()
+    for patient in patients:
+        roster_key = roster_index.get_roster_key(patient)
+        if roster_key in seen_keys:
+            diff.append(("duplicate", None))
+            continue
+        seen_keys.add(roster_key)
+        indexed = index.get(metriport_facility_id, roster_key)
+        if indexed is None:
+            by_contact = index.find_by_contact(metriport_facility_id, patient)
+            if by_contact and by_contact[1] == roster_index.get_fingerprint(patient):
+                indexed = by_contact
+        if indexed is None:
+            diff.append(("create", None))
+        elif indexed[1] != roster_index.get_fingerprint(patient):
+            diff.append(("update", indexed[0]))
+        else:
+            diff.append(("unchanged", indexed[0]))
+    return diff
 
 
 async def sync_patients(
-    metriport_facility_id: str, patients: list[Patient], client=None
-) -> list[httpx.Response]:
+    metriport_facility_id: str,
+    patients: list[Patient],
+    client=None,
+    max_concurrency: int = 10,
+    requests_per_second: float = 10,
+    index: Optional[roster_index.RosterIndex] = None,
+    full_refresh: bool = False,
+) -> list[PatientSyncResult]:
+    """
+    Creates the patients of a roster that don't exist in the facility yet and updates the ones whose
+    demographics changed, and returns the outcome for each of them (in the same order as `patients`).
+
+    The roster is compared to a local index of the patients already synced (`index`, in memory if
+    not given): only the first sync of a facility, or one with `full_refresh`, lists all of its
+    patients, later syncs only send requests for the patients that are new or changed.
+
+    All requests share one client and are limited to `max_concurrency` in flight and
+    `requests_per_second`; rate limited and failed requests are retried with backoff.
+    """
     if client is None:
-        client = default_async_client()
+        client = get_async_client()
+    if index is None:
+        with roster_index.RosterIndex(":memory:") as index:
+            return await sync_patients(
+                metriport_facility_id, patients, client, max_concurrency, requests_per_second, index, full_refresh
+            )
+
+    started_at = datetime.now(timezone.utc).isoformat()
+    rate_limiter = TokenBucket(requests_per_second)
+    if full_refresh or index.get_watermark(metriport_facility_id) is None:
+        async for row in list_patients(metriport_facility_id, client, rate_limiter):
+            index.upsert(metriport_facility_id, row, row.id, started_at)
+        index.commit()
+    diff = diff_roster(metriport_facility_id, patients, index)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def sync_patient(position: int, patient: Patient) -> PatientSyncResult:
+        action, patient_id = diff[position]
+        result = PatientSyncResult(index=position, externalId=patient.externalId, status="unchanged", patientId=patient_id)
+        if action == "unchanged":
+            return result
+        if action == "duplicate":
+            result.status = "failed"
+            result.error = "Same externalId (or demographics) as a previous patient of the roster"
+            return result
+        async with semaphore:
+            try:
+                if action == "create":
+                    response = await upload_new_patient(metriport_facility_id, patient, client, rate_limiter)
+                else:
+                    response = await update_patient(patient_id, metriport_facility_id, patient, client, rate_limiter)
+            except httpx.HTTPError as exc:
+                result.status = "failed"
+                result.error = repr(exc)
+                return result
+        result.statusCode = response.status_code
+        if response.is_success:
+            result.status = "created" if action == "create" else "updated"
+            result.patientId = response.json().get("id") or patient_id
+            index.upsert(metriport_facility_id, patient, result.patientId)
+        else:
+            result.status = "failed"
+            result.error = response.text[:1000]
+        return result
+
+    try:
+        results = await asyncio.gather(*(sync_patient(i, patient) for i, patient in enumerate(patients)))
+    finally:
+        # Keep what was synced even if the run fails midway
+        index.commit()
+    index.set_watermark(metriport_facility_id, started_at)
+    counts = {}
+    for result in results:
+        counts[result.status] = counts.get(result.status, 0) + 1
+    logging.info(f"Synced {len(patients)} patients: {counts}")
+    return results
 
-    existing_patients_query = await client.get(
-        "/medical/v1/patient", params={"facilityId": metriport_facility_id}
-    )
-    parsed_patients = (
-        Patient.parse_obj(row)
-        for row in existing_patients_query.raise_for_status().json()["patients"]
-    )
-    existing_patients = {patient.id: patient for patient in parsed_patients}
-    # Identify existing patients by identical emails or phone numbers
-    email_index = {}
-    phone_index = {}
-    for metriport_id, row in existing_patients.items():
-        for contact_info in row.contact:
-            if contact_info.phone:
-                phone_index[contact_info.phone] = metriport_id
-            if contact_info.email:
-                email_index[contact_info.email] = metriport_id
-    # TODO(ali): Handle incremental update
-    promises = []
-    for patient in patients:
-        if not _already_included(patient, email_index, phone_index):
-            promises.append(upload_new_patient(metriport_facility_id, patient))
-    return [await promise for promise in promises]
-    
 async def main():
-    # Instantiate the HTTP client
-    client = default_async_client()
+    # The shared HTTP client
+    client = get_async_client()
 
     facility_id = env.get_env_var("METRIPORT_FACILITY_ID")
 
-    gcp_instance = gcp.GCP()
     upload_response = await upload_new_patient(
-        metriport_facility_id=gcp_instance.get_secret("METRIPORT_FACILITY_ID"),
+        metriport_facility_id=gcp.secrets.get("METRIPORT_FACILITY_ID"),
         patient=Patient(
             firstName="Aamina",
             lastName="Alexander",
@@ -238,6 +457,8 @@ async def main():
     else:
         print("Error:", document_query_response.status_code)
 
+    await close_async_client()
+
 # Run the main function
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,5 +1,7 @@
 from dotenv import load_dotenv
 import os
+import threading
+import time
 
 load_dotenv()  # Load environment variables from .env file
 
@@ -12,5 +14,35 @@ class GCP:
 
 
     def save_to_big_query(self, data: dict):
-        # Save data to BigQuery
-        pass
\ No newline at end of file
+        # Save data to BigQuery (the webhook writes through sink.BatchedSink instead)
+        pass
+
+
+class SecretCache:
+    """
+    Secrets fetched once and kept for `ttl_seconds`, so they aren't fetched again for every request
+    but rotated secrets are still picked up.
+    """
+
+    def __init__(self, ttl_seconds: float = 300, fetch=GCP.get_secret):
+        self.ttl_seconds = ttl_seconds
+        self.fetch = fetch
+        self.secrets = {}
+        self.lock = threading.Lock()
+
+    def get(self, secret_name: str):
+        with self.lock:
+            cached = self.secrets.get(secret_name)
+            if cached and time.monotonic() < cached[1]:
+                return cached[0]
+            value = self.fetch(secret_name)
+            self.secrets[secret_name] = (value, time.monotonic() + self.ttl_seconds)
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.secrets.clear()
+
+
+# Shared by the whole process
+secrets = SecretCache()
@@ -1,19 +1,110 @@
 import hmac
 import hashlib
 import json
-from typing import Optional
+import tempfile
+from contextlib import asynccontextmanager
+from typing import IO, Optional
+import ijson
 from fastapi import FastAPI, Request, Response, status
 from pydantic import BaseModel
 
+import asyncio
 import gcp
-from create_patient_trigger_webhook import post_consolidated_query, default_async_client
+from create_patient_trigger_webhook import post_consolidated_query, get_async_client, close_async_client
+from sink import BatchedSink, get_backend, get_processed_date
+from work_queue import WorkQueue
+
+# Bodies up to this size are kept in memory, larger ones are spooled to a temporary file
+MAX_BODY_IN_MEMORY = 1024 * 1024
+# Bundle entries sent to the sink at a time
+ENTRY_BATCH_SIZE = 500
+
+
+def iter_entry_batches(body: IO[bytes], batch_size: int = ENTRY_BATCH_SIZE):
+    """The bundle entries of a consolidated-data webhook, parsed as they're read, in batches."""
+    body.seek(0)
+    batch = []
+    for entry in ijson.items(body, 'patients.item.bundle.entry.item', use_float=True):
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def process_webhook(event: tuple[dict, IO[bytes]]):
+    """
+    Processes a webhook event after it was acknowledged. It assumes you only have one patient whose
+    id is queried from the environment variable METRIPORT_PATIENT_ID. The application flow here is
+    the following:
+    Webhook gets triggered by doucment query request, and once it recieves a document-conversion in the response,
+    it makes a consolidated query request. Once it recieves a consolidated-data in the response, it "saves" the
+    data to BigQuery.
+
+    :param event: The `meta` of the webhook request and its raw body.
+    """
+    meta, body = event
+    try:
+        await handle_webhook(meta, body)
+    finally:
+        body.close()
+
+
+async def handle_webhook(meta: dict, body: IO[bytes]):
+    # Check the type of the webhook
+    webhook_type = meta.get('type')
+
+    if webhook_type == 'medical.document-download':
+        # Do nothing
+        print("Documents Downloaded")
+        pass
+    elif webhook_type == 'medical.document-conversion':
+        # Perform a consolidated query
+        print("Making Consolidated Query")
+        consolidated_query_response = await post_consolidated_query(
+            patient_id=gcp.secrets.get("METRIPORT_PATIENT_ID"),
+            client=get_async_client(),
+        )
+
+    elif webhook_type == 'medical.consolidated-data':
+        # Save the results to BigQuery (see sink.get_backend), a batch of entries at a time so
+        # large bundles are never fully in memory. Raises if the rows couldn't be inserted, so the
+        # event is processed again when it's redelivered
+        print("Writing to Big Query")
+        source = meta.get('messageId') or ''
+        processed_date = get_processed_date()
+        batches = iter_entry_batches(body)
+        while True:
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+            await sink.write(batch, source=source, processed_date=processed_date)
+        await sink.flush(source)
+
+
+# Webhook events are processed in the background, a few at a time
+work_queue = WorkQueue(process_webhook, workers=4)
+# Rows of the consolidated-data bundles, created on startup
+sink: Optional[BatchedSink] = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client for all webhook events, closed on shutdown
+    global sink
+    get_async_client()
+    sink = BatchedSink(get_backend())
+    sink.start()
+    work_queue.start()
+    yield
+    await work_queue.stop()
+    await sink.close()
+    await close_async_client()
+
 
 # Initialize FastAPI app
-app = FastAPI()
-# Get environment variables
-gcp_instance = gcp.GCP()
-WH_KEY = gcp_instance.get_secret("METRIPORT_WH_KEY")
-PATIENT_ID = gcp_instance.get_secret("METRIPORT_PATIENT_ID")
+app = FastAPI(lifespan=lifespan)
 
 # Function to verify webhook signature
 def verify_webhook_signature(key: str, body: str, signature: str) -> bool:
@@ -30,14 +121,45 @@ def verify_webhook_signature(key: str, body: str, signature: str) -> bool:
     body_bytes = body.encode('utf-8')
     
     hmac_obj = hmac.new(key_bytes, body_bytes, hashlib.sha256)
+    return verify_webhook_hmac(hmac_obj, signature)
+
+
+def verify_webhook_hmac(hmac_obj, signature: Optional[str]) -> bool:
+    """
+    Verify the signature of a webhook request against an HMAC already updated with its body.
+
+    :param hmac_obj: HMAC (SHA-256, with your webhook key) of the raw body of the webhook request.
+    :param signature: the signature obtained from the webhook request header (string).
+    :return: True if signature is verified, False otherwise.
+    """
     computed_signature = hmac_obj.hexdigest()
-    if hmac.compare_digest(computed_signature, signature):
+    if signature and hmac.compare_digest(computed_signature, signature):
         print('Signature verified')
         return True
     else:
         print('Signature verification failed')
         return False
 
+
+async def read_body(request: Request, key: str) -> tuple[IO[bytes], hmac.HMAC]:
+    """
+    Reads the body of a request as it's received, into a spooled temporary file, and computes its
+    HMAC along the way - the body is never held in memory as a whole.
+    """
+    hmac_obj = hmac.new(key.encode('utf-8'), digestmod=hashlib.sha256)
+    body = tempfile.SpooledTemporaryFile(max_size=MAX_BODY_IN_MEMORY)
+    async for chunk in request.stream():
+        hmac_obj.update(chunk)
+        body.write(chunk)
+    body.seek(0)
+    return body, hmac_obj
+
+
+def read_field(body: IO[bytes], field: str):
+    """A top-level field of a JSON body, parsed without parsing the rest of it."""
+    body.seek(0)
+    return next(ijson.items(body, field, use_float=True), None)
+
 class WebhookPayload(BaseModel):
     ping: Optional[str] = None
 
@@ -45,54 +167,43 @@ class WebhookPayload(BaseModel):
 @app.post("/")
 async def webhook(request: Request):
     """
-    This Python function handles a webhook request by verifying the signature, processing different
-    types of webhook events, and returning an appropriate response. It assumes you only have one patient
-    whose id is queried from the environment variable METRIPORT_PATIENT_ID. The application flow here is 
-    the following:
-    Webhook gets triggered by doucment query request, and once it recieves a document-conversion in the response,
-    it makes a consolidated query request. Once it recieves a consolidated-data in the response, it "saves" the
-    data to BigQuery.
+    This Python function handles a webhook request by verifying the signature and queueing the event
+    to be processed in the background (see process_webhook), so it can return right away: Metriport
+    doesn't wait for (or time out on) the processing. Events already received, by `meta.messageId`,
+    are dropped. The body is streamed, see read_body.
 
     :param request: The request object.
     :return: A response object.
     """
-    raw_body = await request.body()
-    raw_body_str = raw_body.decode()
-    body = json.loads(raw_body_str)
     signature = request.headers.get('x-metriport-signature')
-
-    print(json.dumps(body, indent=2))
-    
-    if not verify_webhook_signature(WH_KEY, raw_body_str, signature):
-        return Response(status_code=status.HTTP_401_UNAUTHORIZED)
-
-    if 'ping' in body:
-        print('Sending 200 | OK + "pong" body param')
-        return Response(content=json.dumps({'pong': body['ping']}), media_type="application/json", status_code=status.HTTP_200_OK)
-    
-
-    # Check the type of the webhook
-    webhook_type = body.get('meta', {}).get('type')
-
-    if webhook_type == 'medical.document-download':
-        # Do nothing
-        print("Documents Downloaded")
-        pass
-    elif webhook_type == 'medical.document-conversion':
-        # Perform a consolidated query
-        print("Making Consolidated Query")
-        consolidated_query_response = await post_consolidated_query(
-            patient_id=PATIENT_ID,
-            client=default_async_client(),
-        )
-
-    elif webhook_type == 'medical.consolidated-data':
-        # Save the results to BigQuery
-        print("Writing to Big Query")
-        gcp_instance.save_to_big_query(body['patients'][0]['bundle']['entry'])
-
+    # Secrets are cached, see gcp.SecretCache
+    body, hmac_obj = await read_body(request, gcp.secrets.get("METRIPORT_WH_KEY"))
+    queued = False
+    try:
+        if not verify_webhook_hmac(hmac_obj, signature):
+            return Response(status_code=status.HTTP_401_UNAUTHORIZED)
+
+        # meta comes first in the body, so this doesn't parse the rest of it
+        meta = read_field(body, 'meta')
+        if meta is None:
+            ping = read_field(body, 'ping')
+            if ping is not None:
+                print('Sending 200 | OK + "pong" body param')
+                return Response(content=json.dumps({'pong': ping}), media_type="application/json", status_code=status.HTTP_200_OK)
+            meta = {}
+
+        print(f"Received {meta.get('type')} ({meta.get('messageId')})")
+        try:
+            queued = work_queue.submit(meta.get('messageId'), (meta, body))
+            if not queued:
+                print(f"Duplicate delivery of {meta.get('messageId')}, ignored")
+        except asyncio.QueueFull:
+            # Metriport retries the request later
+            return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    finally:
+        # Queued bodies are closed once processed
+        if not queued:
+            body.close()
 
     print('Sending 200 | OK')
     return Response(status_code=status.HTTP_200_OK)
-
-
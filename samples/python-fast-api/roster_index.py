@@ -0,0 +1,165 @@
+"""Persistent local index of the patients synced to Metriport, so syncs only send the changes."""
+
+import hashlib
+import json
+import re
+import sqlite3
+from datetime import datetime, timezone
+from typing import Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    facility_id TEXT NOT NULL,
+    roster_key TEXT NOT NULL,
+    patient_id TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    synced_at TEXT NOT NULL,
+    PRIMARY KEY (facility_id, roster_key)
+);
+CREATE TABLE IF NOT EXISTS contacts (
+    facility_id TEXT NOT NULL,
+    contact TEXT NOT NULL,
+    patient_id TEXT NOT NULL,
+    PRIMARY KEY (facility_id, contact)
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    facility_id TEXT PRIMARY KEY,
+    last_synced_at TEXT NOT NULL
+);
+"""
+
+
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    email = (email or "").strip().lower()
+    return email or None
+
+
+def normalize_phone(phone: Optional[str]) -> Optional[str]:
+    # Digits only, without the US country code
+    digits = re.sub(r"\D", "", phone or "")
+    if len(digits) == 11 and digits.startswith("1"):
+        digits = digits[1:]
+    return digits or None
+
+
+def _normalize_text(value: Optional[str]) -> str:
+    return " ".join((value or "").split()).lower()
+
+
+def normalize_demographics(patient) -> dict:
+    """The demographics of a patient, normalized so formatting differences don't count as changes."""
+    return {
+        "firstName": _normalize_text(patient.firstName),
+        "lastName": _normalize_text(patient.lastName),
+        "dob": patient.dob.strip(),
+        "genderAtBirth": patient.genderAtBirth.strip().upper(),
+        "address": sorted(
+            (
+                _normalize_text(address.addressLine1),
+                _normalize_text(address.addressLine2),
+                _normalize_text(address.city),
+                address.state.strip().upper(),
+                address.zip.strip(),
+            )
+            for address in patient.address
+        ),
+        "emails": sorted({normalize_email(c.email) for c in patient.contact or [] if normalize_email(c.email)}),
+        "phones": sorted({normalize_phone(c.phone) for c in patient.contact or [] if normalize_phone(c.phone)}),
+    }
+
+
+def get_fingerprint(patient) -> str:
+    demographics = json.dumps(normalize_demographics(patient), sort_keys=True)
+    return hashlib.sha256(demographics.encode("utf-8")).hexdigest()
+
+
+def get_roster_key(patient) -> str:
+    """The externalId of a patient or, when it doesn't have one, its name, date of birth and gender."""
+    if patient.externalId:
+        return f"externalId:{patient.externalId.strip()}"
+    demographics = normalize_demographics(patient)
+    return "demographics:" + "|".join(
+        demographics[field] for field in ["firstName", "lastName", "dob", "genderAtBirth"]
+    )
+
+
+def get_contacts(patient) -> list[str]:
+    contacts = []
+    for contact in patient.contact or []:
+        if normalize_email(contact.email):
+            contacts.append(f"email:{normalize_email(contact.email)}")
+        if normalize_phone(contact.phone):
+            contacts.append(f"phone:{normalize_phone(contact.phone)}")
+    return contacts
+
+
+class RosterIndex:
+    """
+    Patients synced to a facility, by roster key (see get_roster_key), with the fingerprint of the
+    demographics last sent, and the time of the last sync of each facility (the watermark).
+
+    Use ":memory:" as the path for an index that only lasts for the process.
+    """
+
+    def __init__(self, path: str = "roster_index.db"):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_watermark(self, facility_id: str) -> Optional[str]:
+        row = self.connection.execute(
+            "SELECT last_synced_at FROM watermarks WHERE facility_id = ?", (facility_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, facility_id: str, synced_at: str):
+        self.connection.execute(
+            "INSERT INTO watermarks (facility_id, last_synced_at) VALUES (?, ?) "
+            "ON CONFLICT (facility_id) DO UPDATE SET last_synced_at = excluded.last_synced_at",
+            (facility_id, synced_at),
+        )
+        self.connection.commit()
+
+    def get(self, facility_id: str, roster_key: str) -> Optional[tuple[str, str]]:
+        """(patient id, fingerprint) of an indexed patient."""
+        return self.connection.execute(
+            "SELECT patient_id, fingerprint FROM patients WHERE facility_id = ? AND roster_key = ?",
+            (facility_id, roster_key),
+        ).fetchone()
+
+    def find_by_contact(self, facility_id: str, patient) -> Optional[tuple[str, str]]:
+        """(patient id, fingerprint) of an indexed patient with the same email or phone."""
+        for contact in get_contacts(patient):
+            row = self.connection.execute(
+                "SELECT p.patient_id, p.fingerprint FROM contacts c "
+                "JOIN patients p ON p.facility_id = c.facility_id AND p.patient_id = c.patient_id "
+                "WHERE c.facility_id = ? AND c.contact = ?",
+                (facility_id, contact),
+            ).fetchone()
+            if row:
+                return row
+        return None
+
+    def upsert(self, facility_id: str, patient, patient_id: str, synced_at: Optional[str] = None):
+        synced_at = synced_at or datetime.now(timezone.utc).isoformat()
+        self.connection.execute(
+            "INSERT INTO patients (facility_id, roster_key, patient_id, fingerprint, synced_at) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (facility_id, roster_key) DO UPDATE SET "
+            "patient_id = excluded.patient_id, fingerprint = excluded.fingerprint, synced_at = excluded.synced_at",
+            (facility_id, get_roster_key(patient), patient_id, get_fingerprint(patient), synced_at),
+        )
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO contacts (facility_id, contact, patient_id) VALUES (?, ?, ?)",
+            [(facility_id, contact, patient_id) for contact in get_contacts(patient)],
+        )
+
+    def commit(self):
+        self.connection.commit()
@@ -0,0 +1,315 @@
+"""
+Batched writer of FHIR bundle entries to a table store (BigQuery, or a local stand-in).
+
+Entries are flattened into table rows with the fhir-to-csv configurations (one table per
+configuration, e.g. `condition`, `observation`), buffered per table and inserted in batches bounded
+by rows and bytes, a few batches at a time. When the backend can't keep up, `write` waits for
+batches to be inserted (backpressure) instead of buffering without limit. Failed inserts are
+retried, and `flush` raises if the rows of a source (e.g. a webhook event) couldn't be inserted, so
+the event can be redelivered.
+"""
+
+import asyncio
+import copy
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Protocol
+
+import env
+
+# The fhir-to-csv package of this repo, see FhirToCsvFlattener
+_FHIR_TO_CSV_PATH = Path(__file__).resolve().parents[2] / "packages" / "data-transformation" / "fhir-to-csv"
+
+
+class SinkError(Exception):
+    pass
+
+
+def get_processed_date() -> str:
+    """Value of the processed_date column, in the same format as fhir-to-csv's."""
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class SinkBackend(Protocol):
+    def insert_rows(self, table: str, columns: list[str], rows: list[tuple]) -> None:
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+class SQLiteBackend:
+    """Local stand-in for BigQuery: one SQLite table (TEXT columns) per table."""
+
+    def __init__(self, path: str = "sink.db"):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.created_tables = set()
+
+    def insert_rows(self, table: str, columns: list[str], rows: list[tuple]) -> None:
+        quoted_columns = ", ".join(f'"{column}"' for column in columns)
+        with self.lock:
+            if table not in self.created_tables:
+                self.connection.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({quoted_columns})')
+                self.created_tables.add(table)
+            placeholders = ", ".join("?" for _ in columns)
+            self.connection.executemany(f'INSERT INTO "{table}" ({quoted_columns}) VALUES ({placeholders})', rows)
+            self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class FileBackend:
+    """Local stand-in for BigQuery: one NDJSON file per table, a JSON object per row."""
+
+    def __init__(self, folder: str = "sink"):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.locks = defaultdict(threading.Lock)
+
+    def insert_rows(self, table: str, columns: list[str], rows: list[tuple]) -> None:
+        lines = "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+        with self.locks[table], open(self.folder / f"{table}.ndjson", "a", encoding="utf-8") as f:
+            f.write(lines)
+
+    def close(self) -> None:
+        pass
+
+
+class BigQueryBackend:
+    """Streams rows into the tables of a BigQuery dataset, which must already exist."""
+
+    def __init__(self, dataset: str):
+        try:
+            from google.cloud import bigquery
+        except ImportError:
+            raise ImportError("Please install google-cloud-bigquery to write to BigQuery.")
+        self.client = bigquery.Client()
+        self.dataset = dataset
+
+    def insert_rows(self, table: str, columns: list[str], rows: list[tuple]) -> None:
+        errors = self.client.insert_rows_json(
+            f"{self.dataset}.{table}", [dict(zip(columns, row)) for row in rows]
+        )
+        if errors:
+            raise RuntimeError(f"Failed to insert {len(errors)} rows into {table}: {errors[:3]}")
+
+    def close(self) -> None:
+        self.client.close()
+
+
+def get_backend() -> SinkBackend:
+    """The backend set by SINK_BACKEND: sqlite (default, SINK_PATH), file (SINK_PATH) or bigquery (BIGQUERY_DATASET)."""
+    backend = env.get_env_var("SINK_BACKEND", "sqlite")
+    if backend == "sqlite":
+        return SQLiteBackend(env.get_env_var("SINK_PATH", "sink.db"))
+    if backend == "file":
+        return FileBackend(env.get_env_var("SINK_PATH", "sink"))
+    if backend == "bigquery":
+        return BigQueryBackend(env.get_env_var("BIGQUERY_DATASET"))
+    raise ValueError(f"Unknown SINK_BACKEND: {backend}")
+
+
+class FhirToCsvFlattener:
+    """
+    Flattens resources with the fhir-to-csv configurations, so the rows are the same as in the
+    fhir-to-csv outputs (see fhir-to-csv's src/bulkTransform).
+    """
+
+    def __init__(self, fhir_to_csv_path: Path = _FHIR_TO_CSV_PATH):
+        if not (fhir_to_csv_path / "src").is_dir():
+            raise ImportError(f"fhir-to-csv not found at {fhir_to_csv_path}")
+        if str(fhir_to_csv_path) not in sys.path:
+            sys.path.append(str(fhir_to_csv_path))
+        from src.bulkTransform.bulkTransform import CompiledConfig
+        from src.parseFhir.resourceErrors import ResourceErrors
+        from src.parseNdjsonBundle.parseNdjsonBundle import config_folder
+
+        # Relative to the fhir-to-csv folder
+        configs_folder = str(fhir_to_csv_path / config_folder)
+        self.configs_by_type = defaultdict(list)
+        for config_file in sorted(os.listdir(configs_folder)):
+            if config_file.endswith(".ini"):
+                compiled = CompiledConfig(config_file, get_processed_date(), configs_folder)
+                self.configs_by_type[compiled.resource_type].append(compiled)
+        self.ResourceErrors = ResourceErrors
+
+    def flatten(
+        self, entries: list[dict], source: str = "", processed_date: str = None
+    ) -> dict[str, tuple[list[str], list[tuple]]]:
+        """Table -> (columns, rows) of a batch of bundle entries."""
+        processed_date = processed_date or get_processed_date()
+        resource_errors = self.ResourceErrors()
+        resources_by_type = defaultdict(list)
+        for entry in entries:
+            resource = entry.get("resource") or {}
+            resources_by_type[resource.get("resourceType")].append(resource)
+        tables = {}
+        for resource_type, resources in resources_by_type.items():
+            for compiled in self.configs_by_type.get(resource_type, []):
+                # The configs are shared by concurrent batches, the processed date is theirs
+                compiled = copy.copy(compiled)
+                compiled.processed_date = processed_date
+                columns = compiled.evaluate(resources, [source] * len(resources), resource_errors)
+                tables[compiled.table_name] = (compiled.header, list(zip(*columns)))
+        if len(resource_errors) > 0:
+            logging.warning(
+                f"{len(resource_errors)} resources of {source} failed to flatten: {dict(resource_errors.counts)}"
+            )
+        return tables
+
+
+class RawFlattener:
+    """One row per resource, (id, resource JSON), in a table per resource type."""
+
+    def flatten(
+        self, entries: list[dict], source: str = "", processed_date: str = None
+    ) -> dict[str, tuple[list[str], list[tuple]]]:
+        tables = defaultdict(lambda: (["id", "source", "resource"], []))
+        for entry in entries:
+            resource = entry.get("resource") or {}
+            table = str(resource.get("resourceType", "unknown")).lower()
+            tables[table][1].append((resource.get("id"), source, json.dumps(resource)))
+        return dict(tables)
+
+
+def get_flattener():
+    try:
+        return FhirToCsvFlattener()
+    except ImportError:
+        # The tables won't match the fhir-to-csv outputs, see requirements.txt for its dependencies
+        logging.exception("Can't flatten resources with fhir-to-csv, writing raw resources instead")
+        return RawFlattener()
+
+
+def _row_size(row: tuple) -> int:
+    return sum(len(value) if isinstance(value, str) else 8 for value in row)
+
+
+class BatchedSink:
+    """
+    Buffers rows per table and inserts them in batches of up to `max_batch_rows` rows and
+    `max_batch_bytes` bytes, with up to `concurrency` inserts running at once. Once
+    `max_pending_batches` batches are waiting to be inserted, `write` waits for them. Failed inserts
+    are retried up to `max_insert_attempts` times, then `flush` raises for the sources of their rows.
+    """
+
+    def __init__(
+        self,
+        backend: SinkBackend,
+        flattener=None,
+        max_batch_rows: int = 500,
+        max_batch_bytes: int = 5 * 1024 * 1024,
+        concurrency: int = 4,
+        max_pending_batches: int = 8,
+        max_insert_attempts: int = 3,
+        retry_delay: float = 1.0,
+    ):
+        self.backend = backend
+        self.flattener = flattener or get_flattener()
+        self.max_batch_rows = max_batch_rows
+        self.max_batch_bytes = max_batch_bytes
+        self.concurrency = concurrency
+        self.max_insert_attempts = max_insert_attempts
+        self.retry_delay = retry_delay
+        self.pending: asyncio.Queue = asyncio.Queue(maxsize=max_pending_batches)
+        # Table -> (columns, rows, bytes, sources) not sent yet
+        self.buffers: dict[str, tuple[list[str], list[tuple], int, set[str]]] = {}
+        # Source -> the inserts of the batches with its rows, resolved once they're done or failed
+        self.inserts_by_source: dict[str, list[asyncio.Future]] = defaultdict(list)
+        # Writers (e.g. webhook events processed concurrently) share the buffers
+        self.lock = asyncio.Lock()
+        self.inserted_rows = 0
+        self.failed_rows = 0
+        self.tasks: list[asyncio.Task] = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._insert_batches()) for _ in range(self.concurrency)]
+
+    async def close(self):
+        """Inserts what's left, then closes the backend."""
+        try:
+            await self.flush()
+        finally:
+            await self.pending.join()
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            self.tasks = []
+            self.backend.close()
+            logging.info(f"Sink closed: {self.inserted_rows} rows inserted, {self.failed_rows} failed")
+
+    async def write(self, entries: list[dict], source: str = "", processed_date: str = None):
+        """Flattens bundle entries and queues their rows, waiting if too many batches are pending."""
+        tables = await asyncio.to_thread(self.flattener.flatten, entries, source, processed_date)
+        async with self.lock:
+            for table, (columns, rows) in tables.items():
+                buffered_columns, buffered_rows, buffered_bytes, sources = self.buffers.get(
+                    table, (columns, [], 0, set())
+                )
+                for row in rows:
+                    size = _row_size(row)
+                    if buffered_rows and (
+                        len(buffered_rows) >= self.max_batch_rows or buffered_bytes + size > self.max_batch_bytes
+                    ):
+                        await self._queue_batch(table, buffered_columns, buffered_rows, sources)
+                        buffered_rows, buffered_bytes, sources = [], 0, set()
+                    buffered_rows.append(row)
+                    buffered_bytes += size
+                    sources.add(source)
+                self.buffers[table] = (buffered_columns, buffered_rows, buffered_bytes, sources)
+
+    async def flush(self, source: str = None):
+        """
+        Queues the rows buffered so far, even if their batches aren't full, and waits for the rows of
+        `source` (of all sources if not set) to be inserted. Raises SinkError if any of them failed.
+        """
+        async with self.lock:
+            buffers, self.buffers = self.buffers, {}
+            for table, (columns, rows, _, sources) in buffers.items():
+                if rows:
+                    await self._queue_batch(table, columns, rows, sources)
+            if source is None:
+                inserts = [insert for inserts in self.inserts_by_source.values() for insert in inserts]
+                self.inserts_by_source.clear()
+            else:
+                inserts = self.inserts_by_source.pop(source, [])
+        results = await asyncio.gather(*inserts, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise SinkError(f"{len(errors)} of {len(inserts)} batches failed to insert") from errors[0]
+
+    async def _queue_batch(self, table: str, columns: list[str], rows: list[tuple], sources: set[str]):
+        insert = asyncio.get_running_loop().create_future()
+        for source in sources:
+            self.inserts_by_source[source].append(insert)
+        await self.pending.put((table, columns, rows, insert))
+
+    async def _insert_batches(self):
+        while True:
+            table, columns, rows, insert = await self.pending.get()
+            try:
+                for attempt in range(1, self.max_insert_attempts + 1):
+                    try:
+                        await asyncio.to_thread(self.backend.insert_rows, table, columns, rows)
+                        self.inserted_rows += len(rows)
+                        insert.set_result(None)
+                        break
+                    except Exception as exc:
+                        if attempt == self.max_insert_attempts:
+                            self.failed_rows += len(rows)
+                            logging.exception(f"Failed to insert {len(rows)} rows into {table}")
+                            insert.set_exception(exc)
+                        else:
+                            logging.warning(f"Failed to insert {len(rows)} rows into {table}, retrying: {exc}")
+                            await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+            finally:
+                self.pending.task_done()
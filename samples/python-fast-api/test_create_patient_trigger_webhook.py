@@ -0,0 +1,97 @@
+import asyncio
+
+import httpx
+import pytest
+
+import roster_index
+from create_patient_trigger_webhook import Address, Contact, Patient, diff_roster, upload_new_patient
+
+FACILITY_ID = "facility"
+
+
+def make_patient(first_name: str, dob: str, external_id=None, phone="(555) 123-4567") -> Patient:
+    return Patient(
+        firstName=first_name,
+        lastName="Smith",
+        dob=dob,
+        genderAtBirth="F",
+        address=[Address(addressLine1="1 Main St", city="Springfield", state="IL", zip="62701")],
+        contact=[Contact(phone=phone)],
+        externalId=external_id,
+    )
+
+
+def test_diff_roster_shared_phone_with_external_ids_creates():
+    with roster_index.RosterIndex(":memory:") as index:
+        index.upsert(FACILITY_ID, make_patient("Jane", "1980-01-01", "ext-mom"), "MOM-ID")
+
+        diff = diff_roster(FACILITY_ID, [make_patient("Kid", "2015-01-01", "ext-kid")], index)
+
+    assert diff == [("create", None)]
+
+
+def test_diff_roster_shared_phone_with_an_indexed_external_id_creates():
+    with roster_index.RosterIndex(":memory:") as index:
+        index.upsert(FACILITY_ID, make_patient("Jane", "1980-01-01", "ext-mom"), "MOM-ID")
+
+        diff = diff_roster(FACILITY_ID, [make_patient("Kid", "2015-01-01")], index)
+
+    assert diff == [("create", None)]
+
+
+def test_diff_roster_shared_phone_with_same_demographics_is_unchanged():
+    with roster_index.RosterIndex(":memory:") as index:
+        index.upsert(FACILITY_ID, make_patient("Jane", "1980-01-01"), "MOM-ID")
+
+        diff = diff_roster(FACILITY_ID, [make_patient("Jane", "1980-01-01", "ext-mom")], index)
+
+    assert diff == [("unchanged", "MOM-ID")]
+
+
+def test_diff_roster_shared_contact_sibling_without_external_ids_creates():
+    with roster_index.RosterIndex(":memory:") as index:
+        index.upsert(FACILITY_ID, make_patient("Jane", "2012-01-01"), "SISTER-ID")
+
+        # Her brother, on the same parent's phone
+        diff = diff_roster(FACILITY_ID, [make_patient("John", "2015-01-01")], index)
+
+    assert diff == [("create", None)]
+
+
+def make_client(responses: list) -> tuple[httpx.AsyncClient, list]:
+    requests = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        response = responses[min(len(requests), len(responses)) - 1]
+        if isinstance(response, Exception):
+            raise response
+        return httpx.Response(response, json={"id": "PATIENT-ID"})
+
+    return httpx.AsyncClient(base_url="http://metriport", transport=httpx.MockTransport(handle)), requests
+
+
+def upload(client: httpx.AsyncClient) -> httpx.Response:
+    return asyncio.run(upload_new_patient(FACILITY_ID, make_patient("Jane", "1980-01-01"), client))
+
+
+def test_upload_new_patient_is_not_retried_on_server_errors():
+    client, requests = make_client([500, 200])
+
+    assert upload(client).status_code == 500
+    assert len(requests) == 1
+
+
+def test_upload_new_patient_is_not_retried_on_timeouts():
+    client, requests = make_client([httpx.ReadTimeout("timed out"), 200])
+
+    with pytest.raises(httpx.ReadTimeout):
+        upload(client)
+    assert len(requests) == 1
+
+
+def test_upload_new_patient_is_retried_when_rate_limited():
+    client, requests = make_client([429, 200])
+
+    assert upload(client).status_code == 200
+    assert len(requests) == 2
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from sink import BatchedSink, RawFlattener, SinkError
+
+
+class FlakyBackend:
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.inserted = []
+
+    def insert_rows(self, table: str, columns: list[str], rows: list[tuple]) -> None:
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError("Insert failed")
+        self.inserted.extend(rows)
+
+    def close(self) -> None:
+        pass
+
+
+entries = [{"resource": {"resourceType": "Condition", "id": "1"}}]
+
+
+def write_and_flush(backend: FlakyBackend):
+    async def run():
+        sink = BatchedSink(backend, flattener=RawFlattener(), max_insert_attempts=2, retry_delay=0)
+        sink.start()
+        try:
+            await sink.write(entries, source="message-1")
+            await sink.flush("message-1")
+        finally:
+            await sink.close()
+
+    asyncio.run(run())
+
+
+def test_failed_insert_is_retried():
+    backend = FlakyBackend(failures=1)
+
+    write_and_flush(backend)
+
+    assert len(backend.inserted) == 1
+
+
+def test_flush_raises_when_the_insert_keeps_failing():
+    backend = FlakyBackend(failures=2)
+
+    with pytest.raises(SinkError):
+        write_and_flush(backend)
+    assert backend.inserted == []
@@ -0,0 +1,27 @@
+import asyncio
+
+from work_queue import WorkQueue
+
+
+def test_failed_item_can_be_redelivered():
+    processed = []
+
+    async def handler(item):
+        processed.append(item)
+        if item == "first attempt":
+            raise RuntimeError("Failed to process")
+
+    async def run():
+        queue = WorkQueue(handler, workers=1)
+        queue.start()
+        assert queue.submit("message-1", "first attempt")
+        assert queue.submit("message-2", "processed")
+        await queue.queue.join()
+        # The failed one is processed again, the processed one is still a duplicate
+        assert queue.submit("message-1", "redelivery")
+        assert not queue.submit("message-2", "duplicate")
+        await queue.stop()
+
+    asyncio.run(run())
+
+    assert processed == ["first attempt", "processed", "redelivery"]
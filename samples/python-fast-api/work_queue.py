@@ -0,0 +1,73 @@
+"""In-process work queue, so the webhook can acknowledge events right away and process them after."""
+
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+
+class WorkQueue:
+    """
+    Runs `handler(item)` for submitted items on `workers` concurrent tasks.
+
+    Items are submitted with an idempotency key (the webhook's `meta.messageId`): an item whose key
+    was already submitted is dropped, so redelivered webhooks are only processed once. The last
+    `max_seen_keys` keys are remembered. The key of an item whose handler fails is forgotten, so a
+    redelivery of it is processed again.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[object], Awaitable[None]],
+        workers: int = 4,
+        max_size: int = 1000,
+        max_seen_keys: int = 100_000,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self.max_seen_keys = max_seen_keys
+        self.seen_keys: OrderedDict = OrderedDict()
+        self.tasks: list[asyncio.Task] = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: Optional[float] = 30):
+        """Processes the items still in the queue (up to `timeout` seconds), then stops the workers."""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Stopping with {self.queue.qsize()} items left in the queue")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, key: Optional[str], item) -> bool:
+        """
+        Queues an item, returns False if its key was already submitted. Raises asyncio.QueueFull
+        when the queue is full.
+        """
+        if key is not None:
+            if key in self.seen_keys:
+                self.seen_keys.move_to_end(key)
+                return False
+        self.queue.put_nowait((key, item))
+        if key is not None:
+            self.seen_keys[key] = True
+            if len(self.seen_keys) > self.max_seen_keys:
+                self.seen_keys.popitem(last=False)
+        return True
+
+    async def _work(self):
+        while True:
+            key, item = await self.queue.get()
+            try:
+                await self.handler(item)
+            except Exception:
+                logging.exception(f"Failed to process a queued item (key {key})")
+                if key is not None:
+                    self.seen_keys.pop(key, None)
+            finally:
+                self.queue.task_done()